@@ -16,6 +16,7 @@ class SessionAdmin(admin.ModelAdmin):
         "start_time",
         "last_seen",
         "identifier",
+        "hit_count",
         "ip",
         "asn",
         "country",
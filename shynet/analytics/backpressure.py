@@ -0,0 +1,90 @@
+import time as _time
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.cache import cache
+
+# The ingestion lag is how long ago the events being ingested right now were enqueued
+# (by this server, so it can't be skewed by clients). It rises whenever events arrive
+# faster than they are written, however they are queued (Celery, the ingress buffer or
+# the background writer). Events replayed from the spool are not counted.
+LAG_KEY = "ingress_lag"
+# When the oldest events enqueued since ingestion last reported its lag were enqueued.
+# If ingestion stalls completely, nothing reports a lag anymore, but this keeps aging.
+PENDING_KEY = "ingress_pending_since"
+# How often each process reports and reads the lag, in seconds
+LAG_REFRESH_INTERVAL = 1
+# How long a reported lag stays valid if nothing is ingested anymore, in seconds
+LAG_TIMEOUT = 60 * 10
+
+_marked_at = 0
+_reported_at = 0
+_observed_at = 0
+_observed_lag = 0
+
+
+def is_enabled():
+    return settings.INGRESS_SHED_HEARTBEATS_LAG > 0 or settings.INGRESS_SAMPLE_LAG > 0
+
+
+def mark_enqueued():
+    """Record that events are waiting to be ingested (at most once per interval)."""
+    global _marked_at
+    if not is_enabled() or _time.monotonic() - _marked_at < LAG_REFRESH_INTERVAL:
+        return
+    _marked_at = _time.monotonic()
+    cache.add(PENDING_KEY, _time.time(), timeout=None)
+
+
+def report_lag(enqueued_at):
+    """Record how long ago the events being ingested were enqueued (at most once per
+    interval), as a Unix timestamp."""
+    global _reported_at
+    if not is_enabled():
+        return
+    # Events enqueued from now on mark themselves again. Every time, so that no mark
+    # outlives the events it was made for.
+    cache.delete(PENDING_KEY)
+    if _time.monotonic() - _reported_at < LAG_REFRESH_INTERVAL:
+        return
+    _reported_at = _time.monotonic()
+    cache.set(LAG_KEY, max(_time.time() - enqueued_at, 0), timeout=LAG_TIMEOUT)
+
+
+def current_lag():
+    global _observed_at, _observed_lag
+    if _time.monotonic() - _observed_at >= LAG_REFRESH_INTERVAL:
+        _observed_at = _time.monotonic()
+        values = cache.get_many([LAG_KEY, PENDING_KEY])
+        pending_since = values.get(PENDING_KEY)
+        _observed_lag = max(
+            values.get(LAG_KEY) or 0,
+            _time.time() - pending_since if pending_since is not None else 0,
+        )
+    return _observed_lag
+
+
+def should_shed_heartbeats():
+    threshold = settings.INGRESS_SHED_HEARTBEATS_LAG
+    return threshold > 0 and current_lag() >= threshold
+
+
+def sample_rate():
+    # The share of new page loads to record. Drops as the lag grows past the
+    # threshold, so that the load shrinks in proportion to how far behind we are.
+    threshold = settings.INGRESS_SAMPLE_LAG
+    if threshold <= 0:
+        return 1.0
+    lag = current_lag()
+    if lag < threshold:
+        return 1.0
+    return max(settings.INGRESS_MIN_SAMPLE_RATE, threshold / lag)
+
+
+def is_sampled(association, rate):
+    # Deterministic, so that every event of a visitor gets the same answer as long as
+    # the rate stays the same; sessions are kept or dropped as a whole.
+    if rate >= 1:
+        return True
+    digest = sha256(association.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64 < rate
@@ -0,0 +1,97 @@
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+from core.cache import incr
+
+# How long buffered items survive in the cache if they are never drained, in seconds
+BUFFER_ITEM_TIMEOUT = 60 * 60 * 24
+# How long a consumer may hold on to the items it drains before another one can drain
+# them again, in seconds
+DRAIN_LOCK_TIMEOUT = 60
+
+
+class CacheBuffer:
+    # A first-in, first-out buffer kept in the Django cache. Producers claim a slot by
+    # incrementing a shared tail counter; a single consumer at a time drains slots from
+    # the head. The buffer is shared between processes whenever the cache is (Redis).
+
+    def __init__(self, name, timeout=BUFFER_ITEM_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+
+    @property
+    def _head_key(self):
+        return f"{self.name}_head"
+
+    @property
+    def _tail_key(self):
+        return f"{self.name}_tail"
+
+    @property
+    def _lock_key(self):
+        return f"{self.name}_lock"
+
+    def _item_key(self, index):
+        return f"{self.name}_item_{index}"
+
+    def push(self, item):
+        """Append an item and return its position in the buffer (starting at 1)."""
+        index = incr(self._tail_key)
+        cache.set(self._item_key(index), item, timeout=self.timeout)
+        return index
+
+    def push_many(self, items):
+        """Append items in order, claiming their slots at once."""
+        if len(items) == 0:
+            return
+        tail = incr(self._tail_key, len(items))
+        cache.set_many(
+            {
+                self._item_key(tail - len(items) + i): item
+                for i, item in enumerate(items, start=1)
+            },
+            timeout=self.timeout,
+        )
+
+    @contextmanager
+    def drain(self, limit):
+        """Yield up to `limit` items from the head of the buffer, and remove them once
+        the block completes. If it raises, the next drain yields them again."""
+        if not cache.add(self._lock_key, 1, timeout=DRAIN_LOCK_TIMEOUT):
+            # Another consumer is draining the buffer right now
+            yield []
+            return
+        try:
+            head = cache.get(self._head_key) or 0
+            tail = cache.get(self._tail_key) or 0
+            if tail < head:
+                # The counters were evicted from the cache; start over
+                head = 0
+
+            indexes = range(head + 1, min(tail, head + limit) + 1)
+            if len(indexes) == 0:
+                yield []
+                return
+            found = cache.get_many([self._item_key(index) for index in indexes])
+
+            items = []
+            drained_keys = []
+            for index in indexes:
+                key = self._item_key(index)
+                if key not in found:
+                    # The slot was claimed but its item has not been written yet. Give
+                    # the producer until the next drain before skipping the slot.
+                    if cache.add(f"{self.name}_gap_{index}", 1, timeout=self.timeout):
+                        break
+                else:
+                    items.append(found[key])
+                    drained_keys.append(key)
+                head = index
+
+            yield items
+
+            cache.set(self._head_key, head, timeout=None)
+            cache.delete_many(drained_keys)
+        finally:
+            cache.delete(self._lock_key)
@@ -0,0 +1,60 @@
+from collections import namedtuple
+from functools import lru_cache
+from hashlib import sha256
+
+import user_agents
+from django.conf import settings
+from django.core.cache import cache
+
+# How long parsed user agents are kept in the shared cache, in seconds
+SHARED_CACHE_TIMEOUT = 60 * 60 * 24
+
+Device = namedtuple("Device", ["browser", "os", "device", "device_type"])
+
+# Lookups that reached the shared cache (i.e., missed the in-process cache)
+shared_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _get_device_type(ua):
+    if (
+        ua.is_bot
+        or (ua.browser.family or "").strip().lower() == "googlebot"
+        or (ua.device.family or ua.device.model or "").strip().lower() == "spider"
+    ):
+        return "ROBOT"
+    elif ua.is_mobile:
+        return "PHONE"
+    elif ua.is_tablet:
+        return "TABLET"
+    elif ua.is_pc:
+        return "DESKTOP"
+    return "OTHER"
+
+
+def parse_user_agent(user_agent):
+    ua = user_agents.parse(user_agent)
+    return Device(
+        browser=ua.browser.family or "",
+        os=ua.os.family or "",
+        device=ua.device.family or ua.device.model or "",
+        device_type=_get_device_type(ua),
+    )
+
+
+@lru_cache(maxsize=settings.USER_AGENT_CACHE_SIZE)
+def classify_user_agent(user_agent):
+    # Real traffic has few distinct user agents, so parsing each of them once per
+    # process (or once per deployment, with the shared cache) is enough.
+    # classify_user_agent.cache_info() reports the in-process hits and misses.
+    if not settings.USER_AGENT_SHARED_CACHE:
+        return parse_user_agent(user_agent)
+
+    key = f"user_agent_{sha256(user_agent.encode('utf-8')).hexdigest()}"
+    device = cache.get(key)
+    if device is not None:
+        shared_cache_stats["hits"] += 1
+        return Device(*device)
+    shared_cache_stats["misses"] += 1
+    device = parse_user_agent(user_agent)
+    cache.set(key, tuple(device), timeout=SHARED_CACHE_TIMEOUT)
+    return device
@@ -0,0 +1,140 @@
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+
+import geoip2.database
+import geoip2.errors
+from django.conf import settings
+from maxminddb import MODE_MMAP, InvalidDatabaseError
+
+log = logging.getLogger(__name__)
+
+ENRICHMENT_LEVELS = {"country", "city", "asn"}
+
+
+class GeoIPLookup:
+    # Looks up the location and network of IP addresses in the MaxMind databases. Both
+    # databases are memory-mapped once per process and shared between threads, and
+    # results are cached per IP. Only the databases needed for the configured
+    # enrichment levels are opened:
+    #   - "country": the visitor's country
+    #   - "city": the visitor's country, coordinates and time zone
+    #   - "asn": the visitor's network operator
+    #
+    # Every `reload_interval` seconds, the database files are checked for changes. A
+    # changed file is opened as a new reader, which replaces the old one in a single
+    # assignment; lookups already running keep the old reader until they finish. Update
+    # the files by renaming a new file over the old one, never by writing in place.
+
+    def __init__(self, city_db, asn_db, enrichment, cache_size, reload_interval=0):
+        unknown = set(enrichment) - ENRICHMENT_LEVELS
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown GeoIP enrichment levels: {', '.join(unknown)}")
+        self.enrichment = set(enrichment)
+        self.paths = (
+            city_db if self.enrichment & {"country", "city"} else None,
+            asn_db if "asn" in self.enrichment else None,
+        )
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._readers = None
+        self._signatures = (None, None)
+        self._next_check = 0
+        self._cached_lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _open(self, path):
+        try:
+            return geoip2.database.Reader(path, mode=MODE_MMAP)
+        except (OSError, InvalidDatabaseError) as e:
+            log.exception("Unable to open GeoIP database: %s", e)
+            return None
+
+    def _signature(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _reload(self):
+        # Must be called with the lock held
+        self._next_check = time.monotonic() + self.reload_interval
+        first_load = self._readers is None
+        old_readers = self._readers or (None, None)
+
+        readers, signatures = [], []
+        for path, reader, signature in zip(self.paths, old_readers, self._signatures):
+            new_signature = self._signature(path) if path is not None else None
+            if path is None or (not first_load and new_signature == signature):
+                readers.append(reader)
+                signatures.append(signature)
+                continue
+            new_reader = self._open(path)
+            if new_reader is None and reader is not None:
+                # Keep using the old database (the new one may still be being copied)
+                # and try again at the next check
+                readers.append(reader)
+                signatures.append(signature)
+            else:
+                readers.append(new_reader)
+                signatures.append(new_signature)
+                if not first_load:
+                    log.info(f"Reloaded GeoIP database {path}")
+
+        changed = not first_load and tuple(readers) != old_readers
+        self._readers = tuple(readers)
+        self._signatures = tuple(signatures)
+        if changed:
+            self._cached_lookup.cache_clear()
+
+    def get_readers(self):
+        # Returns the city and ASN readers (either may be None)
+        readers = self._readers
+        if readers is not None and (
+            self.reload_interval <= 0 or time.monotonic() < self._next_check
+        ):
+            return readers
+        with self._lock:
+            if self._readers is None or (
+                self.reload_interval > 0 and time.monotonic() >= self._next_check
+            ):
+                self._reload()
+            return self._readers
+
+    def lookup(self, ip):
+        # Checks for changed databases first, so that cached results of the old ones
+        # are forgotten even for IPs that are looked up all the time
+        self.get_readers()
+        return self._cached_lookup(ip)
+
+    def _lookup(self, ip):
+        # The result is shared between callers and must not be modified
+        city_reader, asn_reader = self.get_readers()
+        data = {}
+        try:
+            if city_reader is not None:
+                city_results = city_reader.city(ip)
+                data["country"] = city_results.country.iso_code
+                if "city" in self.enrichment:
+                    data["longitude"] = city_results.location.longitude
+                    data["latitude"] = city_results.location.latitude
+                    data["time_zone"] = city_results.location.time_zone
+            if asn_reader is not None:
+                asn_results = asn_reader.asn(ip)
+                data["asn"] = asn_results.autonomous_system_organization
+        except geoip2.errors.AddressNotFoundError:
+            pass
+        except ValueError as e:
+            log.debug(f"Cannot look up invalid IP {ip}: {e}")
+        return data
+
+
+geoip = GeoIPLookup(
+    settings.MAXMIND_CITY_DB,
+    settings.MAXMIND_ASN_DB,
+    settings.MAXMIND_ENRICHMENT,
+    settings.MAXMIND_CACHE_SIZE,
+    settings.MAXMIND_RELOAD_INTERVAL,
+)
@@ -0,0 +1,92 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+
+from .buffer import CacheBuffer
+from .models import Hit, Session
+
+# How many rows are updated by a single UPDATE statement when flushing
+FLUSH_CHUNK_SIZE = 500
+
+pending_heartbeats = CacheBuffer("heartbeat_buffer")
+
+
+def record_heartbeats(heartbeats):
+    # Accumulates heartbeats in the cache instead of writing them to the database.
+    # Each one is a (hit pk, session pk, hit last seen, last seen) tuple: a hit may
+    # have been seen earlier than its heartbeat arrived. They are only grouped by hit
+    # when they are flushed, so concurrent heartbeats can't overwrite each other.
+    pending_heartbeats.push_many(list(heartbeats))
+
+
+def coalesce_heartbeats(heartbeats):
+    # Groups (hit pk, session pk, hit last seen, last seen) tuples by hit, as expected
+    # by write_heartbeats
+    coalesced = {}
+    for hit_pk, session_pk, hit_last_seen, last_seen in heartbeats:
+        _, count, previous_hit_last_seen, previous_last_seen = coalesced.get(
+            hit_pk, (session_pk, 0, hit_last_seen, last_seen)
+        )
+        coalesced[hit_pk] = (
+            session_pk,
+            count + 1,
+            max(hit_last_seen, previous_hit_last_seen),
+            max(last_seen, previous_last_seen),
+        )
+    return coalesced
+
+
+def flush_heartbeats(limit):
+    # Writes up to `limit` recorded heartbeats to the database. Returns the number of
+    # heartbeats that were flushed. They are only removed from the cache once they
+    # are written, so a failed flush is retried by the next one.
+    with pending_heartbeats.drain(limit) as pending:
+        if len(pending) > 0:
+            with transaction.atomic():
+                write_heartbeats(coalesce_heartbeats(pending))
+        return len(pending)
+
+
+def write_heartbeats(heartbeats):
+    # Adds heartbeats to hits and their sessions with one UPDATE statement per chunk,
+    # without loading them. `heartbeats` maps the pks of hits to their session's pk,
+    # their number of new heartbeats, when the hit was last seen and when the session
+    # was. Returns the number of hits that still existed.
+    session_last_seens = {}
+    for session_pk, _, _, last_seen in heartbeats.values():
+        session_last_seens[session_pk] = max(
+            last_seen, session_last_seens.get(session_pk, last_seen)
+        )
+
+    hit_pks = list(heartbeats.keys())
+    session_pks = list(session_last_seens.keys())
+    updated = 0
+    for i in range(0, len(hit_pks), FLUSH_CHUNK_SIZE):
+        chunk = hit_pks[i : i + FLUSH_CHUNK_SIZE]
+        updated += Hit.objects.filter(pk__in=chunk).update(
+            heartbeats=F("heartbeats")
+            + Case(
+                *[When(pk=pk, then=Value(heartbeats[pk][1])) for pk in chunk],
+                default=Value(0),
+                output_field=IntegerField(),
+            ),
+            last_seen=Greatest(
+                F("last_seen"),
+                Case(
+                    *[When(pk=pk, then=Value(heartbeats[pk][2])) for pk in chunk],
+                    default=F("last_seen"),
+                ),
+            ),
+        )
+    for i in range(0, len(session_pks), FLUSH_CHUNK_SIZE):
+        chunk = session_pks[i : i + FLUSH_CHUNK_SIZE]
+        Session.objects.filter(pk__in=chunk).update(
+            last_seen=Greatest(
+                F("last_seen"),
+                Case(
+                    *[When(pk=pk, then=Value(session_last_seens[pk])) for pk in chunk],
+                    default=F("last_seen"),
+                ),
+            )
+        )
+    return updated
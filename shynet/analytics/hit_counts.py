@@ -0,0 +1,23 @@
+from django.db.models import Case, Count, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+
+def recalculate_hit_counts(sessions, hits):
+    # Counts the hits of the given sessions again, and sets whether they bounced
+    # accordingly. Takes querysets rather than models, so that migrations can pass
+    # those of their historical models. Returns the number of sessions.
+    hit_counts = (
+        hits.filter(session=OuterRef("pk"))
+        .order_by()
+        .values("session")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    updated = sessions.update(hit_count=Coalesce(Subquery(hit_counts), Value(0)))
+    sessions.update(
+        is_bounce=Case(
+            When(hit_count=1, then=Value(True)),
+            default=Value(False),
+        )
+    )
+    return updated
@@ -1,28 +1,30 @@
+from django.conf import settings
 from django.contrib import admin
 from django.urls import include, path
 
 from .views import ingress
 
+if settings.ASYNC_INGRESS:
+    PixelView, ScriptView = ingress.AsyncPixelView, ingress.AsyncScriptView
+else:
+    PixelView, ScriptView = ingress.PixelView, ingress.ScriptView
+
 urlpatterns = [
-    path(
-        "<service_uuid>/pixel.gif", ingress.PixelView.as_view(), name="endpoint_pixel"
-    ),
-    path(
-        "<service_uuid>/script.js", ingress.ScriptView.as_view(), name="endpoint_script"
-    ),
+    path("<service_uuid>/pixel.gif", PixelView.as_view(), name="endpoint_pixel"),
+    path("<service_uuid>/script.js", ScriptView.as_view(), name="endpoint_script"),
     path(
         "<service_uuid>/<identifier>/pixel.gif",
-        ingress.PixelView.as_view(),
+        PixelView.as_view(),
         name="endpoint_pixel_id",
     ),
     path(
         "<service_uuid>/<identifier>/script.js",
-        ingress.ScriptView.as_view(),
+        ScriptView.as_view(),
         name="endpoint_script_id",
     ),
     path(
         "<service_uuid>/random/<random_number>/pixel.gif",
-        ingress.PixelView.as_view(),
+        PixelView.as_view(),
         name="endpoint_pixel_random",
     ),
 ]
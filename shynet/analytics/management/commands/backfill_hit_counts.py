@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from analytics.hit_counts import recalculate_hit_counts
+from analytics.models import Hit, Session
+
+
+class Command(BaseCommand):
+    help = "Recalculates the hit count and bounce status of existing sessions"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--service",
+            type=str,
+            help="Only recalculate the sessions of the service with this UUID",
+        )
+
+    def handle(self, *args, **options):
+        sessions = Session.objects.all()
+        if options.get("service") is not None:
+            sessions = sessions.filter(service=options.get("service"))
+
+        updated = recalculate_hit_counts(sessions, Hit.objects.all())
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Successfully recalculated {updated} sessions")
+        )
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from analytics.pipeline import association_cache, stage_timings
+from analytics.tasks import dropped_ingress_counts
+from analytics.views.ingress import script_cache
+from core.local_cache import local_cache_stats
+from core.service_config import config_versions
+
+
+class Command(BaseCommand):
+    help = (
+        "Shows how many tracking events were dropped before being enqueued, how long "
+        "each stage of ingestion takes, and how well the local caches do"
+    )
+
+    def handle(self, *args, **options):
+        for reason, count in dropped_ingress_counts().items():
+            self.stdout.write(f"Dropped ({reason}): {count}")
+        for stage, timing in stage_timings().items():
+            self.stdout.write(
+                f"Stage ({stage}): {timing['events']} events, "
+                f"{timing['seconds_per_event'] * 1e6:.1f} µs per event"
+            )
+        stats = local_cache_stats([config_versions, script_cache, association_cache])
+        for name, stat in stats.items():
+            self.stdout.write(
+                f"Local cache ({name}): {stat['hits']} hits, {stat['misses']} misses "
+                f"({stat['hit_ratio']:.1%} hit ratio), "
+                f"~{stat['saved_seconds']:.1f}s saved"
+            )
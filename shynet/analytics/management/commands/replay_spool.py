@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analytics.spool import Spool
+from analytics.tasks import UNAVAILABLE_ERRORS, ingest_events
+
+
+class Command(BaseCommand):
+    help = "Writes tracking events that were spooled to disk during an outage"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--directory",
+            type=str,
+            default=settings.INGRESS_SPOOL_DIRECTORY,
+            help="The spool directory (defaults to INGRESS_SPOOL_DIRECTORY)",
+        )
+
+    def handle(self, *args, **options):
+        if options.get("directory") == "":
+            raise CommandError("No spool directory is configured")
+
+        spool = Spool(
+            options.get("directory"),
+            settings.INGRESS_SPOOL_SEGMENT_SIZE,
+            retryable=UNAVAILABLE_ERRORS,
+        )
+        replayed = spool.replay(ingest_events)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Successfully replayed {replayed} events")
+        )
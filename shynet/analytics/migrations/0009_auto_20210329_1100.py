@@ -1,13 +1,13 @@
 # Generated by Django 3.1.7 on 2021-03-29 15:00
 
 from django.db import migrations, models
-from ..models import Session
 
 
-def update_bounce_stats(_a, _b):
-    Session.objects.all().annotate(hit_count=models.Count("hit")).filter(
-        hit_count__gt=1
-    ).update(is_bounce=False)
+def update_bounce_stats(apps, _b):
+    Session = apps.get_model("analytics", "Session")
+    Session.objects.all().annotate(hits=models.Count("hit")).filter(hits__gt=1).update(
+        is_bounce=False
+    )
 
 
 class Migration(migrations.Migration):
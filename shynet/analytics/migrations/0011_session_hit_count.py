@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+from analytics.hit_counts import recalculate_hit_counts
+
+
+def backfill_hit_counts(apps, schema_editor):
+    Session = apps.get_model("analytics", "Session")
+    Hit = apps.get_model("analytics", "Hit")
+    recalculate_hit_counts(Session.objects.all(), Hit.objects.all())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("analytics", "0010_auto_20220624_0744"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="session",
+            name="hit_count",
+            field=models.IntegerField(default=0, verbose_name="Hit count"),
+        ),
+        migrations.RunPython(backfill_hit_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("analytics", "0011_session_hit_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="hit",
+            name="sample_weight",
+            field=models.FloatField(default=1.0),
+        ),
+        migrations.AddField(
+            model_name="session",
+            name="sample_weight",
+            field=models.FloatField(default=1.0, verbose_name="Sample weight"),
+        ),
+    ]
@@ -57,10 +57,15 @@ class Session(models.Model):
     latitude = models.FloatField(null=True, verbose_name=_("Latitude"))
     time_zone = models.TextField(blank=True, verbose_name=_("Time zone"))
 
+    # Denormalized so that neither ingestion nor the session list needs to count hits
+    hit_count = models.IntegerField(default=0, verbose_name=_("Hit count"))
     is_bounce = models.BooleanField(
         default=True, db_index=True, verbose_name=_("Is bounce")
     )
 
+    # How many sessions this one stands for; more than one if it was sampled
+    sample_weight = models.FloatField(default=1.0, verbose_name=_("Sample weight"))
+
     class Meta:
         verbose_name = _("Session")
         verbose_name_plural = _("Sessions")
@@ -88,11 +93,17 @@ class Session(models.Model):
             kwargs={"pk": self.service.pk, "session_pk": self.uuid},
         )
 
-    def recalculate_bounce(self):
-        bounce = self.hit_set.count() == 1
-        if bounce != self.is_bounce:
-            self.is_bounce = bounce
-            self.save()
+    @classmethod
+    def add_hits(cls, session_pks, count=1):
+        # Atomically adds to the hit count of the given sessions. A session is a bounce
+        # if it has exactly one hit, so its bounce status is updated in the same statement.
+        return cls.objects.filter(pk__in=session_pks).update(
+            hit_count=models.F("hit_count") + count,
+            is_bounce=models.Case(
+                models.When(hit_count=1 - count, then=models.Value(True)),
+                default=models.Value(False),
+            ),
+        )
 
 
 class Hit(models.Model):
@@ -114,6 +125,9 @@ class Hit(models.Model):
     referrer = models.TextField(blank=True, db_index=True)
     load_time = models.FloatField(null=True, db_index=True)
 
+    # How many hits this one stands for; more than one if its session was sampled
+    sample_weight = models.FloatField(default=1.0)
+
     # While not necessary, we store the root service directly for performance.
     # It makes querying much easier; no need for inner joins.
     service = models.ForeignKey(Service, on_delete=models.CASCADE, db_index=True)
@@ -0,0 +1,613 @@
+import logging
+import math
+import random
+import threading
+import time as _time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timezone as dt_timezone
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from core.cache import get_and_touch_many, incr
+from core.local_cache import LocalCache
+from core.service_config import get_service_config
+
+from .devices import classify_user_agent
+from .geoip import geoip
+from .heartbeats import coalesce_heartbeats, record_heartbeats, write_heartbeats
+from .models import Hit, Session
+
+log = logging.getLogger(__name__)
+
+# The stages every list of events goes through, in order:
+#   - validate: resolve the services of the events and normalize their payloads
+#   - filter: drop events that must not be recorded (DNT, ignored IPs)
+#   - associate: find the sessions and hits the events belong to, and claim the
+#     sessions that need to be created
+#   - enrich: classify the user agents and locate the IPs of new sessions
+#   - persist: write the events, with a fixed number of queries per list
+# Enrichment comes after association, since only new sessions need it.
+STAGES = ("validate", "filter", "associate", "enrich", "persist")
+
+# The sessions and hits of recent events, kept in this process so that the events
+# that follow them (mostly heartbeats) can skip the shared cache. Their timeouts in
+# the shared cache are refreshed whenever they are looked up there again.
+association_cache = LocalCache("associations")
+
+# How long a process may take to create a session it claimed, in seconds. Processes
+# that need the same session meanwhile wait for at most this long, then reuse it.
+SESSION_CLAIM_LEASE = 5
+# How often waiting processes check whether the claimed session was created
+SESSION_CLAIM_POLL_INTERVAL = 0.05
+
+# How often each process adds its stage timings to the shared totals, in seconds
+TIMINGS_FLUSH_INTERVAL = 60
+
+
+def is_ignored_ip(service, ip):
+    try:
+        return ip in service.ignored_networks
+    except ValueError as e:
+        log.exception(e)
+    return False
+
+
+def session_cache_path(service, ip, user_agent):
+    association_id_hash = sha256()
+    association_id_hash.update(str(ip).encode("utf-8"))
+    association_id_hash.update(str(user_agent).encode("utf-8"))
+    if settings.AGGRESSIVE_HASH_SALTING:
+        association_id_hash.update(str(service.pk).encode("utf-8"))
+        association_id_hash.update(
+            str(timezone.now().date().isoformat()).encode("utf-8")
+        )
+    return f"session_association_{service.pk}_{association_id_hash.hexdigest()}"
+
+
+def idempotency_cache_path(idempotency):
+    return f"hit_idempotency_{idempotency}"
+
+
+def _session_claim_path(session_cache_path):
+    return f"{session_cache_path}_claim"
+
+
+def _claim_sessions(session_cache_paths):
+    # Makes sure only one process at a time creates the session of a visitor, so that
+    # a visitor's first events arriving together (from two tabs, or a page load and
+    # its heartbeat) don't each create one. Returns the paths this process claimed,
+    # which must be released with _release_session_claims once their sessions are
+    # cached, and the pks of sessions that other processes created in the meantime.
+    #
+    # A process either gets every claim it needs, or holds none while it waits:
+    # otherwise two processes that each claimed a session the other one needs would
+    # wait for each other until the lease expires, then both create them. Claims are
+    # taken in order, so that such processes don't keep getting in each other's way.
+    pending = set(session_cache_paths)
+    claimed, found = set(), {}
+    if len(pending) == 0:
+        return claimed, found
+    deadline = _time.monotonic() + SESSION_CLAIM_LEASE
+    while True:
+        claimed = set()
+        for path in sorted(pending):
+            if not cache.add(_session_claim_path(path), 1, timeout=SESSION_CLAIM_LEASE):
+                break
+            claimed.add(path)
+        # Whoever held a claim before may have created the session already
+        created = cache.get_many(list(pending))
+        found.update(created)
+        pending.difference_update(created)
+        _release_session_claims(claimed.intersection(created))
+        claimed.difference_update(created)
+        if claimed == pending or _time.monotonic() >= deadline:
+            # Sessions still claimed by others at the deadline are created anyway
+            return claimed, found
+        _release_session_claims(claimed)
+        _time.sleep(random.uniform(0.5, 1.5) * SESSION_CLAIM_POLL_INTERVAL)
+
+
+def _release_session_claims(session_cache_paths):
+    # Claims of processes that fail before releasing them expire after the lease
+    if len(session_cache_paths) > 0:
+        cache.delete_many([_session_claim_path(path) for path in session_cache_paths])
+
+
+def _remember_associations(associations):
+    cache.set_many(associations, timeout=settings.SESSION_MEMORY_TIMEOUT)
+    association_cache.set_many(associations)
+
+
+def _enrich(ip, user_agent):
+    return (classify_user_agent(user_agent), geoip.lookup(ip))
+
+
+def _new_session_fields(
+    service, time, ip, user_agent, identifier, enrichment, sample_rate=1.0
+):
+    # Returns the fields of a new session, or None if the session should not be
+    # recorded at all. A session sampled at rate r stands for 1 / r sessions.
+    device, ip_data = enrichment
+    if device.device_type == "ROBOT" and service.ignore_robots:
+        return None
+
+    return dict(
+        service_id=service.pk,
+        ip=ip if service.collect_ips and not settings.BLOCK_ALL_IPS else None,
+        user_agent=user_agent,
+        identifier=identifier.strip(),
+        browser=device.browser,
+        device=device.device,
+        device_type=device.device_type,
+        start_time=time,
+        last_seen=time,
+        hit_count=1,
+        sample_weight=1 / sample_rate,
+        os=device.os,
+        asn=ip_data.get("asn") or "",
+        country=ip_data.get("country") or "",
+        longitude=ip_data.get("longitude"),
+        latitude=ip_data.get("latitude"),
+        time_zone=ip_data.get("time_zone") or "",
+    )
+
+
+def _new_hit_fields(
+    service, session, initial, tracker, time, payload, location, sample_rate=1.0
+):
+    return dict(
+        session=session,
+        initial=initial,
+        tracker=tracker,
+        # At first, location is given by the HTTP referrer. Some browsers
+        # will send the source of the script, however, so we allow JS payloads
+        # to include the location.
+        location=payload.get("location", location),
+        referrer=payload.get("referrer", ""),
+        load_time=payload.get("loadTime"),
+        start_time=time,
+        last_seen=time,
+        sample_weight=1 / sample_rate,
+        service_id=service.pk,
+    )
+
+
+def _hit_association(hit):
+    # What the idempotency key of a hit maps to in the cache. Knowing the session of a
+    # hit lets heartbeats be verified without loading either row.
+    # Its start time lets reported visible time be turned into a last seen time.
+    return (str(hit.session_id), hit.pk, hit.start_time)
+
+
+def _associated_hit_pk(association):
+    if isinstance(association, tuple):
+        return association[1]
+    # Associations cached by older versions hold only the hit's primary key
+    return association
+
+
+def _hit_last_seen(start_time, payload, time):
+    # Scripts in visibility mode report how long the page has been visible, which is
+    # when the visitor was last seen on it; everything else was seen when it arrived.
+    visible_time = payload.get("visibleTime")
+    if (
+        start_time is None
+        or not isinstance(visible_time, (int, float))
+        or isinstance(visible_time, bool)
+        or visible_time < 0
+    ):
+        return time
+    return min(start_time + timezone.timedelta(milliseconds=visible_time), time)
+
+
+def _is_number(value):
+    return (
+        isinstance(value, (int, float))
+        and not isinstance(value, bool)
+        and math.isfinite(value)
+    )
+
+
+def _parse_time(time):
+    # Celery's JSON serializer turns times into ISO 8601 strings. Returns None for
+    # anything that is not a time.
+    if isinstance(time, str):
+        try:
+            time = parse_datetime(time)
+        except ValueError:
+            return None
+    if not isinstance(time, datetime):
+        return None
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time, dt_timezone.utc)
+    return time
+
+
+def _validate_payload(payload):
+    # Payloads come straight from clients. Returns whether the event can be recorded,
+    # normalizing the fields that are merely unusable.
+    if not isinstance(payload, dict):
+        return False
+    for field in ("idempotency", "location", "referrer"):
+        if field in payload and payload[field] is None:
+            # Same as leaving it out
+            del payload[field]
+        elif field in payload and not isinstance(payload[field], str):
+            return False
+    load_time = payload.get("loadTime")
+    if not _is_number(load_time) or load_time <= 0:
+        payload["loadTime"] = None
+    return True
+
+
+class IngestBatch:
+    # A list of events on its way through the pipeline, and what the stages found out
+    # about them
+
+    def __init__(self, events):
+        self.events = events
+        # Heartbeats of hits whose session and hit are both known; they are written
+        # without loading either
+        self.heartbeats = []
+        self.services = {}  # Service uuid -> service configuration
+        self.cached = {}  # Session cache path or idempotency path -> association
+        self.claimed = set()  # Session cache paths this process creates sessions for
+        self.enrichments = {}  # (IP, user agent) -> (device, IP data)
+        # Whether heartbeats were left in the cache for the next flush
+        self.deferred_heartbeats = False
+
+    def __len__(self):
+        return len(self.events) + len(self.heartbeats)
+
+
+class IngestPipeline:
+    # Ingests lists of events in stages (see STAGES), each working on the whole list
+    # so that its queries and cache round trips are shared by every event in it.
+    # Events are processed in order, so a heartbeat can refer to a hit created earlier
+    # in the same list. After each stage, the timing hooks are called with the name of
+    # the stage, how long it took (in seconds) and how many events it was given.
+
+    def __init__(self, enrich_threads=0):
+        self.timing_hooks = []
+        self._enrich_executor = (
+            ThreadPoolExecutor(max_workers=enrich_threads, thread_name_prefix="enrich")
+            if enrich_threads > 0
+            else None
+        )
+
+    def add_timing_hook(self, hook):
+        self.timing_hooks.append(hook)
+
+    def run(self, events):
+        """Ingest a list of events. Returns the batch, as the stages left it."""
+        batch = IngestBatch(list(events))
+        for stage in STAGES:
+            if len(batch) == 0:
+                break
+            count = len(batch)
+            started = _time.perf_counter()
+            getattr(self, stage)(batch)
+            elapsed = _time.perf_counter() - started
+            for hook in self.timing_hooks:
+                hook(stage, elapsed, count)
+        return batch
+
+    def validate(self, batch):
+        for service_uuid in {str(event["service_uuid"]) for event in batch.events}:
+            service = get_service_config(service_uuid)
+            if service is not None and service.is_active:
+                batch.services[service_uuid] = service
+
+        valid = []
+        for event in batch.events:
+            service = batch.services.get(str(event["service_uuid"]))
+            if service is None:
+                log.debug(f"Ignoring event for unknown service {event['service_uuid']}")
+                continue
+            event["time"] = _parse_time(event["time"])
+            if event["time"] is None or not _validate_payload(event["payload"]):
+                log.debug("Ignoring event with an invalid time or payload")
+                continue
+            event["service"] = service
+            valid.append(event)
+        batch.events = valid
+
+    def filter(self, batch):
+        accepted = []
+        for event in batch.events:
+            service = event["service"]
+            if event.get("dnt", False) and service.respect_dnt:
+                log.debug("Ignoring because of DNT or GPC")
+                continue
+            if is_ignored_ip(service, event["ip"]):
+                log.debug("Ignoring because of ignored IP")
+                continue
+            accepted.append(event)
+        batch.events = accepted
+
+    def associate(self, batch):
+        for event in batch.events:
+            event["session_cache_path"] = session_cache_path(
+                event["service"], event["ip"], event["user_agent"]
+            )
+            idempotency = event["payload"].get("idempotency")
+            event["idempotency_path"] = (
+                idempotency_cache_path(idempotency) if idempotency is not None else None
+            )
+
+        # Resolve (and keep alive) every session and hit in a single round trip
+        cached = association_cache.get_many(
+            list(
+                {event["session_cache_path"] for event in batch.events}
+                | {
+                    event["idempotency_path"]
+                    for event in batch.events
+                    if event["idempotency_path"] is not None
+                }
+            ),
+            lambda keys: get_and_touch_many(keys, settings.SESSION_MEMORY_TIMEOUT),
+        )
+
+        # Heartbeats of a known hit only need their counters bumped. The identifier
+        # cannot change, as it was already recorded by the hit's page load.
+        events = []
+        for event in batch.events:
+            session_pk = cached.get(event["session_cache_path"])
+            association = cached.get(event["idempotency_path"])
+            if (
+                session_pk is not None
+                and isinstance(association, tuple)
+                and association[0] == str(session_pk)
+            ):
+                batch.heartbeats.append(event)
+            else:
+                events.append(event)
+        batch.events = events
+
+        batch.claimed, found = _claim_sessions(
+            {
+                event["session_cache_path"]
+                for event in batch.events
+                if event["session_cache_path"] not in cached
+            }
+        )
+        cached.update(found)
+        batch.cached = cached
+
+    def enrich(self, batch):
+        # Only visitors without a session yet need to be enriched
+        visitors = list(
+            {
+                (event["ip"], event["user_agent"])
+                for event in batch.events
+                if event["session_cache_path"] not in batch.cached
+            }
+        )
+        if self._enrich_executor is not None and len(visitors) > 1:
+            enrichments = self._enrich_executor.map(lambda v: _enrich(*v), visitors)
+        else:
+            enrichments = [_enrich(*visitor) for visitor in visitors]
+        batch.enrichments = dict(zip(visitors, enrichments))
+
+    def persist(self, batch):
+        batch.events = self._persist_heartbeats(batch) + batch.events
+        if len(batch.events) > 0:
+            self._persist_events(batch)
+
+    def _persist_heartbeats(self, batch):
+        # Writes the heartbeats of known hits. Returns those whose hit no longer
+        # exists, which are ingested like any other event.
+        if len(batch.heartbeats) == 0:
+            return []
+
+        heartbeats = []  # (Hit pk, session pk, hit last seen, last seen)
+        for event in batch.heartbeats:
+            session_pk, hit_pk, start_time = batch.cached[event["idempotency_path"]]
+            time = event["time"]
+            hit_last_seen = _hit_last_seen(start_time, event["payload"], time)
+            heartbeats.append((hit_pk, session_pk, hit_last_seen, time))
+
+        if settings.HEARTBEAT_FLUSH_INTERVAL > 0:
+            # Defer them (and their sessions' last seen time) to the next flush
+            record_heartbeats(heartbeats)
+            batch.deferred_heartbeats = True
+            return []
+
+        heartbeats = coalesce_heartbeats(heartbeats)
+        if write_heartbeats(heartbeats) == len(heartbeats):
+            return []
+
+        existing = set(
+            Hit.objects.filter(pk__in=list(heartbeats)).values_list("pk", flat=True)
+        )
+        return [
+            event
+            for event in batch.heartbeats
+            if batch.cached[event["idempotency_path"]][1] not in existing
+        ]
+
+    def _persist_events(self, batch):
+        cached, events = batch.cached, batch.events
+        existing_sessions = {
+            str(pk): session
+            for pk, session in Session.objects.in_bulk(
+                [
+                    cached[event["session_cache_path"]]
+                    for event in events
+                    if event["session_cache_path"] in cached
+                ]
+            ).items()
+        }
+        existing_hits = Hit.objects.in_bulk(
+            [
+                _associated_hit_pk(cached[event["idempotency_path"]])
+                for event in events
+                if event["idempotency_path"] in cached
+            ]
+        )
+
+        sessions = {}  # Session cache path -> session
+        hits = {}  # Idempotency path -> hit
+        new_sessions, new_hits = [], []
+        updated_sessions, updated_hits = {}, {}
+
+        for event in events:
+            service, time = event["service"], event["time"]
+            sample_rate = event.get("sample_rate", 1.0)
+            identifier = event.get("identifier", "")
+            session_cache_path = event["session_cache_path"]
+
+            session = sessions.get(session_cache_path)
+            if session is None and session_cache_path in cached:
+                session = existing_sessions.get(str(cached[session_cache_path]))
+                if session is not None and str(session.service_id) != service.pk:
+                    session = None
+            if session is None:
+                initial = True
+                visitor = (event["ip"], event["user_agent"])
+                session_fields = _new_session_fields(
+                    service,
+                    time,
+                    event["ip"],
+                    event["user_agent"],
+                    identifier,
+                    # Sessions that went missing since they were cached were not
+                    # enriched yet
+                    batch.enrichments.get(visitor) or _enrich(*visitor),
+                    sample_rate,
+                )
+                if session_fields is None:
+                    continue
+                session = Session(**session_fields)
+                new_sessions.append(session)
+            else:
+                initial = False
+                session.last_seen = max(session.last_seen, time)
+                if session.identifier == "" and identifier.strip() != "":
+                    session.identifier = identifier.strip()
+                if str(session.pk) in existing_sessions:
+                    updated_sessions[session.pk] = session
+            sessions[session_cache_path] = session
+
+            idempotency_path = event["idempotency_path"]
+            hit = hits.get(idempotency_path)
+            if hit is None and idempotency_path in cached:
+                hit = existing_hits.get(_associated_hit_pk(cached[idempotency_path]))
+            if hit is not None and hit.session_id == session.pk:
+                # This is a heartbeat
+                hit.heartbeats += 1
+                hit.last_seen = max(
+                    hit.last_seen,
+                    _hit_last_seen(hit.start_time, event["payload"], time),
+                )
+                if hit.pk in existing_hits:
+                    updated_hits[hit.pk] = hit
+            else:
+                hit = Hit(
+                    **_new_hit_fields(
+                        service,
+                        session,
+                        initial,
+                        event["tracker"],
+                        time,
+                        event["payload"],
+                        event["location"],
+                        sample_rate,
+                    )
+                )
+                new_hits.append(hit)
+            if idempotency_path is not None:
+                hits[idempotency_path] = hit
+
+        new_hit_counts = Counter(hit.session_id for hit in new_hits)
+        for session in new_sessions:
+            session.hit_count = new_hit_counts[session.pk]
+            session.is_bounce = session.hit_count == 1
+
+        with transaction.atomic():
+            Session.objects.bulk_create(new_sessions)
+            Hit.objects.bulk_create(new_hits)
+            if len(updated_sessions) > 0:
+                # Only save what changed; hit counts may be bumped concurrently
+                Session.objects.bulk_update(
+                    updated_sessions.values(), ["last_seen", "identifier"]
+                )
+            if len(updated_hits) > 0:
+                Hit.objects.bulk_update(
+                    updated_hits.values(), ["heartbeats", "last_seen"]
+                )
+
+            # Count the new hits of older sessions, grouped by how many each received
+            grown_sessions = defaultdict(list)
+            for session_pk, count in new_hit_counts.items():
+                if str(session_pk) in existing_sessions:
+                    grown_sessions[count].append(session_pk)
+            for count, session_pks in grown_sessions.items():
+                Session.add_hits(session_pks, count)
+
+        # Remember (and refresh) every session and hit seen in this batch. New
+        # sessions are only shared now that their first hits are written, so that
+        # other events of the visitor waiting for them don't write alongside us.
+        associations = {path: session.pk for path, session in sessions.items()}
+        associations.update({path: _hit_association(hit) for path, hit in hits.items()})
+        _remember_associations(associations)
+        _release_session_claims(batch.claimed)
+
+        log.debug(
+            f"Ingested {len(events)} events into {len(new_sessions)} new sessions "
+            f"and {len(new_hits)} new hits"
+        )
+
+
+def _timings_key(stage, stat):
+    return f"ingest_stage_{stat}_{stage}"
+
+
+class StageTimings:
+    # A timing hook that adds up how long each stage took in this process, and adds
+    # that to totals in the shared cache every TIMINGS_FLUSH_INTERVAL seconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}  # Stage -> [seconds, events]
+        self._flushed_at = _time.monotonic()
+
+    def __call__(self, stage, seconds, count):
+        log.debug(f"Stage {stage} took {seconds * 1000:.2f}ms for {count} events")
+        with self._lock:
+            totals = self._totals.setdefault(stage, [0, 0])
+            totals[0] += seconds
+            totals[1] += count
+            if _time.monotonic() - self._flushed_at < TIMINGS_FLUSH_INTERVAL:
+                return
+            flushed, self._totals = self._totals, {}
+            self._flushed_at = _time.monotonic()
+        try:
+            for stage, (seconds, count) in flushed.items():
+                incr(_timings_key(stage, "us"), int(seconds * 1_000_000))
+                incr(_timings_key(stage, "events"), count)
+        except Exception as e:
+            log.exception(e)
+
+
+def stage_timings():
+    # Totals reported by every process since the shared cache was last cleared
+    keys = [_timings_key(stage, stat) for stage in STAGES for stat in ("us", "events")]
+    values = cache.get_many(keys)
+    timings = {}
+    for stage in STAGES:
+        events = values.get(_timings_key(stage, "events"), 0)
+        seconds = values.get(_timings_key(stage, "us"), 0) / 1_000_000
+        timings[stage] = {
+            "events": events,
+            "seconds": seconds,
+            "seconds_per_event": seconds / events if events > 0 else 0,
+        }
+    return timings
@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import threading
+import time as _time
+from datetime import datetime
+
+from django.db import close_old_connections
+
+log = logging.getLogger(__name__)
+
+# How long a segment is appended to before it is closed, in seconds. Open segments
+# that were not written to for this long belong to a process that went away, and are
+# replayed too.
+SEGMENT_MAX_AGE = 60
+
+# How many spooled events are ingested at once when replaying
+REPLAY_BATCH_SIZE = 500
+
+# Segments being replayed are touched after every batch. Those that were not touched
+# for this long, in seconds, belong to a replay that was killed, and are replayed again.
+REPLAY_LEASE = 600
+
+
+def _serialize(event):
+    return json.dumps(dict(event, time=event["time"].isoformat()), default=str)
+
+
+def _deserialize(line):
+    event = json.loads(line)
+    event["time"] = datetime.fromisoformat(event["time"])
+    return event
+
+
+class Spool:
+    # An append-only log of ingress events on local disk, for when they can't be
+    # handed to the broker or written to the database. Events are appended to segment
+    # files (`*.open`) that are closed (renamed to `*.jsonl`) once they grow too large
+    # or too old, or when the spool is replayed; closed segments are replayed in order
+    # and deleted afterwards.
+    #
+    # Batches that fail to replay with one of the `retryable` errors stay in the spool
+    # for the next replay. Any other failure would happen again every time, so those
+    # batches are set aside in `*.failed` files for an operator to look at (renaming
+    # one to `*.jsonl` replays it again).
+
+    def __init__(self, directory, segment_size, retryable=()):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retryable = retryable
+        self._lock = threading.Lock()
+        self._file = None
+        self._opened_at = None
+        self._sequence = 0
+        self._replaying = threading.Lock()
+        self._last_check = 0
+
+    @property
+    def enabled(self):
+        return self.directory != ""
+
+    def append(self, event):
+        with self._lock:
+            if self._file is not None and (
+                self._file.tell() >= self.segment_size
+                or _time.time() - self._opened_at >= SEGMENT_MAX_AGE
+            ):
+                self._close_segment()
+            if self._file is None:
+                self._open_segment()
+            self._file.write(_serialize(event) + "\n")
+            # Hand the line to the OS, so it survives this process crashing
+            self._file.flush()
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._sequence += 1
+        name = f"{_time.time_ns():020d}-{os.getpid()}-{self._sequence}"
+        self._file = open(
+            os.path.join(self.directory, f"{name}.open"), "a", encoding="utf-8"
+        )
+        self._opened_at = _time.time()
+
+    def _close_segment(self):
+        path = self._file.name
+        self._file.close()
+        self._file = None
+        try:
+            os.rename(path, path[: -len(".open")] + ".jsonl")
+        except FileNotFoundError:
+            # Already claimed as abandoned by a replay
+            pass
+
+    def _claimable_segments(self):
+        # Closed segments, plus open ones that nobody appended to for too long and
+        # those whose replay was interrupted
+        segments = []
+        if not os.path.isdir(self.directory):
+            return segments
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".jsonl"):
+                    segments.append(entry.path)
+                elif (
+                    entry.name.endswith(".open")
+                    and (self._file is None or entry.path != self._file.name)
+                    and _time.time() - entry.stat().st_mtime > SEGMENT_MAX_AGE
+                ):
+                    segments.append(entry.path)
+                elif (
+                    entry.name.endswith(".replaying")
+                    and _time.time() - entry.stat().st_mtime > REPLAY_LEASE
+                ):
+                    segments.append(entry.path)
+        # Segment names start with their creation time
+        return sorted(segments, key=os.path.basename)
+
+    def has_pending(self, interval):
+        """Check, at most once every `interval` seconds, whether anything awaits replay."""
+        if not self.enabled or _time.time() - self._last_check < interval:
+            return False
+        self._last_check = _time.time()
+        return self._file is not None or len(self._claimable_segments()) > 0
+
+    def replay(self, ingest):
+        """Ingest every closed segment, oldest first. Returns the number of events."""
+        if not self._replaying.acquire(blocking=False):
+            return 0
+        try:
+            # Include what this process spooled last; appending again opens a new one
+            with self._lock:
+                if self._file is not None:
+                    self._close_segment()
+            replayed = 0
+            for path in self._claimable_segments():
+                replayed += self._replay_segment(path, ingest)
+            return replayed
+        finally:
+            self._replaying.release()
+
+    def _replay_segment(self, path, ingest):
+        # Claim the segment, so that no other process replays it as well. An abandoned
+        # replay is claimed by renaming it first, as only one process can do that.
+        base = os.path.splitext(path)[0]
+        claimed = base + ".replaying"
+        try:
+            if path == claimed:
+                path = base + ".jsonl"
+                os.rename(claimed, path)
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return 0
+        # Start the lease; renaming a file leaves its modification time alone
+        os.utime(claimed)
+
+        events = []
+        with open(claimed, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    events.append(_deserialize(line))
+                except ValueError:
+                    # The end of a line written while its process was killed
+                    log.warning(f"Skipping unreadable line in {path}")
+
+        replayed = 0
+        done = 0
+        try:
+            for i in range(0, len(events), REPLAY_BATCH_SIZE):
+                batch = events[i : i + REPLAY_BATCH_SIZE]
+                try:
+                    # Ingestion annotates events; keep the originals for a retry
+                    ingest([dict(event) for event in batch])
+                    replayed += len(batch)
+                except self.retryable:
+                    raise
+                except Exception as e:
+                    log.exception(e)
+                    self._quarantine(base + ".failed", batch)
+                done += len(batch)
+                os.utime(claimed)
+        except Exception:
+            # Keep what was not ingested for the next replay
+            with open(claimed, "w", encoding="utf-8") as f:
+                f.writelines(_serialize(event) + "\n" for event in events[done:])
+            os.rename(claimed, base + ".jsonl")
+            raise
+        os.remove(claimed)
+        log.info(f"Replayed {replayed} spooled events from {path}")
+        return replayed
+
+    def _quarantine(self, path, events):
+        with open(path, "a", encoding="utf-8") as f:
+            f.writelines(_serialize(event) + "\n" for event in events)
+        log.error(
+            f"Set {len(events)} spooled events that failed to replay aside in {path}"
+        )
+
+    def replay_in_background(self, ingest):
+        def run():
+            try:
+                self.replay(ingest)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                close_old_connections()
+
+        threading.Thread(target=run, name="shynet-spool-replay", daemon=True).start()
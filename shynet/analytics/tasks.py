@@ -1,51 +1,136 @@
-import ipaddress
 import logging
-from hashlib import sha256
+import sqlite3
+import threading
+import time as _time
+from concurrent.futures import ThreadPoolExecutor
 
-import geoip2.database
-import user_agents
 from celery import shared_task
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Q
-from django.utils import timezone
+from django.db import InterfaceError as DatabaseInterfaceError
+from django.db import OperationalError as DatabaseOperationalError
+from django.db import close_old_connections
+from kombu.exceptions import OperationalError as BrokerError
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
 
-from core.models import Service
+from core.cache import incr
 
-from .models import Hit, Session
+from . import backpressure
+from .buffer import CacheBuffer
+from .heartbeats import flush_heartbeats
+from .pipeline import (
+    IngestPipeline,
+    StageTimings,
+    idempotency_cache_path,
+    is_ignored_ip,
+    session_cache_path,
+)
+from .spool import Spool
+from .writer import BackgroundWriter
 
 log = logging.getLogger(__name__)
 
-_geoip2_city_reader = None
-_geoip2_asn_reader = None
+ingress_buffer = CacheBuffer("ingress_buffer")
 
+HEARTBEAT_FLUSH_SCHEDULED_KEY = "heartbeat_flush_scheduled"
+# How many heartbeats are flushed per round trip to the cache
+HEARTBEAT_FLUSH_LIMIT = 1000
 
-def _geoip2_lookup(ip):
-    global _geoip2_city_reader, _geoip2_asn_reader  # TODO: is there a better way to do global Django vars? Is this thread safe?
-    try:
-        if settings.MAXMIND_CITY_DB == None or settings.MAXMIND_ASN_DB == None:
-            return None
-        if _geoip2_city_reader == None or _geoip2_asn_reader == None:
-            _geoip2_city_reader = geoip2.database.Reader(settings.MAXMIND_CITY_DB)
-            _geoip2_asn_reader = geoip2.database.Reader(settings.MAXMIND_ASN_DB)
-        city_results = _geoip2_city_reader.city(ip)
-        asn_results = _geoip2_asn_reader.asn(ip)
-        return {
-            "asn": asn_results.autonomous_system_organization,
-            "country": city_results.country.iso_code,
-            "longitude": city_results.location.longitude,
-            "latitude": city_results.location.latitude,
-            "time_zone": city_results.location.time_zone,
-        }
-    except geoip2.errors.AddressNotFoundError:
-        return {}
-    except FileNotFoundError as e:
-        log.exception("Unable to perform GeoIP lookup: %s", e)
-        return {}
+# Failures to reach the broker, cache or database, after which events are spooled to
+# disk (or kept buffered) to be retried. Anything else, such as an integrity error,
+# would fail again every time.
+UNAVAILABLE_ERRORS = (
+    DatabaseOperationalError,
+    DatabaseInterfaceError,
+    BrokerError,
+    RedisConnectionError,
+    RedisTimeoutError,
+    sqlite3.OperationalError,  # Of the SQLite cache
+    OSError,
+)
 
+ingress_spool = Spool(
+    settings.INGRESS_SPOOL_DIRECTORY,
+    settings.INGRESS_SPOOL_SEGMENT_SIZE,
+    retryable=UNAVAILABLE_ERRORS,
+)
+# How often each process checks the spool for events to replay, in seconds
+SPOOL_REPLAY_INTERVAL = 30
 
-@shared_task
-def ingress_request(
+# Every event is ingested through this pipeline
+ingest_pipeline = IngestPipeline(enrich_threads=settings.INGRESS_ENRICH_THREADS)
+ingest_pipeline.add_timing_hook(StageTimings())
+
+# Threads that enqueue events on behalf of the async tracking views, so that the
+# event loop never waits for the broker (or, without one, for ingestion itself)
+_ingress_executor = ThreadPoolExecutor(
+    max_workers=settings.ASYNC_INGRESS_THREADS, thread_name_prefix="ingress"
+)
+# Requests waiting for those threads. Bounded, so that a slow or unavailable broker
+# can't pile them up in memory.
+_ingress_backlog = threading.BoundedSemaphore(settings.ASYNC_INGRESS_BACKLOG)
+
+
+# Why events can be dropped before they are enqueued
+DROP_REASONS = (
+    "inactive",
+    "dnt",
+    "ignored_ip",
+    "shed_heartbeat",
+    "sampled_out",
+    "backlog_full",
+)
+
+
+def _drop_count_key(reason):
+    return f"ingress_dropped_{reason}"
+
+
+def ingress_drop_reason(service, dnt, ip):
+    # Returns why the service would not record an event, if it wouldn't
+    if not service.is_active:
+        return "inactive"
+    if dnt and service.respect_dnt:
+        return "dnt"
+    if is_ignored_ip(service, ip):
+        return "ignored_ip"
+    return None
+
+
+def ingress_shed_reason(service, event):
+    # Returns why an event should be dropped to sample the service or relieve
+    # backpressure, if it should. Events that are kept are tagged with the rate their
+    # session was sampled at.
+    idempotency = event["payload"].get("idempotency")
+    if (
+        idempotency is not None
+        and backpressure.is_enabled()
+        and backpressure.should_shed_heartbeats()
+        and cache.has_key(idempotency_cache_path(idempotency))
+    ):
+        # Page loads matter more than how long they were looked at
+        return "shed_heartbeat"
+    sample_rate = service.sample_rate * backpressure.sample_rate()
+    if sample_rate >= 1:
+        return None
+    association = session_cache_path(service, event["ip"], event["user_agent"])
+    if not backpressure.is_sampled(association, sample_rate):
+        return "sampled_out"
+    event["sample_rate"] = sample_rate
+    return None
+
+
+def count_dropped_ingress(reason, count=1):
+    incr(_drop_count_key(reason), count)
+
+
+def dropped_ingress_counts():
+    counts = cache.get_many([_drop_count_key(reason) for reason in DROP_REASONS])
+    return {reason: counts.get(_drop_count_key(reason), 0) for reason in DROP_REASONS}
+
+
+def enqueue_ingress(
     service_uuid,
     tracker,
     time,
@@ -55,152 +140,237 @@ def ingress_request(
     user_agent,
     dnt=False,
     identifier="",
+    sample_rate=1.0,
 ):
-    try:
-        service = Service.objects.get(pk=service_uuid, status=Service.ACTIVE)
-        log.debug(f"Linked to service {service}")
+    enqueue_ingress_many(
+        [
+            dict(
+                service_uuid=service_uuid,
+                tracker=tracker,
+                time=time,
+                payload=payload,
+                ip=ip,
+                location=location,
+                user_agent=user_agent,
+                dnt=dnt,
+                identifier=identifier,
+                sample_rate=sample_rate,
+            )
+        ]
+    )
 
-        if dnt and service.respect_dnt:
-            log.debug("Ignoring because of DNT or GPC")
-            return
 
-        try:
-            remote_ip = ipaddress.ip_network(ip)
-            for ignored_network in service.get_ignored_networks():
-                if (
-                    ignored_network.version == remote_ip.version
-                    and ignored_network.supernet_of(remote_ip)
-                ):
-                    log.debug("Ignoring because of ignored IP")
-                    return
-        except ValueError as e:
-            log.exception(e)
-
-        # Validate payload
-        if payload.get("loadTime", 1) <= 0:
-            payload["loadTime"] = None
-
-        association_id_hash = sha256()
-        association_id_hash.update(str(ip).encode("utf-8"))
-        association_id_hash.update(str(user_agent).encode("utf-8"))
-        if settings.AGGRESSIVE_HASH_SALTING:
-            association_id_hash.update(str(service.pk).encode("utf-8"))
-            association_id_hash.update(
-                str(timezone.now().date().isoformat()).encode("utf-8")
-            )
-        session_cache_path = (
-            f"session_association_{service.pk}_{association_id_hash.hexdigest()}"
+def _mark_enqueued(events):
+    # Ingestion measures its lag from when events were enqueued
+    enqueued_at = _time.time()
+    for event in events:
+        event.setdefault("enqueued_at", enqueued_at)
+    backpressure.mark_enqueued()
+
+
+def _spool(events):
+    for event in events:
+        # Replayed events say nothing about how far behind ingestion is
+        ingress_spool.append(
+            {key: value for key, value in event.items() if key != "enqueued_at"}
         )
 
-        # Create or update session
-        session = None
-        if cache.get(session_cache_path) is not None:
-            cache.touch(session_cache_path, settings.SESSION_MEMORY_TIMEOUT)
-            session = Session.objects.filter(
-                pk=cache.get(session_cache_path), service=service
-            ).first()
-        if session is None:
-            initial = True
-
-            log.debug("Cannot link to existing session; creating a new one...")
-
-            ip_data = _geoip2_lookup(ip)
-            log.debug(f"Found geoip2 data...")
-
-            ua = user_agents.parse(user_agent)
-            device_type = "OTHER"
-            if (
-                ua.is_bot
-                or (ua.browser.family or "").strip().lower() == "googlebot"
-                or (ua.device.family or ua.device.model or "").strip().lower()
-                == "spider"
-            ):
-                device_type = "ROBOT"
-            elif ua.is_mobile:
-                device_type = "PHONE"
-            elif ua.is_tablet:
-                device_type = "TABLET"
-            elif ua.is_pc:
-                device_type = "DESKTOP"
-            if device_type == "ROBOT" and service.ignore_robots:
-                return
-            session = Session.objects.create(
-                service=service,
-                ip=ip if service.collect_ips and not settings.BLOCK_ALL_IPS else None,
-                user_agent=user_agent,
-                identifier=identifier.strip(),
-                browser=ua.browser.family or "",
-                device=ua.device.family or ua.device.model or "",
-                device_type=device_type,
-                start_time=time,
-                last_seen=time,
-                os=ua.os.family or "",
-                asn=ip_data.get("asn") or "",
-                country=ip_data.get("country") or "",
-                longitude=ip_data.get("longitude"),
-                latitude=ip_data.get("latitude"),
-                time_zone=ip_data.get("time_zone") or "",
-            )
-            cache.set(
-                session_cache_path, session.pk, timeout=settings.SESSION_MEMORY_TIMEOUT
-            )
+
+def enqueue_ingress_many(events):
+    # Hands events (with the arguments of enqueue_ingress) over for ingestion at once
+    _mark_enqueued(events)
+    if not ingress_spool.enabled:
+        _dispatch_ingress(events)
+        return
+
+    try:
+        _dispatch_ingress(events)
+    except UNAVAILABLE_ERRORS as e:
+        log.warning(f"Spooling {len(events)} events to disk: {e!r}")
+        _spool(events)
+        return
+    if ingress_spool.has_pending(SPOOL_REPLAY_INTERVAL):
+        # Whatever failed before seems to work again
+        ingress_spool.replay_in_background(ingest_events)
+
+
+def _dispatch_ingress(events):
+    if settings.CELERY_TASK_ALWAYS_EAGER and settings.BACKGROUND_WRITER_QUEUE_SIZE > 0:
+        # Without a broker, write the events from this process' writer thread
+        events = [event for event in events if not background_writer.submit(event)]
+        if len(events) == 0:
+            return
+        log.warning("Background writer queue is full; ingesting inline")
+
+    if settings.INGRESS_BATCH_SIZE <= 0:
+        if len(events) == 1:
+            result = ingress_request.delay(**events[0])
         else:
-            initial = False
-
-            log.debug("Updating old session with new data...")
-
-            # Update last seen time
-            session.last_seen = time
-            if session.identifier == "" and identifier.strip() != "":
-                session.identifier = identifier.strip()
-            session.save()
-
-        # Create or update hit
-        idempotency = payload.get("idempotency")
-        idempotency_path = f"hit_idempotency_{idempotency}"
-        hit = None
-
-        if idempotency is not None:
-            if cache.get(idempotency_path) is not None:
-                cache.touch(idempotency_path, settings.SESSION_MEMORY_TIMEOUT)
-                hit = Hit.objects.filter(
-                    pk=cache.get(idempotency_path), session=session
-                ).first()
-                if hit is not None:
-                    # There is an existing hit with an identical idempotency key. That means
-                    # this is a heartbeat.
-                    log.debug("Hit is a heartbeat; updating old hit with new data...")
-                    hit.heartbeats += 1
-                    hit.last_seen = time
-                    hit.save()
-
-        if hit is None:
-            log.debug("Hit is a page load; creating new hit...")
-            # There is no existing hit; create a new one
-            hit = Hit.objects.create(
-                session=session,
-                initial=initial,
+            result = ingress_events.delay(events)
+        if (
+            settings.CELERY_TASK_ALWAYS_EAGER
+            and ingress_spool.enabled
+            and result.failed()
+            and isinstance(result.result, UNAVAILABLE_ERRORS)
+        ):
+            # Ingested inline, and failed; give the spool a chance
+            raise result.result
+        return
+
+    for event in events:
+        position = ingress_buffer.push(event)
+        if position % settings.INGRESS_BATCH_SIZE == 0:
+            # A full batch is waiting
+            ingress_batch.delay()
+        elif position % settings.INGRESS_BATCH_SIZE == 1:
+            # Make sure this batch is written even if it never fills up
+            ingress_batch.apply_async(countdown=settings.INGRESS_BATCH_TIMEOUT)
+
+
+def _enqueue_ingress_in_thread(events):
+    try:
+        enqueue_ingress_many(events)
+    except Exception as e:
+        log.exception(e)
+    finally:
+        _ingress_backlog.release()
+        # These threads never see request_finished, which normally takes care of this
+        close_old_connections()
+
+
+def enqueue_ingress_nowait(events):
+    # Same as enqueue_ingress_many, but hands the events to a thread and returns
+    # immediately, without any I/O, so that it can run on an event loop. Returns False
+    # when too many requests are waiting already; the events must then be passed to
+    # ingress_backlog_full (which does I/O).
+    enqueued_at = _time.time()
+    for event in events:
+        event.setdefault("enqueued_at", enqueued_at)
+    if not _ingress_backlog.acquire(blocking=False):
+        return False
+    _ingress_executor.submit(_enqueue_ingress_in_thread, events)
+    return True
+
+
+def ingress_backlog_full(events):
+    # Spools the events that enqueue_ingress_nowait could not hand over to disk (or
+    # drops them, without a spool)
+    if ingress_spool.enabled:
+        log.warning(f"Ingress backlog is full; spooling {len(events)} events")
+        _spool(events)
+    else:
+        count_dropped_ingress("backlog_full", len(events))
+
+
+@shared_task
+def ingress_request(
+    service_uuid,
+    tracker,
+    time,
+    payload,
+    ip,
+    location,
+    user_agent,
+    dnt=False,
+    identifier="",
+    sample_rate=1.0,
+    enqueued_at=None,
+):
+    ingest_events(
+        [
+            dict(
+                service_uuid=service_uuid,
                 tracker=tracker,
-                # At first, location is given by the HTTP referrer. Some browsers
-                # will send the source of the script, however, so we allow JS payloads
-                # to include the location.
-                location=payload.get("location", location),
-                referrer=payload.get("referrer", ""),
-                load_time=payload.get("loadTime"),
-                start_time=time,
-                last_seen=time,
-                service=service,
+                time=time,
+                payload=payload,
+                ip=ip,
+                location=location,
+                user_agent=user_agent,
+                dnt=dnt,
+                identifier=identifier,
+                sample_rate=sample_rate,
+                enqueued_at=enqueued_at,
             )
+        ]
+    )
+
+
+def _schedule_heartbeat_flush():
+    if cache.add(
+        HEARTBEAT_FLUSH_SCHEDULED_KEY, 1, timeout=settings.HEARTBEAT_FLUSH_INTERVAL
+    ):
+        flush_pending_heartbeats.apply_async(
+            countdown=settings.HEARTBEAT_FLUSH_INTERVAL
+        )
 
-            # Recalculate whether the session is a bounce
-            session.recalculate_bounce()
 
-            # Set idempotency (if applicable)
-            if idempotency is not None:
-                cache.set(
-                    idempotency_path, hit.pk, timeout=settings.SESSION_MEMORY_TIMEOUT
-                )
+@shared_task
+def flush_pending_heartbeats():
+    # Anything recorded from now on needs another flush
+    cache.delete(HEARTBEAT_FLUSH_SCHEDULED_KEY)
+    try:
+        flushed = flush_heartbeats(HEARTBEAT_FLUSH_LIMIT)
+        while flushed > 0:
+            log.debug(f"Flushed heartbeats of {flushed} hits")
+            flushed = flush_heartbeats(HEARTBEAT_FLUSH_LIMIT)
     except Exception as e:
         log.exception(e)
-        print(e)
         raise e
+
+
+@shared_task
+def ingress_events(events):
+    # Events that arrived together, such as a batch sent by the tracking script
+    ingest_events(events)
+
+
+@shared_task
+def ingress_batch():
+    # The events stay in the buffer until they are written, so that they are retried
+    # by the next batch if the database is unavailable
+    with ingress_buffer.drain(settings.INGRESS_BATCH_SIZE) as events:
+        if len(events) == 0:
+            return
+        try:
+            ingest_events(events)
+        except UNAVAILABLE_ERRORS:
+            raise
+        except Exception:
+            # They would fail every time; ingest_events already logged why
+            log.error(f"Dropping a batch of {len(events)} events that failed to ingest")
+
+
+def ingest_events(events):
+    # Writes a list of events with a fixed number of queries, however long the list
+    try:
+        enqueued_at = [
+            event["enqueued_at"]
+            for event in events
+            if event.get("enqueued_at") is not None
+        ]
+        if len(enqueued_at) > 0:
+            backpressure.report_lag(min(enqueued_at))
+        batch = ingest_pipeline.run(events)
+        if batch.deferred_heartbeats:
+            _schedule_heartbeat_flush()
+    except Exception as e:
+        log.exception(e)
+        raise e
+
+
+def _ingest_or_spool(events):
+    # Writes a batch for the background writer; keeps it on disk if that fails
+    try:
+        ingest_events([dict(event) for event in events])
+    except UNAVAILABLE_ERRORS:
+        if not ingress_spool.enabled:
+            raise
+        log.warning(f"Spooling {len(events)} events to disk")
+        _spool(events)
+
+
+background_writer = BackgroundWriter(
+    _ingest_or_spool,
+    max_size=settings.BACKGROUND_WRITER_QUEUE_SIZE,
+    batch_size=settings.BACKGROUND_WRITER_BATCH_SIZE,
+)
@@ -12,29 +12,137 @@ var Shynet = {
 {% else %}
 var Shynet = {
   dnt: false,
+  endpoint: "{{protocol}}://{{request.site.domain|default:request.get_host}}{{endpoint}}",
   idempotency: null,
   heartbeatTaskId: null,
-  skipHeartbeat: false,
-  sendHeartbeat: function () {
+  // Events waiting to be sent. Heartbeats are sent in batches of batchSize; page
+  // loads, and whatever is waiting when the page is hidden or left, right away.
+  queue: [],
+  batchSize: parseInt("{{heartbeat_batch_size}}"),
+  // In visibility mode, how long the current page was visible (in milliseconds) is
+  // added up locally and reported, instead of sending heartbeats the whole time.
+  visibilityMode: "{{tracking_mode}}" === "visibility",
+  visibleTime: 0,
+  visibleSince: null,
+  newEvent: function () {
+    var event = {
+      idempotency: Shynet.idempotency,
+      referrer: document.referrer,
+      location: window.location.href,
+      loadTime:
+        window.performance.timing.domContentLoadedEventEnd -
+        window.performance.timing.navigationStart,
+      createdAt: Date.now(),
+    };
+    if (Shynet.visibilityMode) {
+      event.visibleTime = Shynet.currentVisibleTime();
+    }
+    return event;
+  },
+  currentVisibleTime: function () {
+    if (Shynet.visibleSince == null) {
+      return Shynet.visibleTime;
+    }
+    return Shynet.visibleTime + (Date.now() - Shynet.visibleSince);
+  },
+  flush: function () {
     try {
-      if (document.hidden || Shynet.skipHeartbeat) {
+      if (Shynet.queue.length === 0) {
+        return;
+      }
+      var now = Date.now();
+      var events = Shynet.queue.map(function (event) {
+        return {
+          idempotency: event.idempotency,
+          referrer: event.referrer,
+          location: event.location,
+          loadTime: event.loadTime,
+          visibleTime: event.visibleTime,
+          // How long ago the event happened, in milliseconds
+          age: now - event.createdAt,
+        };
+      });
+      Shynet.queue = [];
+      var body = JSON.stringify(events);
+      // Beacons are sent as text/plain, so they need no CORS preflight, and are
+      // delivered even if the page is being unloaded.
+      if (navigator.sendBeacon && navigator.sendBeacon(Shynet.endpoint, body)) {
         return;
       }
-      Shynet.idempotency = Math.random().toString(36).substring(2, 15) + Math.random().toString(36).substring(2, 15);
-      Shynet.skipHeartbeat = false;
+      var xhr = new XMLHttpRequest();
+      xhr.open("POST", Shynet.endpoint, true);
+      xhr.setRequestHeader("Content-Type", "application/json");
+      xhr.send(body);
+    } catch (e) {}
+  },
+  sendHeartbeat: function () {
+    if (document.hidden) {
+      return;
+    }
+    Shynet.queue.push(Shynet.newEvent());
+    if (Shynet.queue.length >= Shynet.batchSize) {
+      Shynet.flush();
+    }
+  },
+  sendKeepalive: function () {
+    if (document.hidden) {
+      return;
+    }
+    Shynet.queue.push(Shynet.newEvent());
+    Shynet.flush();
+  },
+  reportVisibleTime: function () {
+    // Only report if the page was visible since the last report
+    if (Shynet.idempotency == null || Shynet.visibleSince == null) {
+      return;
+    }
+    Shynet.queue.push(Shynet.newEvent());
+    Shynet.visibleTime = Shynet.currentVisibleTime();
+    Shynet.visibleSince = null;
+  },
+  newPageLoad: function () {
+    if (Shynet.heartbeatTaskId != null) {
+      clearInterval(Shynet.heartbeatTaskId);
+    }
+    if (Shynet.visibilityMode) {
+      // Report how long the previous page was visible before moving on
+      Shynet.reportVisibleTime();
+      Shynet.visibleTime = 0;
+      Shynet.visibleSince = document.hidden ? null : Date.now();
+    }
+    Shynet.idempotency = Math.random().toString(36).substring(2, 15) + Math.random().toString(36).substring(2, 15);
+    if (Shynet.visibilityMode) {
+      Shynet.heartbeatTaskId = setInterval(Shynet.sendKeepalive, parseInt("{{keepalive_frequency}}"));
+    } else {
       Shynet.heartbeatTaskId = setInterval(Shynet.sendHeartbeat, parseInt("{{heartbeat_frequency}}"));
-      Shynet.sendHeartbeat();
     }
-  };
+    Shynet.queue.push(Shynet.newEvent());
+    Shynet.flush();
+  },
+  onHidden: function () {
+    if (Shynet.visibilityMode) {
+      Shynet.reportVisibleTime();
+    }
+    Shynet.flush();
+  }
+};
 
-  window.addEventListener("load", Shynet.newPageLoad);
+window.addEventListener("load", Shynet.newPageLoad);
+document.addEventListener("visibilitychange", function () {
+  if (document.visibilityState === "hidden") {
+    Shynet.onHidden();
+  } else if (Shynet.visibilityMode && Shynet.visibleSince == null) {
+    Shynet.visibleSince = Date.now();
+  }
+});
+window.addEventListener("pagehide", Shynet.onHidden);
 {% endif %}
 
 
 {% if script_inject %}
 // The following is script is not part of Shynet, and was instead
 // provided by this site's administrator.
-// 
+//
 // -- START --
 {{script_inject|safe}}
 // -- END --
@@ -0,0 +1,149 @@
+import json
+import tempfile
+import threading
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import AsyncRequestFactory, TestCase
+from django.utils import timezone
+
+from analytics import tasks
+from analytics.spool import Spool
+from analytics.views.ingress import AsyncPixelView, AsyncScriptView
+from core.factories import ServiceFactory, UserFactory
+
+
+class AsyncIngressViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+        self.factory = AsyncRequestFactory()
+
+    async def tests_pixel_enqueues_without_waiting(self):
+        """
+        GIVEN: The async pixel view
+        WHEN: The pixel is requested
+        THEN: The event is handed over without being processed inline
+        """
+        request = self.factory.get("/", headers={"User-Agent": "Mozilla/5.0"})
+
+        with mock.patch("analytics.views.ingress.enqueue_ingress_nowait") as enqueue:
+            resp = await AsyncPixelView.as_view()(
+                request, service_uuid=str(self.service.uuid)
+            )
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Content-Type"], "image/gif")
+        [event] = enqueue.call_args.args[0]
+        self.assertEqual(event["tracker"], "PIXEL")
+        self.assertEqual(event["user_agent"], "Mozilla/5.0")
+
+    async def tests_script_post_enqueues_payload(self):
+        """
+        GIVEN: The async script view
+        WHEN: The script posts a page view
+        THEN: The payload is handed over without being processed inline
+        """
+        request = self.factory.post(
+            "/",
+            data=json.dumps({"idempotency": "abc"}),
+            content_type="application/json",
+        )
+
+        with mock.patch("analytics.views.ingress.enqueue_ingress_nowait") as enqueue:
+            resp = await AsyncScriptView.as_view()(
+                request, service_uuid=str(self.service.uuid)
+            )
+
+        self.assertEqual(resp.status_code, 200)
+        [event] = enqueue.call_args.args[0]
+        self.assertEqual(event["payload"], {"idempotency": "abc"})
+        self.assertEqual(event["tracker"], "JS")
+
+    async def tests_script_get(self):
+        """
+        GIVEN: The async script view
+        WHEN: The script is requested twice
+        THEN: The same cached script is served both times
+        """
+        view = AsyncScriptView.as_view()
+
+        first = await view(self.factory.get("/"), service_uuid=str(self.service.uuid))
+        second = await view(self.factory.get("/"), service_uuid=str(self.service.uuid))
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first["ETag"], second["ETag"])
+        self.assertIn(b"var Shynet", second.content)
+
+
+class IngressBacklogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        # Threads that never get to the requests handed to them
+        for name, value in [
+            ("_ingress_backlog", threading.BoundedSemaphore(1)),
+            ("_ingress_executor", mock.Mock()),
+        ]:
+            patcher = mock.patch.object(tasks, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def event(self, idempotency):
+        return dict(
+            service_uuid="service",
+            tracker="JS",
+            time=timezone.now(),
+            payload={"idempotency": idempotency},
+            ip="203.0.113.1",
+            location="",
+            user_agent="Mozilla/5.0",
+        )
+
+    def enqueue(self, events):
+        # As the async views do
+        if not tasks.enqueue_ingress_nowait(events):
+            tasks.ingress_backlog_full(events)
+
+    def tests_hands_over_without_io(self):
+        """
+        GIVEN: Room in the backlog of requests for the ingress threads
+        WHEN: A request's events are handed over
+        THEN: Nothing but the hand-over happens on the calling thread
+        """
+        with mock.patch.object(tasks.backpressure, "mark_enqueued") as mark_enqueued:
+            self.assertTrue(tasks.enqueue_ingress_nowait([self.event("first")]))
+
+        mark_enqueued.assert_not_called()
+        tasks._ingress_executor.submit.assert_called_once()
+
+    def tests_full_backlog_drops(self):
+        """
+        GIVEN: A full backlog of requests for the ingress threads, and no spool
+        WHEN: Another request's events are handed over
+        THEN: They are dropped and counted
+        """
+        self.enqueue([self.event("first")])
+        self.enqueue([self.event("second"), self.event("third")])
+
+        self.assertEqual(tasks._ingress_executor.submit.call_count, 1)
+        self.assertEqual(tasks.dropped_ingress_counts()["backlog_full"], 2)
+
+    def tests_full_backlog_spools(self):
+        """
+        GIVEN: A full backlog of requests for the ingress threads, and a spool
+        WHEN: Another request's events are handed over
+        THEN: They are spooled to disk, to be replayed later
+        """
+        spool = Spool(self.directory.name, segment_size=1024)
+        with mock.patch.object(tasks, "ingress_spool", spool), self.assertLogs(
+            "analytics.tasks", level="WARNING"
+        ):
+            self.enqueue([self.event("first")])
+            self.enqueue([self.event("second")])
+
+        replayed = []
+        spool.replay(replayed.extend)
+        self.assertEqual([e["payload"]["idempotency"] for e in replayed], ["second"])
+        self.assertEqual(tasks.dropped_ingress_counts()["backlog_full"], 0)
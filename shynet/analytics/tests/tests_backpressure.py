@@ -0,0 +1,187 @@
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from analytics import backpressure
+from analytics.models import Hit, Session
+from analytics.tasks import dropped_ingress_counts, enqueue_ingress, ingest_events
+from core.factories import ServiceFactory, UserFactory
+
+
+@override_settings(INGRESS_SHED_HEARTBEATS_LAG=10, INGRESS_SAMPLE_LAG=60)
+class BackpressureTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+        self.url = reverse(
+            "ingress:endpoint_script", kwargs={"service_uuid": self.service.uuid}
+        )
+
+    def post(self, idempotency, ip="203.0.113.1"):
+        return self.client.post(
+            self.url,
+            data={"idempotency": idempotency, "location": "https://example.com/"},
+            content_type="application/json",
+            REMOTE_ADDR=ip,
+        )
+
+    def tests_sample_rate(self):
+        """
+        GIVEN: Ingestion falling further and further behind
+        WHEN: The sample rate is computed
+        THEN: It drops in proportion, but never below the minimum
+        """
+        for lag, rate in [(0, 1.0), (59, 1.0), (60, 1.0), (240, 0.25), (10**6, 0.01)]:
+            with mock.patch.object(backpressure, "current_lag", return_value=lag):
+                self.assertEqual(backpressure.sample_rate(), rate)
+
+    def tests_sampling_is_deterministic(self):
+        """
+        GIVEN: Many visitors and a sample rate
+        WHEN: Each visitor is sampled twice
+        THEN: They get the same answer both times, and about the right share is kept
+        """
+        associations = [f"visitor-{i}" for i in range(2000)]
+
+        first = [backpressure.is_sampled(a, 0.25) for a in associations]
+        second = [backpressure.is_sampled(a, 0.25) for a in associations]
+
+        self.assertEqual(first, second)
+        self.assertAlmostEqual(sum(first) / len(first), 0.25, delta=0.05)
+
+    def tests_heartbeats_are_shed_first(self):
+        """
+        GIVEN: Ingestion that fell behind, but not enough to sample
+        WHEN: A page load and its heartbeat arrive
+        THEN: The page load is recorded, and the heartbeat dropped
+        """
+        with mock.patch.object(backpressure, "current_lag", return_value=30):
+            self.post("page")
+            self.post("page")
+
+        self.assertEqual(Session.objects.get().hit_set.get().heartbeats, 0)
+        self.assertEqual(dropped_ingress_counts()["shed_heartbeat"], 1)
+
+    def tests_sampled_counts_are_scaled(self):
+        """
+        GIVEN: Ingestion that fell far behind
+        WHEN: Many visitors arrive
+        THEN: Only some are recorded, but the dashboard counts make up for it
+        """
+        visitors = 200
+        with mock.patch.object(backpressure, "current_lag", return_value=240):
+            for i in range(visitors):
+                self.post(f"page-{i}", ip=f"203.0.113.{i}")
+
+        recorded = Session.objects.count()
+        self.assertEqual(recorded + dropped_ingress_counts()["sampled_out"], visitors)
+        self.assertLess(recorded, visitors / 2)
+        self.assertTrue(all(s.sample_weight == 4 for s in Session.objects.all()))
+
+        stats = self.service.get_relative_stats(
+            timezone.now() - timezone.timedelta(hours=1), timezone.now()
+        )
+        self.assertEqual(stats["session_count"], recorded * 4)
+        self.assertEqual(stats["hit_count"], recorded * 4)
+
+
+@override_settings(INGRESS_SHED_HEARTBEATS_LAG=10, INGRESS_SAMPLE_LAG=60)
+@mock.patch.object(backpressure, "LAG_REFRESH_INTERVAL", 0)
+class LagTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+
+    def event(self, time):
+        return dict(
+            service_uuid=str(self.service.uuid),
+            tracker="JS",
+            time=time,
+            payload={"idempotency": "page"},
+            ip="203.0.113.1",
+            location="https://example.com/",
+            user_agent="Mozilla/5.0 (X11; Linux x86_64) Firefox/110.0",
+        )
+
+    def tests_lag_is_measured_from_enqueueing(self):
+        """
+        GIVEN: An event that happened a while ago, sent late by the script
+        WHEN: It is enqueued and ingested right away
+        THEN: Ingestion is not behind
+        """
+        enqueue_ingress(**self.event(timezone.now() - timezone.timedelta(minutes=30)))
+
+        self.assertEqual(Hit.objects.count(), 1)
+        self.assertLess(backpressure.current_lag(), 5)
+
+    def tests_replayed_events_do_not_report_lag(self):
+        """
+        GIVEN: An event spooled during an outage
+        WHEN: It is replayed long after
+        THEN: No lag is reported
+        """
+        ingest_events([self.event(timezone.now() - timezone.timedelta(hours=2))])
+
+        self.assertEqual(Hit.objects.count(), 1)
+        self.assertIsNone(cache.get(backpressure.LAG_KEY))
+        self.assertEqual(backpressure.current_lag(), 0)
+
+    def tests_stalled_ingestion(self):
+        """
+        GIVEN: Events that were enqueued, but not ingested, two minutes ago
+        WHEN: The lag is read
+        THEN: It is at least two minutes, until ingestion catches up again
+        """
+        backpressure.mark_enqueued()
+        cache.set(backpressure.PENDING_KEY, time.time() - 120, timeout=None)
+
+        self.assertGreaterEqual(backpressure.current_lag(), 120)
+        self.assertTrue(backpressure.should_shed_heartbeats())
+
+        backpressure.report_lag(time.time())
+
+        self.assertLess(backpressure.current_lag(), 5)
+
+
+@override_settings(INGRESS_SHED_HEARTBEATS_LAG=10, INGRESS_SAMPLE_LAG=60)
+class IdleLagTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = 1000.0
+        clock = mock.Mock(monotonic=lambda: self.now, time=lambda: self.now)
+        for name, value in [
+            ("_time", clock),
+            ("_marked_at", 0),
+            ("_reported_at", 0),
+            ("_observed_at", 0),
+        ]:
+            patcher = mock.patch.object(backpressure, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ingest(self, delay):
+        # An event enqueued, and ingested `delay` seconds later
+        enqueued_at = self.now
+        backpressure.mark_enqueued()
+        self.now += delay
+        backpressure.report_lag(enqueued_at)
+
+    def tests_idle_period(self):
+        """
+        GIVEN: Events that were ingested as soon as they arrived, the second one too
+               soon after the first to report its lag
+        WHEN: Nothing arrives for ten minutes
+        THEN: Ingestion is not behind
+        """
+        self.ingest(0.5)
+        self.now += 0.5
+        self.ingest(0.01)
+        self.now += 600
+
+        self.assertLess(backpressure.current_lag(), 1)
+        self.assertEqual(backpressure.sample_rate(), 1.0)
+        self.assertFalse(backpressure.should_shed_heartbeats())
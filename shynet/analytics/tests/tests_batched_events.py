@@ -0,0 +1,63 @@
+import json
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from analytics.models import Hit, Session
+from core.factories import ServiceFactory, UserFactory
+
+
+class BatchedEventsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+        self.url = reverse(
+            "ingress:endpoint_script", kwargs={"service_uuid": self.service.uuid}
+        )
+
+    def post(self, events, content_type="text/plain;charset=UTF-8"):
+        return self.client.post(
+            self.url, data=json.dumps(events), content_type=content_type
+        )
+
+    def tests_batch(self):
+        """
+        GIVEN: A page load and two of its heartbeats, collected by the script
+        WHEN: They are sent as a beacon
+        THEN: They are recorded as one hit, at the times they happened
+        """
+        page = {"idempotency": "page", "location": "https://example.com/"}
+
+        resp = self.post(
+            [dict(page, age=10000), dict(page, age=5000), dict(page, age=0)]
+        )
+
+        self.assertEqual(resp.status_code, 200)
+        hit = Hit.objects.get()
+        self.assertEqual(hit.heartbeats, 2)
+        self.assertAlmostEqual(hit.duration.total_seconds(), 10, delta=1)
+        self.assertLess(hit.start_time, timezone.now() - timezone.timedelta(seconds=9))
+        self.assertEqual(Session.objects.get().hit_count, 1)
+
+    def tests_single_event(self):
+        """
+        GIVEN: An older tracking script
+        WHEN: It sends a single event
+        THEN: It is still recorded
+        """
+        resp = self.post({"idempotency": "page"}, content_type="application/json")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Hit.objects.count(), 1)
+
+    def tests_invalid_batches(self):
+        """
+        GIVEN: The script endpoint
+        WHEN: Something other than a reasonably sized list of events is sent
+        THEN: The request is rejected
+        """
+        for events in [[], ["page"], [{"idempotency": str(i)} for i in range(101)]]:
+            self.assertEqual(self.post(events).status_code, 400)
+        self.assertEqual(Hit.objects.count(), 0)
@@ -0,0 +1,66 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from analytics import devices
+from analytics.devices import Device, classify_user_agent
+
+DESKTOP = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.90 Safari/537.36"
+PHONE = "Mozilla/5.0 (iPhone; CPU iPhone OS 16_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1"
+TABLET = "Mozilla/5.0 (iPad; CPU OS 16_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1"
+ROBOT = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
+
+
+class ClassifyUserAgentTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        classify_user_agent.cache_clear()
+        self.addCleanup(classify_user_agent.cache_clear)
+
+    def tests_device_types(self):
+        """
+        GIVEN: User agents of different kinds of devices
+        WHEN: They are classified
+        THEN: Each gets its device type, browser and OS
+        """
+        self.assertEqual(
+            classify_user_agent(DESKTOP), Device("Chrome", "Linux", "Other", "DESKTOP")
+        )
+        self.assertEqual(classify_user_agent(PHONE).device_type, "PHONE")
+        self.assertEqual(classify_user_agent(TABLET).device_type, "TABLET")
+        self.assertEqual(classify_user_agent(ROBOT).device_type, "ROBOT")
+
+    @override_settings(USER_AGENT_SHARED_CACHE=False)
+    def tests_parsed_once_per_process(self):
+        """
+        GIVEN: A user agent that was classified before
+        WHEN: It is classified again
+        THEN: It is not parsed again
+        """
+        with mock.patch.object(
+            devices, "parse_user_agent", wraps=devices.parse_user_agent
+        ) as parse:
+            first = classify_user_agent(DESKTOP)
+            second = classify_user_agent(DESKTOP)
+
+        self.assertEqual(first, second)
+        self.assertEqual(parse.call_count, 1)
+
+    @override_settings(USER_AGENT_SHARED_CACHE=True)
+    def tests_shared_between_processes(self):
+        """
+        GIVEN: A user agent classified by one process
+        WHEN: Another process classifies it
+        THEN: It gets the result from the shared cache without parsing it
+        """
+        stats = dict(devices.shared_cache_stats)
+        device = classify_user_agent(PHONE)
+        classify_user_agent.cache_clear()  # As if in another process
+
+        with mock.patch.object(devices, "parse_user_agent") as parse:
+            self.assertEqual(classify_user_agent(PHONE), device)
+
+        parse.assert_not_called()
+        self.assertEqual(devices.shared_cache_stats["misses"], stats["misses"] + 1)
+        self.assertEqual(devices.shared_cache_stats["hits"], stats["hits"] + 1)
@@ -0,0 +1,76 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+
+from analytics.tasks import dropped_ingress_counts
+from core.factories import ServiceFactory, UserFactory
+from core.models import Service
+
+
+class EdgeFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+        self.url = reverse(
+            "ingress:endpoint_pixel", kwargs={"service_uuid": self.service.uuid}
+        )
+
+    def update_service(self, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            for field, value in fields.items():
+                setattr(self.service, field, value)
+            self.service.save()
+
+    def request_pixel(self, **extra):
+        with mock.patch("analytics.views.ingress.enqueue_ingress_many") as enqueue:
+            resp = self.client.get(self.url, **extra)
+        self.assertEqual(resp.status_code, 200)
+        return enqueue.called
+
+    def tests_accepted(self):
+        """
+        GIVEN: A service that records everything
+        WHEN: The pixel is requested
+        THEN: The event is enqueued
+        """
+        self.update_service(respect_dnt=False)
+
+        self.assertTrue(self.request_pixel(HTTP_DNT="1"))
+        self.assertEqual(set(dropped_ingress_counts().values()), {0})
+
+    def tests_dnt(self):
+        """
+        GIVEN: A service that respects Do Not Track
+        WHEN: The pixel is requested with DNT or GPC
+        THEN: The event is dropped and counted
+        """
+        self.update_service(respect_dnt=True)
+
+        self.assertFalse(self.request_pixel(HTTP_DNT="1"))
+        self.assertFalse(self.request_pixel(HTTP_SEC_GPC="1"))
+        self.assertTrue(self.request_pixel())
+        self.assertEqual(dropped_ingress_counts()["dnt"], 2)
+
+    def tests_ignored_ip(self):
+        """
+        GIVEN: A service that ignores the visitor's network
+        WHEN: The pixel is requested
+        THEN: The event is dropped and counted
+        """
+        self.update_service(ignored_ips="127.0.0.0/8")
+
+        self.assertFalse(self.request_pixel(REMOTE_ADDR="127.0.0.1"))
+        self.assertEqual(dropped_ingress_counts()["ignored_ip"], 1)
+
+    def tests_archived(self):
+        """
+        GIVEN: An archived service
+        WHEN: The pixel is requested
+        THEN: The event is dropped and counted
+        """
+        self.update_service(status=Service.ARCHIVED)
+
+        self.assertFalse(self.request_pixel())
+        self.assertEqual(dropped_ingress_counts()["inactive"], 1)
@@ -0,0 +1,164 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from analytics.geoip import GeoIPLookup
+
+IP = "203.0.113.1"
+
+
+class FakeReader:
+    # Stands in for a MaxMind database, answering every IP the same way
+    def __init__(self, country="NL", asn="Example Networks"):
+        self.country = country
+        self.organization = asn
+
+    def city(self, ip):
+        return SimpleNamespace(
+            country=SimpleNamespace(iso_code=self.country),
+            location=SimpleNamespace(
+                longitude=4.9, latitude=52.4, time_zone="Europe/Amsterdam"
+            ),
+        )
+
+    def asn(self, ip):
+        return SimpleNamespace(autonomous_system_organization=self.organization)
+
+
+class GeoIPReloadTests(SimpleTestCase):
+    def setUp(self):
+        self.geoip = GeoIPLookup(
+            "city.mmdb", None, ["country"], cache_size=10, reload_interval=60
+        )
+        self.signature = ("inode", 1)
+        self.readers = [FakeReader("NL")]
+        for name, fake in [("_open", self.open), ("_signature", self.stat)]:
+            patcher = mock.patch.object(self.geoip, name, side_effect=fake)
+            self.addCleanup(patcher.stop)
+            setattr(self, name, patcher.start())
+
+    def open(self, path):
+        return self.readers.pop(0)
+
+    def stat(self, path):
+        return self.signature
+
+    def check_now(self):
+        # As if the reload interval passed
+        self.geoip._next_check = 0
+
+    def tests_unchanged_database_is_kept(self):
+        """
+        GIVEN: A database that was opened
+        WHEN: It is checked again without having changed
+        THEN: It is not opened again
+        """
+        self.assertEqual(self.geoip.lookup(IP), {"country": "NL"})
+        self.check_now()
+
+        self.assertEqual(self.geoip.lookup("203.0.113.2"), {"country": "NL"})
+        self.assertEqual(self._open.call_count, 1)
+        self.assertEqual(self._signature.call_count, 2)
+
+    def tests_changed_database_is_reloaded(self):
+        """
+        GIVEN: A database whose results are cached
+        WHEN: The file is replaced and checked again
+        THEN: The new database answers, and cached results are forgotten
+        """
+        self.assertEqual(self.geoip.lookup(IP), {"country": "NL"})
+        self.signature = ("inode", 2)
+        self.readers.append(FakeReader("BE"))
+
+        self.assertEqual(self.geoip.lookup(IP), {"country": "NL"})
+        self.check_now()
+
+        self.assertEqual(self.geoip.lookup(IP), {"country": "BE"})
+        self.assertEqual(self._open.call_count, 2)
+
+    def tests_broken_database_keeps_old_reader(self):
+        """
+        GIVEN: A database that was opened
+        WHEN: The file changes, but cannot be opened until the next check
+        THEN: The old database keeps answering until the new one opens
+        """
+        self.geoip.lookup(IP)
+        self.signature = ("inode", 2)
+        self.readers += [None, FakeReader("BE")]
+        self.check_now()
+
+        self.assertEqual(self.geoip.lookup("203.0.113.2"), {"country": "NL"})
+        self.check_now()
+
+        self.assertEqual(self.geoip.lookup("203.0.113.3"), {"country": "BE"})
+        self.assertEqual(self.geoip.lookup(IP), {"country": "BE"})
+
+
+class GeoIPEnrichmentTests(SimpleTestCase):
+    def lookup(self, enrichment):
+        geoip = GeoIPLookup("city.mmdb", "asn.mmdb", enrichment, cache_size=10)
+        with mock.patch.object(
+            geoip, "_open", side_effect=lambda path: FakeReader()
+        ) as opened:
+            data = geoip.lookup(IP)
+        return data, sorted(call.args[0] for call in opened.call_args_list)
+
+    def tests_levels(self):
+        """
+        GIVEN: Each combination of enrichment levels
+        WHEN: An IP is looked up
+        THEN: Only the configured fields are returned, and only the databases they
+              need are opened
+        """
+        cases = [
+            (["country"], {"country": "NL"}, ["city.mmdb"]),
+            (
+                ["city"],
+                {
+                    "country": "NL",
+                    "longitude": 4.9,
+                    "latitude": 52.4,
+                    "time_zone": "Europe/Amsterdam",
+                },
+                ["city.mmdb"],
+            ),
+            (["asn"], {"asn": "Example Networks"}, ["asn.mmdb"]),
+            (
+                ["country", "asn"],
+                {"country": "NL", "asn": "Example Networks"},
+                ["asn.mmdb", "city.mmdb"],
+            ),
+            ([], {}, []),
+        ]
+        for enrichment, data, opened in cases:
+            with self.subTest(enrichment=enrichment):
+                self.assertEqual(self.lookup(enrichment), (data, opened))
+
+    def tests_unknown_level(self):
+        """
+        GIVEN: A misspelled enrichment level
+        WHEN: The lookup is created
+        THEN: It refuses to start
+        """
+        with self.assertRaises(ValueError):
+            GeoIPLookup("city.mmdb", "asn.mmdb", ["country", "cty"], cache_size=10)
+
+    def tests_missing_database(self):
+        """
+        GIVEN: A database file that does not exist
+        WHEN: An IP is looked up
+        THEN: Nothing is returned for it, and the other database is still used
+        """
+        geoip = GeoIPLookup(
+            "/nonexistent/city.mmdb", "asn.mmdb", ["country", "asn"], cache_size=10
+        )
+        real_open = geoip._open
+        with mock.patch.object(
+            geoip,
+            "_open",
+            side_effect=lambda path: real_open(path)
+            if path.startswith("/nonexistent")
+            else FakeReader(),
+        ), self.assertLogs("analytics.geoip", level="ERROR"):
+            self.assertEqual(geoip.lookup(IP), {"asn": "Example Networks"})
@@ -0,0 +1,134 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from analytics.heartbeats import flush_heartbeats, record_heartbeats
+from analytics.models import Hit, Session
+from analytics.pipeline import association_cache
+from analytics.tasks import ingress_request
+from core.factories import ServiceFactory, UserFactory
+
+
+class HeartbeatCoalescingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+        self.start = timezone.now() - timezone.timedelta(minutes=5)
+        self.session = Session.objects.create(
+            service=self.service, start_time=self.start, last_seen=self.start
+        )
+        self.hit = Hit.objects.create(
+            session=self.session,
+            service=self.service,
+            start_time=self.start,
+            last_seen=self.start,
+        )
+
+    def heartbeat(self, time):
+        return (self.hit.pk, self.session.pk, time, time)
+
+    def tests_heartbeats_are_flushed_together(self):
+        """
+        GIVEN: Several heartbeats recorded for the same hit, out of order
+        WHEN: The pending heartbeats are flushed
+        THEN: The hit and its session are updated once with the total and latest time
+        """
+        times = [self.start + timezone.timedelta(seconds=s) for s in (5, 15, 10)]
+        record_heartbeats([self.heartbeat(times[0])])
+        record_heartbeats([self.heartbeat(times[1]), self.heartbeat(times[2])])
+
+        self.assertEqual(flush_heartbeats(100), 3)
+
+        self.hit.refresh_from_db()
+        self.session.refresh_from_db()
+        self.assertEqual(self.hit.heartbeats, 3)
+        self.assertEqual(self.hit.last_seen, times[1])
+        self.assertEqual(self.session.last_seen, times[1])
+        self.assertEqual(flush_heartbeats(100), 0)
+
+    def tests_heartbeats_after_flush_are_pending_again(self):
+        """
+        GIVEN: A hit whose heartbeats were already flushed
+        WHEN: Another heartbeat is recorded and flushed
+        THEN: Only the new heartbeat is added
+        """
+        record_heartbeats([self.heartbeat(self.start)])
+        flush_heartbeats(100)
+        record_heartbeats([self.heartbeat(self.start)])
+        flush_heartbeats(100)
+
+        self.hit.refresh_from_db()
+        self.assertEqual(self.hit.heartbeats, 2)
+
+    def tests_failed_flush_keeps_heartbeats(self):
+        """
+        GIVEN: Recorded heartbeats
+        WHEN: Writing them fails, and they are flushed again
+        THEN: They are written by the second flush
+        """
+        record_heartbeats([self.heartbeat(self.start)] * 2)
+        with mock.patch(
+            "analytics.heartbeats.write_heartbeats", side_effect=DatabaseError()
+        ), self.assertRaises(DatabaseError):
+            flush_heartbeats(100)
+
+        self.assertEqual(flush_heartbeats(100), 2)
+
+        self.hit.refresh_from_db()
+        self.assertEqual(self.hit.heartbeats, 2)
+
+
+class HeartbeatFastPathTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+
+    def ingress(self, time):
+        ingress_request(
+            str(self.service.uuid),
+            "JS",
+            time,
+            {"idempotency": "page"},
+            "203.0.113.1",
+            "",
+            "Mozilla/5.0 (X11; Linux x86_64) Firefox/110.0",
+        )
+
+    @override_settings(HEARTBEAT_FLUSH_INTERVAL=0)
+    def tests_heartbeat_does_not_load_rows(self):
+        """
+        GIVEN: A page load that was already recorded
+        WHEN: A heartbeat for it arrives
+        THEN: The hit and session are updated without being loaded
+        """
+        start = timezone.now()
+        self.ingress(start)
+        heartbeat = start + timezone.timedelta(seconds=5)
+
+        with self.assertNumQueries(2):
+            self.ingress(heartbeat)
+
+        hit = Hit.objects.get()
+        self.assertEqual((hit.heartbeats, hit.last_seen), (1, heartbeat))
+        self.assertEqual(hit.session.last_seen, heartbeat)
+
+    @override_settings(HEARTBEAT_FLUSH_INTERVAL=0)
+    def tests_heartbeat_skips_shared_cache(self):
+        """
+        GIVEN: A page load recorded by this process, with the local cache enabled
+        WHEN: A heartbeat for it arrives
+        THEN: Its session and hit are found without asking the shared cache
+        """
+        start = timezone.now()
+        with mock.patch.object(association_cache, "ttl", 10):
+            association_cache.clear()
+            self.ingress(start)
+            with mock.patch("analytics.pipeline.get_and_touch_many") as shared:
+                self.ingress(start + timezone.timedelta(seconds=5))
+            association_cache.clear()
+
+        shared.assert_not_called()
+        self.assertEqual(Hit.objects.get().heartbeats, 1)
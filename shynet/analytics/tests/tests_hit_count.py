@@ -0,0 +1,112 @@
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from analytics.models import Hit, Session
+from analytics.tasks import ingress_request
+from core.factories import ServiceFactory, UserFactory
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.90 Safari/537.36"
+
+
+class HitCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+
+    def ingress(self, idempotency):
+        ingress_request(
+            str(self.service.uuid),
+            "JS",
+            timezone.now(),
+            {"idempotency": idempotency},
+            "203.0.113.1",
+            "",
+            USER_AGENT,
+        )
+
+    def tests_hit_count_is_maintained_at_ingest(self):
+        """
+        GIVEN: A visitor
+        WHEN: They load two pages and send a heartbeat
+        THEN: Their session counts two hits and is not a bounce
+        """
+        self.ingress("first")
+        session = Session.objects.get()
+        self.assertEqual(session.hit_count, 1)
+        self.assertTrue(session.is_bounce)
+
+        self.ingress("first")
+        self.ingress("second")
+        session.refresh_from_db()
+        self.assertEqual(session.hit_count, 2)
+        self.assertFalse(session.is_bounce)
+
+    def tests_backfill_hit_counts(self):
+        """
+        GIVEN: Sessions created before hit counts were stored
+        WHEN: The backfill command is run
+        THEN: Their hit counts and bounce statuses are recalculated
+        """
+        bounce = Session.objects.create(service=self.service, is_bounce=False)
+        Hit.objects.create(session=bounce, service=self.service)
+        long = Session.objects.create(service=self.service)
+        Hit.objects.create(session=long, service=self.service)
+        Hit.objects.create(session=long, service=self.service)
+
+        call_command("backfill_hit_counts", stdout=StringIO())
+
+        bounce.refresh_from_db()
+        long.refresh_from_db()
+        self.assertEqual((bounce.hit_count, bounce.is_bounce), (1, True))
+        self.assertEqual((long.hit_count, long.is_bounce), (2, False))
+
+
+class HitCountMigrationTests(TransactionTestCase):
+    def migrate(self, analytics_migration=None):
+        # Migrates analytics to the given migration, and everything else to the latest
+        executor = MigrationExecutor(connection)
+        targets = [
+            (app, analytics_migration or name) if app == "analytics" else (app, name)
+            for app, name in executor.loader.graph.leaf_nodes()
+        ]
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate()
+
+    def tests_migration_backfills_hit_counts(self):
+        """
+        GIVEN: Sessions created before hit counts were stored
+        WHEN: The migration adding them is applied
+        THEN: Their hit counts and bounce statuses are calculated
+        """
+        apps = self.migrate("0010_auto_20220624_0744")
+        User = apps.get_model("core", "User")
+        Service = apps.get_model("core", "Service")
+        Session = apps.get_model("analytics", "Session")
+        Hit = apps.get_model("analytics", "Hit")
+        service = Service.objects.create(
+            name="Example",
+            owner=User.objects.create(username="owner", email="owner@example.com"),
+        )
+        bounce = Session.objects.create(service=service)
+        Hit.objects.create(session=bounce, service=service)
+        long = Session.objects.create(service=service, is_bounce=False)
+        Hit.objects.create(session=long, service=service)
+        Hit.objects.create(session=long, service=service)
+
+        Session = self.migrate("0011_session_hit_count").get_model(
+            "analytics", "Session"
+        )
+
+        bounce = Session.objects.get(pk=bounce.pk)
+        long = Session.objects.get(pk=long.pk)
+        self.assertEqual((bounce.hit_count, bounce.is_bounce), (1, True))
+        self.assertEqual((long.hit_count, long.is_bounce), (2, False))
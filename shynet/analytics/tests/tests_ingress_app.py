@@ -0,0 +1,59 @@
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.urls import reverse
+
+from core.factories import ServiceFactory, UserFactory
+from shynet.ingress import application
+
+
+class IngressApplicationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+
+    def request(self, method, path, **extra):
+        environ = getattr(RequestFactory(), method)(path, **extra).environ
+        statuses = []
+        body = application(environ, lambda status, headers: statuses.append(status))
+        return statuses[0], b"".join(body)
+
+    def tests_serves_tracking_endpoints(self):
+        """
+        GIVEN: The standalone ingress application
+        WHEN: The tracking script is requested
+        THEN: It is served
+        """
+        path = reverse(
+            "ingress:endpoint_script", kwargs={"service_uuid": self.service.uuid}
+        )
+
+        status, body = self.request("get", path)
+
+        self.assertEqual(status, "200 OK")
+        self.assertIn(b"var Shynet", body)
+
+    def tests_does_not_serve_other_routes(self):
+        """
+        GIVEN: The standalone ingress application
+        WHEN: A dashboard page is requested
+        THEN: It is not found
+        """
+        status, _ = self.request("get", reverse("dashboard:dashboard"))
+
+        self.assertEqual(status, "404 Not Found")
+
+    def tests_preflight_can_be_cached(self):
+        """
+        GIVEN: A tracking endpoint
+        WHEN: A browser sends a CORS preflight request
+        THEN: The answer says how long it may be reused
+        """
+        path = reverse(
+            "ingress:endpoint_script", kwargs={"service_uuid": self.service.uuid}
+        )
+
+        resp = self.client.options(path)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Access-Control-Max-Age", resp)
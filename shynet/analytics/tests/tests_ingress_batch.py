@@ -0,0 +1,170 @@
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.db import IntegrityError, OperationalError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from analytics.models import Hit, Session
+from analytics.tasks import enqueue_ingress, ingest_events, ingress_batch
+from core.factories import ServiceFactory, UserFactory
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.90 Safari/537.36"
+
+
+class IngressBatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+
+    def event(self, idempotency, ip="203.0.113.1", time=None, **kwargs):
+        return dict(
+            service_uuid=str(self.service.uuid),
+            tracker="JS",
+            time=time or timezone.now(),
+            payload={"idempotency": idempotency, "location": "https://example.com/"},
+            ip=ip,
+            location="",
+            user_agent=USER_AGENT,
+            **kwargs,
+        )
+
+    def tests_batch_creates_sessions_and_hits(self):
+        """
+        GIVEN: A batch with two page loads and a heartbeat from one visitor, and a page
+               load from another
+        WHEN: The batch is ingested
+        THEN: Two sessions and three hits are created, and the heartbeat is counted
+        """
+        ingest_events(
+            [
+                self.event("first"),
+                self.event("first"),
+                self.event("second"),
+                self.event("other", ip="203.0.113.2"),
+            ]
+        )
+
+        self.assertEqual(Session.objects.count(), 2)
+        self.assertEqual(Hit.objects.count(), 3)
+        self.assertTrue(Hit.objects.get(heartbeats=1).initial)
+        self.assertEqual(Session.objects.filter(is_bounce=True).count(), 1)
+        self.assertEqual(
+            sorted(Session.objects.values_list("hit_count", flat=True)), [1, 2]
+        )
+
+    def tests_batch_links_to_earlier_batches(self):
+        """
+        GIVEN: A session created by an earlier batch
+        WHEN: A heartbeat and a new page load from the same visitor are ingested
+        THEN: They are linked to the existing session and hit
+        """
+        ingest_events([self.event("first")])
+        ingest_events([self.event("first"), self.event("second")])
+
+        session = Session.objects.get()
+        self.assertEqual(session.hit_set.count(), 2)
+        self.assertEqual(session.hit_count, 2)
+        self.assertEqual(session.hit_set.get(initial=True).heartbeats, 1)
+        self.assertFalse(session.is_bounce)
+
+    def tests_batch_respects_dnt(self):
+        """
+        GIVEN: A service that respects DNT
+        WHEN: A batch with a DNT event is ingested
+        THEN: The event is dropped
+        """
+        ingest_events([self.event("first", dnt=True)])
+
+        self.assertEqual(Session.objects.count(), 0)
+
+    @override_settings(INGRESS_BATCH_SIZE=2)
+    def tests_enqueue_buffers_events(self):
+        """
+        GIVEN: Batching is enabled
+        WHEN: Events are enqueued
+        THEN: They are drained from the buffer and written
+        """
+        for idempotency in ["first", "first", "second"]:
+            enqueue_ingress(**self.event(idempotency))
+
+        self.assertEqual(Session.objects.count(), 1)
+        self.assertEqual(Hit.objects.count(), 2)
+
+    def tests_invalid_events_are_dropped_alone(self):
+        """
+        GIVEN: A batch with a valid event and events with malformed payloads
+        WHEN: The batch is ingested
+        THEN: Only the malformed events are dropped, and unusable load times are cleared
+        """
+        events = [self.event(str(i), ip=f"203.0.113.{i}") for i in range(1, 6)]
+        events[1]["payload"]["loadTime"] = None
+        events[2]["payload"]["loadTime"] = "slow"
+        events[3]["payload"]["location"] = {"href": "https://example.com/"}
+        events[4]["payload"]["referrer"] = 1
+
+        ingest_events(events)
+
+        self.assertEqual(Hit.objects.count(), 3)
+        self.assertEqual(
+            list(Hit.objects.values_list("load_time", flat=True)), [None] * 3
+        )
+
+    @override_settings(INGRESS_BATCH_SIZE=2)
+    def tests_failed_batches_stay_buffered(self):
+        """
+        GIVEN: Batching is enabled, and the database fails while a batch is written
+        WHEN: The next batch is written
+        THEN: It includes the events of the failed batch
+        """
+        with patch(
+            "analytics.tasks.ingest_events", side_effect=OperationalError("unavailable")
+        ):
+            enqueue_ingress(**self.event("first"))
+            enqueue_ingress(**self.event("second"))
+        self.assertEqual(Hit.objects.count(), 0)
+
+        enqueue_ingress(**self.event("third"))
+        ingress_batch()
+
+        self.assertEqual(Hit.objects.count(), 3)
+
+    @override_settings(INGRESS_BATCH_SIZE=2)
+    def tests_failing_batches_are_dropped(self):
+        """
+        GIVEN: Batching is enabled, and a batch fails in a way retrying can't fix
+        WHEN: The next batch is written
+        THEN: The failed batch is dropped instead of blocking the buffer
+        """
+        with patch(
+            "analytics.tasks.ingest_events", side_effect=IntegrityError("broken")
+        ), self.assertLogs("analytics.tasks", level="ERROR"):
+            enqueue_ingress(**self.event("first"))
+            enqueue_ingress(**self.event("second"))
+
+        enqueue_ingress(**self.event("third"))
+        ingress_batch()
+
+        self.assertEqual(Hit.objects.count(), 1)
+
+    def tests_serialized_times(self):
+        """
+        GIVEN: Events whose times were serialized to strings by the broker
+        WHEN: A page load, a heartbeat and another page load of a visitor are ingested
+        THEN: They are recorded as if their times were never serialized
+        """
+        start = timezone.now()
+        times = [start + timezone.timedelta(seconds=s) for s in (0, 5, 10)]
+        events = [
+            self.event(idempotency, time=time.isoformat())
+            for idempotency, time in zip(["first", "first", "second"], times)
+        ]
+        broken = self.event("third", time="yesterday")
+
+        ingest_events(events[:1])
+        ingest_events(events[1:] + [broken])
+
+        session = Session.objects.get()
+        self.assertEqual(session.last_seen, times[2])
+        self.assertEqual(session.hit_count, 2)
+        self.assertEqual(session.hit_set.get(initial=True).last_seen, times[1])
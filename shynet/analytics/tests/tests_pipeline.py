@@ -0,0 +1,69 @@
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from analytics.models import Hit, Session
+from analytics.pipeline import STAGES, IngestPipeline
+from core.factories import ServiceFactory, UserFactory
+
+
+@override_settings(HEARTBEAT_FLUSH_INTERVAL=0)
+class IngestPipelineTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory(), ignored_ips="10.0.0.0/8")
+        self.time = timezone.now()
+
+    def event(self, ip, idempotency):
+        return {
+            "service_uuid": str(self.service.uuid),
+            "tracker": "JS",
+            "time": self.time,
+            "payload": {"idempotency": idempotency},
+            "ip": ip,
+            "location": "",
+            "user_agent": "Mozilla/5.0 (X11; Linux x86_64) Firefox/110.0",
+        }
+
+    def tests_stages_are_timed(self):
+        """
+        GIVEN: A pipeline with a timing hook
+        WHEN: A list of events, one of them from an ignored IP, is ingested
+        THEN: The hook sees every stage in order, each with the events it was given
+        """
+        pipeline = IngestPipeline()
+        timings = []
+        pipeline.add_timing_hook(
+            lambda stage, seconds, count: timings.append((stage, count))
+        )
+
+        pipeline.run(
+            [
+                self.event("203.0.113.1", "a"),
+                self.event("203.0.113.2", "b"),
+                self.event("10.0.0.1", "c"),
+            ]
+        )
+
+        self.assertEqual(timings, list(zip(STAGES, [3, 3, 2, 2, 2])))
+        self.assertEqual(Session.objects.count(), 2)
+
+    def tests_only_new_visitors_are_enriched(self):
+        """
+        GIVEN: A pipeline that enriches events in a thread pool
+        WHEN: Page loads of new visitors are ingested, then heartbeats of the same visitors
+        THEN: Only the page loads are enriched, and the heartbeats update their hits
+        """
+        pipeline = IngestPipeline(enrich_threads=2)
+        ips = [f"203.0.113.{i}" for i in range(1, 5)]
+
+        first = pipeline.run([self.event(ip, ip) for ip in ips])
+        second = pipeline.run([self.event(ip, ip) for ip in ips])
+
+        self.assertEqual(len(first.enrichments), 4)
+        self.assertEqual(len(second.enrichments), 0)
+        self.assertEqual(len(second.heartbeats), 4)
+        self.assertEqual(Session.objects.count(), 4)
+        self.assertEqual(
+            list(Hit.objects.values_list("heartbeats", flat=True)), [1, 1, 1, 1]
+        )
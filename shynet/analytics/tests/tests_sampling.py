@@ -0,0 +1,87 @@
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from analytics.models import Hit, Session
+from core.factories import ServiceFactory, UserFactory
+
+
+class ServiceSamplingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.sample_rate = 0.25
+            self.service.save()
+        self.url = reverse(
+            "ingress:endpoint_script", kwargs={"service_uuid": self.service.uuid}
+        )
+
+    def post(self, idempotency, ip, load_time=100):
+        self.client.post(
+            self.url,
+            data={"idempotency": idempotency, "loadTime": load_time},
+            content_type="application/json",
+            REMOTE_ADDR=ip,
+        )
+
+    def stats(self):
+        return self.service.get_relative_stats(
+            timezone.now() - timezone.timedelta(hours=1), timezone.now()
+        )
+
+    def tests_whole_sessions_are_sampled(self):
+        """
+        GIVEN: A service that records a quarter of its sessions
+        WHEN: Many visitors view two pages each
+        THEN: About a quarter of them are recorded, with both of their pages
+        """
+        visitors = 400
+        for i in range(visitors):
+            ip = f"198.51.{i // 256}.{i % 256}"
+            self.post(f"first-{i}", ip)
+            self.post(f"second-{i}", ip)
+
+        recorded = Session.objects.count()
+        self.assertAlmostEqual(recorded / visitors, 0.25, delta=0.1)
+        self.assertEqual(Hit.objects.count(), recorded * 2)
+        self.assertTrue(all(s.hit_count == 2 for s in Session.objects.all()))
+
+        stats = self.stats()
+        self.assertEqual(stats["session_count"], recorded * 4)
+        self.assertEqual(stats["hit_count"], recorded * 8)
+        self.assertEqual(stats["avg_hits_per_session"], 2)
+        self.assertEqual(stats["bounce_rate_pct"], 0)
+
+    def tests_averages_are_weighted(self):
+        """
+        GIVEN: Sessions recorded at different sample rates
+        WHEN: Statistics are computed
+        THEN: Averages count each session as many times as it stands for
+        """
+        now = timezone.now()
+        for weight, seconds, load_time in [(1, 10, 100), (3, 30, 500)]:
+            session = Session.objects.create(
+                service=self.service,
+                start_time=now - timezone.timedelta(seconds=seconds),
+                last_seen=now,
+                sample_weight=weight,
+                hit_count=1,
+            )
+            Hit.objects.create(
+                session=session,
+                service=self.service,
+                start_time=session.start_time,
+                load_time=load_time,
+                sample_weight=weight,
+            )
+
+        stats = self.stats()
+
+        self.assertEqual(stats["session_count"], 4)
+        self.assertEqual(stats["avg_load_time"], 400)
+        duration = stats["avg_session_duration"]
+        if isinstance(duration, timezone.timedelta):
+            duration = duration.total_seconds()
+        self.assertAlmostEqual(duration, 25, delta=0.1)
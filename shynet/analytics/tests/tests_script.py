@@ -0,0 +1,101 @@
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from core.factories import ServiceFactory, UserFactory
+
+
+class ScriptViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+        self.url = reverse(
+            "ingress:endpoint_script", kwargs={"service_uuid": self.service.uuid}
+        )
+
+    def tests_conditional_request(self):
+        """
+        GIVEN: A client that already downloaded the script
+        WHEN: It asks for the script again with the ETag it received
+        THEN: The script is not sent again
+        """
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("max-age=", resp["Cache-Control"])
+
+        resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=resp["ETag"])
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.content, b"")
+
+    def tests_service_update_changes_script(self):
+        """
+        GIVEN: A script that was served and cached
+        WHEN: The service's injected script is changed
+        THEN: The new script is served under a new ETag
+        """
+        etag = self.client.get(self.url)["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.script_inject = "console.log('injected');"
+            self.service.save()
+        resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp["ETag"], etag)
+        self.assertIn(b"console.log('injected');", resp.content)
+
+    def tests_variants_are_cached_separately(self):
+        """
+        GIVEN: A service that respects Do Not Track
+        WHEN: The script is requested with and without DNT
+        THEN: Each request gets its own variant of the script, which shared caches
+              keep apart
+        """
+        self.service.respect_dnt = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.save()
+
+        tracking = self.client.get(self.url)
+        not_tracking = self.client.get(self.url, HTTP_DNT="1")
+
+        self.assertNotEqual(tracking["ETag"], not_tracking["ETag"])
+        for resp in (tracking, not_tracking):
+            self.assertIn("DNT", resp["Vary"])
+            self.assertIn("Origin", resp["Vary"])
+        self.assertIn(b"dnt: true", not_tracking.content)
+        self.assertIn(b"dnt: false", tracking.content)
+
+    def tests_tracking_mode_changes_script(self):
+        """
+        GIVEN: A script that was served and cached in heartbeat mode
+        WHEN: The tracking mode is switched to visibility
+        THEN: A different script is served, which reports visible time
+        """
+        heartbeat = self.client.get(self.url)
+        with override_settings(SCRIPT_TRACKING_MODE="visibility"):
+            visibility = self.client.get(self.url)
+
+        self.assertNotEqual(heartbeat["ETag"], visibility["ETag"])
+        self.assertIn(b'"heartbeat" === "visibility"', heartbeat.content)
+        self.assertIn(b'"visibility" === "visibility"', visibility.content)
+
+    def tests_origins_are_checked(self):
+        """
+        GIVEN: A service that only accepts its subdomains
+        WHEN: The script is requested from various origins
+        THEN: Only requests from a subdomain get it
+        """
+        self.service.origins = "https://*.example.com"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.save()
+
+        allowed = self.client.get(self.url, HTTP_ORIGIN="https://www.example.com")
+        referred = self.client.get(
+            self.url, HTTP_REFERER="https://blog.example.com/post?id=1"
+        )
+        forbidden = self.client.get(self.url, HTTP_ORIGIN="https://example.net")
+
+        self.assertEqual(allowed.status_code, 200)
+        self.assertEqual(referred.status_code, 200)
+        self.assertEqual(forbidden.status_code, 403)
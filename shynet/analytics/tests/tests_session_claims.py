@@ -0,0 +1,157 @@
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from analytics import pipeline
+from analytics.models import Hit, Session
+from analytics.tasks import ingest_events, ingress_request
+from core.factories import ServiceFactory, UserFactory
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) Firefox/110.0"
+
+
+@override_settings(HEARTBEAT_FLUSH_INTERVAL=0)
+class ConcurrentSessionTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+
+    def run_concurrently(self, targets):
+        barrier = threading.Barrier(len(targets))
+        errors = []
+
+        def run(target):
+            try:
+                barrier.wait()
+                target()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=run, args=(t,)) for t in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def ingress(self, idempotency):
+        ingress_request(
+            str(self.service.uuid),
+            "JS",
+            timezone.now(),
+            {"idempotency": idempotency},
+            "203.0.113.1",
+            "",
+            USER_AGENT,
+        )
+
+    def tests_concurrent_first_events_share_a_session(self):
+        """
+        GIVEN: A visitor without a session
+        WHEN: Page loads from two tabs are ingested at the same time
+        THEN: A single session is created, holding both hits
+        """
+        self.run_concurrently([lambda i=i: self.ingress(f"tab-{i}") for i in range(2)])
+
+        self.assertEqual(Session.objects.count(), 1)
+        self.assertEqual(Hit.objects.count(), 2)
+        self.assertEqual(Session.objects.get().hit_count, 2)
+
+    def tests_concurrent_batches_share_a_session(self):
+        """
+        GIVEN: A visitor without a session
+        WHEN: Two batches with events of that visitor are ingested at the same time
+        THEN: A single session is created
+        """
+        event = {
+            "service_uuid": str(self.service.uuid),
+            "tracker": "JS",
+            "time": timezone.now(),
+            "ip": "203.0.113.1",
+            "location": "",
+            "user_agent": USER_AGENT,
+        }
+        self.run_concurrently(
+            [
+                lambda i=i: ingest_events(
+                    [dict(event, payload={"idempotency": f"batch-{i}"})]
+                )
+                for i in range(2)
+            ]
+        )
+
+        self.assertEqual(Session.objects.count(), 1)
+        self.assertEqual(Hit.objects.count(), 2)
+
+    def tests_batches_with_visitors_in_opposite_order(self):
+        """
+        GIVEN: Two visitors without a session
+        WHEN: Two batches with events of both, in opposite orders, are ingested at the
+            same time
+        THEN: A session is created for each visitor, without waiting for a claim to
+            expire
+        """
+
+        def event(visitor, batch):
+            return {
+                "service_uuid": str(self.service.uuid),
+                "tracker": "JS",
+                "time": timezone.now(),
+                "payload": {"idempotency": f"{batch}-{visitor}"},
+                "ip": f"203.0.113.{visitor}",
+                "location": "",
+                "user_agent": USER_AGENT,
+            }
+
+        start = time.monotonic()
+        self.run_concurrently(
+            [
+                lambda: ingest_events([event(1, "a"), event(2, "a")]),
+                lambda: ingest_events([event(2, "b"), event(1, "b")]),
+            ]
+        )
+
+        self.assertLess(time.monotonic() - start, pipeline.SESSION_CLAIM_LEASE)
+        self.assertEqual(Session.objects.count(), 2)
+        self.assertEqual(Hit.objects.count(), 4)
+        self.assertEqual(
+            sorted(Session.objects.values_list("hit_count", flat=True)), [2, 2]
+        )
+
+    def tests_claims_are_not_held_while_waiting(self):
+        """
+        GIVEN: A process that holds the claim of one of two visitors
+        WHEN: Another process claims both
+        THEN: It doesn't hold the claim of the other visitor while it waits
+        """
+        claim = pipeline._session_claim_path
+        self.assertTrue(cache.add(claim("visitor-b"), 1))
+        result = {}
+        waiting = threading.Event()
+        sleep = time.sleep
+
+        def wait(seconds):
+            waiting.set()
+            sleep(seconds)
+
+        def claim_both():
+            result["claims"] = pipeline._claim_sessions({"visitor-a", "visitor-b"})
+
+        with mock.patch.object(pipeline._time, "sleep", wait):
+            thread = threading.Thread(target=claim_both)
+            thread.start()
+            self.assertTrue(waiting.wait(pipeline.SESSION_CLAIM_LEASE))
+            self.assertTrue(cache.add(claim("visitor-a"), 1))
+            # This process creates both sessions, so the other one ends up with neither
+            cache.set_many({"visitor-a": 1, "visitor-b": 2})
+            cache.delete_many([claim("visitor-a"), claim("visitor-b")])
+            thread.join()
+
+        self.assertEqual(result["claims"], (set(), {"visitor-a": 1, "visitor-b": 2}))
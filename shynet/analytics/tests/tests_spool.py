@@ -0,0 +1,180 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+
+from analytics import spool as spool_module
+from analytics import tasks
+from analytics.models import Hit
+from analytics.spool import Spool
+from core.factories import ServiceFactory, UserFactory
+
+
+def event(i, service_uuid="service"):
+    return dict(
+        service_uuid=service_uuid,
+        tracker="JS",
+        time=timezone.now(),
+        payload={"idempotency": f"event-{i}"},
+        ip="203.0.113.1",
+        location="https://example.com/",
+        user_agent="Mozilla/5.0 (X11; Linux x86_64) Firefox/110.0",
+        dnt=False,
+        identifier="",
+    )
+
+
+class SpoolTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def tests_replays_in_order(self):
+        """
+        GIVEN: Events spooled across several segments
+        WHEN: The spool is replayed
+        THEN: Every event is ingested once, in order, and the segments are removed
+        """
+        spool = Spool(self.directory.name, segment_size=1)
+        events = [event(i) for i in range(5)]
+        for e in events:
+            spool.append(e)
+
+        ingested = []
+        replayed = spool.replay(lambda batch: ingested.extend(batch))
+
+        self.assertEqual(replayed, 5)
+        self.assertEqual(ingested, events)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def tests_failed_replay(self):
+        """
+        GIVEN: A spooled event
+        WHEN: Replaying it fails
+        THEN: It is replayed again next time
+        """
+        spool = Spool(
+            self.directory.name, segment_size=1, retryable=(OperationalError,)
+        )
+        spool.append(event(0))
+        spool.append(event(1))
+
+        with self.assertRaises(OperationalError):
+            spool.replay(mock.Mock(side_effect=OperationalError()))
+        ingested = []
+        spool.replay(lambda batch: ingested.extend(batch))
+
+        self.assertEqual(
+            [e["payload"] for e in ingested],
+            [{"idempotency": "event-0"}, {"idempotency": "event-1"}],
+        )
+
+    def tests_failing_batch_is_set_aside(self):
+        """
+        GIVEN: Spooled segments, of which the first always fails to replay
+        WHEN: The spool is replayed
+        THEN: The failing events are set aside, and the later segment is replayed
+        """
+        spool = Spool(
+            self.directory.name, segment_size=1, retryable=(OperationalError,)
+        )
+        spool.append(event(0))
+        spool.append(event(1))
+
+        ingested = []
+
+        def ingest(batch):
+            if batch[0]["payload"] == {"idempotency": "event-0"}:
+                raise ValueError()
+            ingested.extend(batch)
+
+        replayed = spool.replay(ingest)
+        spool.replay(ingest)
+
+        self.assertEqual(replayed, 1)
+        self.assertEqual([e["payload"] for e in ingested], [{"idempotency": "event-1"}])
+        (failed,) = os.listdir(self.directory.name)
+        self.assertTrue(failed.endswith(".failed"))
+        with open(os.path.join(self.directory.name, failed)) as f:
+            self.assertIn("event-0", f.read())
+
+    def tests_interrupted_replay(self):
+        """
+        GIVEN: A segment whose replay was killed a while ago
+        WHEN: The spool is replayed
+        THEN: The segment is replayed again
+        """
+        spool = Spool(self.directory.name, segment_size=1)
+        spool.append(event(0))
+        (segment,) = os.listdir(self.directory.name)
+        path = os.path.join(self.directory.name, segment)
+        replaying = os.path.splitext(path)[0] + ".replaying"
+        os.rename(path, replaying)
+
+        ingested = []
+        self.assertEqual(spool.replay(lambda batch: ingested.extend(batch)), 0)
+        stale = time.time() - spool_module.REPLAY_LEASE - 1
+        os.utime(replaying, (stale, stale))
+        replayed = spool.replay(lambda batch: ingested.extend(batch))
+
+        self.assertEqual(replayed, 1)
+        self.assertEqual([e["payload"] for e in ingested], [{"idempotency": "event-0"}])
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+class EnqueueSpoolTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def tests_broker_outage(self):
+        """
+        GIVEN: A broker that is unavailable
+        WHEN: A page view is enqueued, and the spool is replayed afterwards
+        THEN: The page view is recorded
+        """
+        spool = Spool(self.directory.name, segment_size=1)
+        e = event(0, str(self.service.uuid))
+        with mock.patch.object(tasks, "ingress_spool", spool), mock.patch.object(
+            tasks.ingress_request, "delay", side_effect=OperationalError()
+        ), self.assertLogs("analytics.tasks", level="WARNING"):
+            tasks.enqueue_ingress(**e)
+            tasks.enqueue_ingress(**event(1, str(self.service.uuid)))
+        self.assertEqual(Hit.objects.count(), 0)
+
+        call_command(
+            "replay_spool", directory=self.directory.name, stdout=open(os.devnull, "w")
+        )
+
+        self.assertEqual(Hit.objects.count(), 1)
+        self.assertEqual(Hit.objects.get().location, e["location"])
+
+    def tests_replays_after_recovery(self):
+        """
+        GIVEN: A broker that was unavailable for a few events
+        WHEN: An event is enqueued after it recovers
+        THEN: Every spooled event is replayed by the same process
+        """
+        spool = Spool(self.directory.name, segment_size=1024 * 1024)
+        with mock.patch.object(tasks, "ingress_spool", spool), mock.patch.object(
+            spool, "replay_in_background", side_effect=spool.replay
+        ):
+            with mock.patch.object(
+                tasks.ingress_request, "delay", side_effect=OperationalError()
+            ), self.assertLogs("analytics.tasks", level="WARNING"):
+                for i in range(3):
+                    tasks.enqueue_ingress(**event(i, str(self.service.uuid)))
+            self.assertEqual(Hit.objects.count(), 0)
+
+            tasks.enqueue_ingress(**event(3, str(self.service.uuid)))
+
+        self.assertEqual(Hit.objects.count(), 4)
+        self.assertEqual(os.listdir(self.directory.name), [])
@@ -0,0 +1,97 @@
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from analytics.models import Hit, Session
+from analytics.tasks import ingest_events, ingress_request
+from core.factories import ServiceFactory, UserFactory
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) Firefox/110.0"
+
+
+@override_settings(HEARTBEAT_FLUSH_INTERVAL=0)
+class VisibleTimeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = ServiceFactory(owner=UserFactory())
+        self.start = timezone.now() - timezone.timedelta(minutes=10)
+
+    def ingress(self, time, payload):
+        ingress_request(
+            str(self.service.uuid),
+            "JS",
+            time,
+            dict(payload, idempotency="page"),
+            "203.0.113.1",
+            "",
+            USER_AGENT,
+        )
+
+    def tests_visible_time_sets_hit_last_seen(self):
+        """
+        GIVEN: A page load
+        WHEN: The page reports, long after it was loaded, how long it was visible
+        THEN: The hit was last seen when it stopped being visible, the session when the report arrived
+        """
+        self.ingress(self.start, {"visibleTime": 0})
+        reported = self.start + timezone.timedelta(minutes=5)
+        self.ingress(reported, {"visibleTime": 30000})
+
+        hit = Hit.objects.get()
+        self.assertEqual(hit.heartbeats, 1)
+        self.assertEqual(hit.last_seen, self.start + timezone.timedelta(seconds=30))
+        self.assertEqual(Session.objects.get().last_seen, reported)
+
+    def tests_visible_time_never_goes_backwards(self):
+        """
+        GIVEN: A hit that reported a visible time
+        WHEN: An older, smaller visible time arrives late
+        THEN: The hit keeps the larger one
+        """
+        self.ingress(self.start, {"visibleTime": 0})
+        self.ingress(self.start + timezone.timedelta(minutes=2), {"visibleTime": 60000})
+        self.ingress(self.start + timezone.timedelta(minutes=3), {"visibleTime": 20000})
+
+        self.assertEqual(
+            Hit.objects.get().last_seen, self.start + timezone.timedelta(seconds=60)
+        )
+
+    def tests_visible_time_is_capped_at_arrival(self):
+        """
+        GIVEN: A page load
+        WHEN: The page reports more visible time than has passed since it was loaded
+        THEN: The hit is last seen when the report arrived
+        """
+        self.ingress(self.start, {"visibleTime": 0})
+        reported = self.start + timezone.timedelta(seconds=10)
+        self.ingress(reported, {"visibleTime": 3600000})
+
+        self.assertEqual(Hit.objects.get().last_seen, reported)
+
+    def tests_batched_visible_time(self):
+        """
+        GIVEN: A page load and a visible time report ingested in one batch
+        WHEN: The batch is ingested
+        THEN: The hit is last seen when it stopped being visible
+        """
+        event = {
+            "service_uuid": str(self.service.uuid),
+            "tracker": "JS",
+            "ip": "203.0.113.1",
+            "location": "",
+            "user_agent": USER_AGENT,
+        }
+        ingest_events(
+            [
+                dict(event, time=self.start, payload={"idempotency": "page"}),
+                dict(
+                    event,
+                    time=self.start + timezone.timedelta(minutes=5),
+                    payload={"idempotency": "page", "visibleTime": 45000},
+                ),
+            ]
+        )
+
+        self.assertEqual(
+            Hit.objects.get().last_seen, self.start + timezone.timedelta(seconds=45)
+        )
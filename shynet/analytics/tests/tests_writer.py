@@ -0,0 +1,66 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from analytics.writer import BackgroundWriter
+
+
+class BackgroundWriterTests(SimpleTestCase):
+    def tests_writes_everything_before_stopping(self):
+        """
+        GIVEN: A background writer with queued events
+        WHEN: It is stopped
+        THEN: Every event is written, in order and in batches
+        """
+        batches = []
+        writer = BackgroundWriter(batches.append, max_size=100, batch_size=10)
+
+        for i in range(25):
+            self.assertTrue(writer.submit(i))
+        writer.stop()
+
+        self.assertEqual(
+            [event for batch in batches for event in batch], list(range(25))
+        )
+        self.assertTrue(all(len(batch) <= 10 for batch in batches))
+
+    def tests_full_queue(self):
+        """
+        GIVEN: A background writer that is busy and whose queue is full
+        WHEN: Another event is submitted
+        THEN: It is refused
+        """
+        release = threading.Event()
+        writer = BackgroundWriter(
+            lambda events: release.wait(), max_size=1, batch_size=1
+        )
+
+        writer.submit(1)  # Taken by the writer thread, which then blocks
+        while not writer.queue.empty():
+            pass
+        self.assertTrue(writer.submit(2))
+        self.assertFalse(writer.submit(3))
+
+        release.set()
+        writer.stop()
+
+    def tests_failed_batch(self):
+        """
+        GIVEN: A background writer whose writes fail once
+        WHEN: More events are submitted afterwards
+        THEN: They are still written
+        """
+        batches = []
+
+        def write(events):
+            if events == [1]:
+                raise RuntimeError("Database is down")
+            batches.append(events)
+
+        writer = BackgroundWriter(write, max_size=10, batch_size=1)
+        with self.assertLogs("analytics.writer", level="ERROR"):
+            writer.submit(1)
+            writer.submit(2)
+            writer.stop()
+
+        self.assertEqual(batches, [[2]])
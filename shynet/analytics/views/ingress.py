@@ -1,7 +1,9 @@
 import base64
+import hashlib
 import json
-from urllib.parse import urlparse
+from collections import Counter
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
@@ -11,19 +13,57 @@ from django.http import (
     HttpResponseBadRequest,
     HttpResponseForbidden,
 )
-from django.shortcuts import render, reverse
+from django.shortcuts import reverse
+from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 from ipware import get_client_ip
 
+from core.local_cache import LocalCache
 from core.models import Service
+from core.origins import url_origin
+from core.service_config import aget_service_config, get_service_config
 
-from ..tasks import ingress_request
+from .. import backpressure
+from ..tasks import (
+    count_dropped_ingress,
+    enqueue_ingress_many,
+    enqueue_ingress_nowait,
+    ingress_backlog_full,
+    ingress_drop_reason,
+    ingress_shed_reason,
+)
+
+# How long rendered scripts are kept in the cache, in seconds. Entries of outdated
+# service configurations are never read again and simply expire.
+SCRIPT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Rendered scripts, kept in this process as well
+script_cache = LocalCache("scripts", max_size=1000)
 
+# How long browsers may reuse the answer to a CORS preflight request, in seconds
+CORS_PREFLIGHT_MAX_AGE = 60 * 60 * 24
+
+# The CORS headers of every response, whatever its origin
+CORS_HEADERS = {
+    "Access-Control-Allow-Methods": "GET,HEAD,OPTIONS,POST",
+    "Access-Control-Allow-Headers": (
+        "Origin, X-Requested-With, Content-Type, Accept, Authorization, Referer"
+    ),
+}
+# Let browsers skip the preflight for subsequent requests
+PREFLIGHT_HEADERS = dict(
+    CORS_HEADERS, **{"Access-Control-Max-Age": str(CORS_PREFLIGHT_MAX_AGE)}
+)
 
-def ingress(request, service_uuid, identifier, tracker, payload):
+# How many events the tracking script can send at once
+MAX_EVENTS_PER_REQUEST = 100
+
+
+def _ingress_event(request, service_uuid, identifier, tracker, payload):
     time = timezone.now()
     client_ip, is_routable = get_client_ip(request)
     location = request.META.get("HTTP_REFERER", "").strip()
@@ -33,59 +73,167 @@ def ingress(request, service_uuid, identifier, tracker, payload):
     if gpc or dnt:
         dnt = True
 
-    ingress_request.delay(
-        service_uuid,
-        tracker,
-        time,
-        payload,
-        client_ip,
-        location,
-        user_agent,
+    # Batched events say how long ago they happened, in milliseconds
+    age = payload.pop("age", 0)
+    if isinstance(age, (int, float)) and age > 0:
+        time -= timezone.timedelta(
+            milliseconds=min(age, settings.SESSION_MEMORY_TIMEOUT * 1000)
+        )
+
+    return dict(
+        service_uuid=service_uuid,
+        tracker=tracker,
+        time=time,
+        payload=payload,
+        ip=client_ip,
+        location=location,
+        user_agent=user_agent,
         dnt=dnt,
         identifier=identifier,
     )
 
 
+def _ingress_events(request, service, identifier, tracker, payloads):
+    # Returns the events of a request, and why the service would not record them (if
+    # it wouldn't). The events of a request share their origin, so they share this.
+    events = [
+        _ingress_event(request, service.uuid, identifier, tracker, payload)
+        for payload in payloads
+    ]
+    reason = ingress_drop_reason(service, events[0]["dnt"], events[0]["ip"])
+    return events, reason
+
+
+def _shed_load(service, events):
+    # Returns the events to keep, and how many were dropped for each reason
+    accepted, dropped = [], Counter()
+    for event in events:
+        reason = ingress_shed_reason(service, event)
+        if reason is None:
+            accepted.append(event)
+        else:
+            dropped[reason] += 1
+    return accepted, dropped
+
+
+def ingress(request, service, identifier, tracker, payloads):
+    events, reason = _ingress_events(request, service, identifier, tracker, payloads)
+    # Drop what the service would not record anyway before it reaches the queue
+    if reason is not None:
+        count_dropped_ingress(reason, len(events))
+        return
+
+    accepted, dropped = _shed_load(service, events)
+    for reason, count in dropped.items():
+        count_dropped_ingress(reason, count)
+    if len(accepted) > 0:
+        enqueue_ingress_many(accepted)
+
+
+async def aingress(request, service, identifier, tracker, payloads):
+    # Same as ingress, but never blocks the event loop
+    events, reason = _ingress_events(request, service, identifier, tracker, payloads)
+    if reason is not None:
+        await sync_to_async(count_dropped_ingress)(reason, len(events))
+        return
+
+    if backpressure.is_enabled():
+        accepted, dropped = await sync_to_async(_shed_load)(service, events)
+    else:
+        # Sampling the service alone needs no I/O
+        accepted, dropped = _shed_load(service, events)
+    for reason, count in dropped.items():
+        await sync_to_async(count_dropped_ingress)(reason, count)
+    if len(accepted) > 0 and not enqueue_ingress_nowait(accepted):
+        await sync_to_async(ingress_backlog_full)(accepted)
+
+
+def _parse_payloads(body):
+    # The tracking script sends a list of events; older versions send a single one
+    payloads = json.loads(body)
+    if isinstance(payloads, dict):
+        payloads = [payloads]
+    if (
+        not isinstance(payloads, list)
+        or not 0 < len(payloads) <= MAX_EVENTS_PER_REQUEST
+        or not all(isinstance(payload, dict) for payload in payloads)
+    ):
+        raise ValidationError("Invalid payload")
+    return payloads
+
+
+def _allowed_origin(request, service):
+    # Returns the value of Access-Control-Allow-Origin for the request, or None if the
+    # request comes from an origin the service does not accept.
+    allowed_origins = service.allowed_origins
+    if allowed_origins.allows_any:
+        return "*"
+
+    remote_origin = request.META.get("HTTP_ORIGIN")
+    if remote_origin is None:
+        referer = request.META.get("HTTP_REFERER")
+        remote_origin = url_origin(referer) if referer is not None else None
+    if remote_origin is not None and remote_origin.lower() in allowed_origins:
+        return remote_origin
+    return None
+
+
+def _add_cors_headers(request, resp, allow_origin):
+    resp["Access-Control-Allow-Origin"] = allow_origin
+    headers = PREFLIGHT_HEADERS if request.method == "OPTIONS" else CORS_HEADERS
+    for header, value in headers.items():
+        resp[header] = value
+    return resp
+
+
 class ValidateServiceOriginsMixin:
     def dispatch(self, request, *args, **kwargs):
         try:
-            service_uuid = self.kwargs.get("service_uuid")
-            origins = cache.get(f"service_origins_{service_uuid}")
-
-            if origins is None:
-                service = Service.objects.get(uuid=service_uuid)
-                origins = service.origins
-                cache.set(f"service_origins_{service_uuid}", origins, timeout=3600)
-
-            allow_origin = "*"
-
-            if origins != "*":
-                remote_origin = request.META.get("HTTP_ORIGIN")
-                if (
-                    remote_origin is None
-                    and request.META.get("HTTP_REFERER") is not None
-                ):
-                    parsed = urlparse(request.META.get("HTTP_REFERER"))
-                    remote_origin = f"{parsed.scheme}://{parsed.netloc}".lower()
-                origins = [origin.strip().lower() for origin in origins.split(",")]
-                if remote_origin in origins:
-                    allow_origin = remote_origin
-                else:
-                    return HttpResponseForbidden()
+            service = get_service_config(self.kwargs.get("service_uuid"))
+            if service is None:
+                raise Service.DoesNotExist()
+            self.service = service
+            allow_origin = _allowed_origin(request, service)
+            if allow_origin is None:
+                return HttpResponseForbidden()
 
             resp = super().dispatch(request, *args, **kwargs)
-            resp["Access-Control-Allow-Origin"] = allow_origin
-            resp["Access-Control-Allow-Methods"] = "GET,HEAD,OPTIONS,POST"
-            resp[
-                "Access-Control-Allow-Headers"
-            ] = "Origin, X-Requested-With, Content-Type, Accept, Authorization, Referer"
-            return resp
+            return _add_cors_headers(request, resp, allow_origin)
+        except Service.DoesNotExist:
+            raise Http404()
+        except ValidationError:
+            return HttpResponseBadRequest()
+
+
+class AsyncValidateServiceOriginsMixin:
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            service = await aget_service_config(self.kwargs.get("service_uuid"))
+            if service is None:
+                raise Service.DoesNotExist()
+            self.service = service
+            allow_origin = _allowed_origin(request, service)
+            if allow_origin is None:
+                return HttpResponseForbidden()
+
+            resp = await super().dispatch(request, *args, **kwargs)
+            return _add_cors_headers(request, resp, allow_origin)
         except Service.DoesNotExist:
             raise Http404()
         except ValidationError:
             return HttpResponseBadRequest()
 
 
+def _pixel_response():
+    data = base64.b64decode(
+        "R0lGODlhAQABAIAAAP///wAAACH5BAEAAAAALAAAAAABAAEAAAICRAEAOw=="
+    )
+    resp = HttpResponse(data, content_type="image/gif")
+    resp["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    resp["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+
 class PixelView(ValidateServiceOriginsMixin, View):
     # Fallback view to serve an unobtrusive 1x1 transparent tracking pixel for browsers with
     # JavaScript disabled.
@@ -93,25 +241,67 @@ class PixelView(ValidateServiceOriginsMixin, View):
         # Extract primary data
         ingress(
             self.request,
-            self.kwargs.get("service_uuid"),
+            self.service,
             self.kwargs.get("identifier", ""),
             "PIXEL",
-            {},
+            [{}],
         )
+        return _pixel_response()
+
 
-        data = base64.b64decode(
-            "R0lGODlhAQABAIAAAP///wAAACH5BAEAAAAALAAAAAABAAEAAAICRAEAOw=="
+class AsyncPixelView(AsyncValidateServiceOriginsMixin, View):
+    # Same as PixelView, but never blocks the event loop
+    async def get(self, *args, **kwargs):
+        await aingress(
+            self.request,
+            self.service,
+            self.kwargs.get("identifier", ""),
+            "PIXEL",
+            [{}],
         )
-        resp = HttpResponse(data, content_type="image/gif")
-        resp["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        resp["Access-Control-Allow-Origin"] = "*"
-        return resp
+        return _pixel_response()
 
 
-@method_decorator(csrf_exempt, name="dispatch")
-class ScriptView(ValidateServiceOriginsMixin, View):
-    def get(self, *args, **kwargs):
+def _script_cache_key(service, variant):
+    # The configuration version is part of the key, so saving a service makes its
+    # cached scripts unreachable.
+    digest = hashlib.sha256(repr((service.version, variant)).encode()).hexdigest()
+    return f"script_{service.uuid}_{digest}"
+
+
+class ScriptMixin:
+    def get_script_variant(self, service):
+        # Returns everything the rendered script depends on
         protocol = "https" if settings.SCRIPT_USE_HTTPS else "http"
+        dnt = (
+            self.request.META.get("HTTP_DNT", "0").strip() == "1"
+            and service.respect_dnt
+        )
+        site = getattr(self.request, "site", None)
+        return (
+            settings.VERSION,
+            site.domain if site is not None else "",
+            self.request.get_host(),
+            protocol,
+            self.kwargs.get("identifier"),
+            dnt,
+            settings.SCRIPT_HEARTBEAT_FREQUENCY,
+            settings.SCRIPT_HEARTBEAT_BATCH_SIZE,
+            settings.SCRIPT_TRACKING_MODE,
+            settings.SCRIPT_KEEPALIVE_FREQUENCY,
+        )
+
+    def render_script(self, service, variant):
+        (
+            *_,
+            protocol,
+            identifier,
+            dnt,
+            heartbeat_frequency,
+            heartbeat_batch_size,
+            tracking_mode,
+            keepalive_frequency,
+        ) = variant
         endpoint = (
             reverse(
                 "ingress:endpoint_script",
@@ -119,52 +309,101 @@ class ScriptView(ValidateServiceOriginsMixin, View):
                     "service_uuid": self.kwargs.get("service_uuid"),
                 },
             )
-            if self.kwargs.get("identifier") is None
+            if identifier is None
             else reverse(
                 "ingress:endpoint_script_id",
                 kwargs={
                     "service_uuid": self.kwargs.get("service_uuid"),
-                    "identifier": self.kwargs.get("identifier"),
+                    "identifier": identifier,
                 },
             )
         )
-        heartbeat_frequency = settings.SCRIPT_HEARTBEAT_FREQUENCY
-        dnt = self.request.META.get("HTTP_DNT", "0").strip() == "1"
-        service_uuid = self.kwargs.get("service_uuid")
-        service = Service.objects.get(pk=service_uuid, status=Service.ACTIVE)
-        return render(
-            self.request,
+        script = render_to_string(
             "analytics/scripts/page.js",
-            context=dict(
-                {
-                    "endpoint": endpoint,
-                    "protocol": protocol,
-                    "heartbeat_frequency": heartbeat_frequency,
-                    "script_inject": self.get_script_inject(),
-                    "dnt": dnt and service.respect_dnt,
-                }
-            ),
-            content_type="application/javascript",
+            context={
+                "endpoint": endpoint,
+                "protocol": protocol,
+                "heartbeat_frequency": heartbeat_frequency,
+                "heartbeat_batch_size": heartbeat_batch_size,
+                "tracking_mode": tracking_mode,
+                "keepalive_frequency": keepalive_frequency,
+                "script_inject": service.script_inject,
+                "dnt": dnt,
+            },
+            request=self.request,
         )
+        etag = f'"{hashlib.sha256(script.encode()).hexdigest()}"'
+        return (etag, script)
+
+    def script_response(self, etag, script):
+        resp = HttpResponse(script, content_type="application/javascript")
+        resp["ETag"] = etag
+        resp["Cache-Control"] = f"public, max-age={settings.SCRIPT_CACHE_MAX_AGE}"
+        # The script depends on DNT, and its CORS headers on the origin; shared caches
+        # must not serve one visitor's script to another
+        patch_vary_headers(resp, ["DNT", "Origin"])
+        # Answers If-None-Match with a 304 when the script did not change
+        return get_conditional_response(self.request, etag=etag, response=resp)
+
+    def parse_payloads(self):
+        return _parse_payloads(self.request.body)
+
+    def ok_response(self):
+        return HttpResponse(
+            json.dumps({"status": "OK"}), content_type="application/json"
+        )
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class ScriptView(ValidateServiceOriginsMixin, ScriptMixin, View):
+    def get(self, *args, **kwargs):
+        service = self.service
+        if not service.is_active:
+            raise Service.DoesNotExist()
+
+        variant = self.get_script_variant(service)
+        cache_key = _script_cache_key(service, variant)
+        cached = script_cache.get(cache_key, cache.get)
+        if cached is None:
+            cached = self.render_script(service, variant)
+            cache.set(cache_key, cached, timeout=SCRIPT_CACHE_TIMEOUT)
+            script_cache.set(cache_key, cached)
+        return self.script_response(*cached)
 
     def post(self, *args, **kwargs):
-        payload = json.loads(self.request.body)
         ingress(
             self.request,
-            self.kwargs.get("service_uuid"),
+            self.service,
             self.kwargs.get("identifier", ""),
             "JS",
-            payload,
-        )
-        return HttpResponse(
-            json.dumps({"status": "OK"}), content_type="application/json"
+            self.parse_payloads(),
         )
+        return self.ok_response()
 
-    def get_script_inject(self):
-        service_uuid = self.kwargs.get("service_uuid")
-        script_inject = cache.get(f"script_inject_{service_uuid}")
-        if script_inject is None:
-            service = Service.objects.get(uuid=service_uuid)
-            script_inject = service.script_inject
-            cache.set(f"script_inject_{service_uuid}", script_inject, timeout=3600)
-        return script_inject
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncScriptView(AsyncValidateServiceOriginsMixin, ScriptMixin, View):
+    # Same as ScriptView, but never blocks the event loop
+    async def get(self, *args, **kwargs):
+        service = self.service
+        if not service.is_active:
+            raise Service.DoesNotExist()
+
+        variant = self.get_script_variant(service)
+        cache_key = _script_cache_key(service, variant)
+        cached = await script_cache.aget(cache_key, cache.aget)
+        if cached is None:
+            cached = await sync_to_async(self.render_script)(service, variant)
+            await cache.aset(cache_key, cached, timeout=SCRIPT_CACHE_TIMEOUT)
+            script_cache.set(cache_key, cached)
+        return self.script_response(*cached)
+
+    async def post(self, *args, **kwargs):
+        await aingress(
+            self.request,
+            self.service,
+            self.kwargs.get("identifier", ""),
+            "JS",
+            self.parse_payloads(),
+        )
+        return self.ok_response()
@@ -0,0 +1,91 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from django.db import close_old_connections
+
+log = logging.getLogger(__name__)
+
+# How long a stopping process waits for queued events to be written, in seconds
+SHUTDOWN_TIMEOUT = 30
+
+# Tells the writer thread to stop once everything before it was written
+_STOP = object()
+
+
+class BackgroundWriter:
+    # A bounded in-memory queue of events, written in batches by a thread of this
+    # process. Lets requests return before their events reach the database when there
+    # is no Celery broker to hand them to. Events still in the queue when the process
+    # exits are written before it does (unless it is killed).
+
+    def __init__(self, write, max_size, batch_size):
+        self.write = write
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, event):
+        """Queue an event. Returns False if the queue is full."""
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # Forked from the process that started the thread (e.g. a preloading
+                # gunicorn master); the queue's contents belong to the parent.
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+                atexit.register(self.stop)
+            self._thread = threading.Thread(
+                target=self._run, name="shynet-writer", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Take whatever else is already waiting, up to a batch
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is _STOP
+            events = [event for event in batch if event is not _STOP]
+            try:
+                if len(events) > 0:
+                    self.write(events)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                close_old_connections()
+            if stopping:
+                return
+
+    def stop(self, timeout=SHUTDOWN_TIMEOUT):
+        """Write everything queued so far and stop the writer thread."""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            log.warning("Background writer did not drain before shutdown")
+            return
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            log.warning("Background writer did not drain before shutdown")
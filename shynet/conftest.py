@@ -0,0 +1,10 @@
+import pytest
+
+from shynet.test_runner import isolated_cache
+
+
+@pytest.fixture(autouse=True, scope="session")
+def _isolated_cache():
+    # Like shynet.test_runner.TestRunner does for `manage.py test`
+    with isolated_cache():
+        yield
@@ -0,0 +1,46 @@
+from django.core.cache import caches
+from redis_cache import RedisCache
+
+from .sqlite_cache import SQLiteCache
+
+
+def get_and_touch_many(keys, timeout):
+    # Returns the cached values of `keys`, resetting the timeout of those that exist.
+    # On a single Redis server or the SQLite cache this is one atomic round trip; other
+    # backends fall back to a get_many followed by a touch per key found.
+    keys = list(keys)
+    if len(keys) == 0:
+        return {}
+
+    cache = caches["default"]
+    if isinstance(cache, RedisCache):
+        versioned_keys = cache.make_keys(keys)
+        client = cache.get_client(versioned_keys[0], write=True)
+        pipeline = client.pipeline(transaction=True)
+        for key in versioned_keys:
+            pipeline.get(key)
+            pipeline.expire(key, cache.get_timeout(timeout))
+        results = pipeline.execute()
+        return {
+            key: cache.get_value(value)
+            for key, value in zip(keys, results[::2])
+            if value is not None
+        }
+
+    if isinstance(cache, SQLiteCache):
+        return cache.get_and_touch_many(keys, timeout)
+
+    found = cache.get_many(keys)
+    for key in found:
+        cache.touch(key, timeout)
+    return found
+
+
+def incr(key, delta=1, timeout=None):
+    # Increments a counter, creating it if it does not exist (or has expired)
+    cache = caches["default"]
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, timeout=timeout)
+        return cache.incr(key, delta)
@@ -0,0 +1,158 @@
+import logging
+import threading
+import time as _time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .cache import incr
+
+log = logging.getLogger(__name__)
+
+# How often each process adds its hit and miss counts to the shared totals, in seconds
+STATS_FLUSH_INTERVAL = 60
+
+
+def _stats_key(name, stat):
+    return f"local_cache_{stat}_{name}"
+
+
+class LocalCache:
+    # A small LRU of values read from the shared cache, kept in this process for at
+    # most LOCAL_CACHE_TTL seconds, in front of keys that are read far more often than
+    # they change. Changes made by other processes are seen after at most that long;
+    # keys that are versioned (like service configurations and rendered scripts)
+    # change their key instead. Only values that were found are kept, so anything
+    # missing is always looked up again.
+
+    def __init__(self, name, max_size=None, ttl=None):
+        self.name = name
+        self.max_size = settings.LOCAL_CACHE_SIZE if max_size is None else max_size
+        self.ttl = settings.LOCAL_CACHE_TTL if ttl is None else ttl
+        self._entries = OrderedDict()  # Key -> (expiry, value)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._load_time = 0  # Seconds spent loading what was missed
+        self._flushed_at = _time.monotonic()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    def _lookup(self, keys):
+        found = {}
+        now = _time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+        return found
+
+    def set_many(self, values):
+        if not self.enabled:
+            return
+        expiry = _time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = (expiry, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_many(self, keys, load_many):
+        """Returns the values of `keys`, loading those not kept here with `load_many`."""
+        if not self.enabled:
+            return load_many(keys)
+        found = self._lookup(keys)
+        missing = [key for key in keys if key not in found]
+        if len(missing) > 0:
+            started = _time.perf_counter()
+            loaded = load_many(missing)
+            self._record(len(found), len(missing), _time.perf_counter() - started)
+            self.set_many(loaded)
+            found.update(loaded)
+        else:
+            self._record(len(found), 0, 0)
+        return found
+
+    def get(self, key, load):
+        return self.get_many([key], lambda keys: _found(key, load(key))).get(key)
+
+    async def aget(self, key, aload):
+        if not self.enabled:
+            return await aload(key)
+        found = self._lookup([key])
+        if key in found:
+            self._record(1, 0, 0)
+            return found[key]
+        started = _time.perf_counter()
+        value = await aload(key)
+        self._record(0, 1, _time.perf_counter() - started)
+        self.set_many(_found(key, value))
+        return value
+
+    def _record(self, hits, misses, load_time):
+        with self._lock:
+            self._hits += hits
+            self._misses += misses
+            self._load_time += load_time
+            if _time.monotonic() - self._flushed_at < STATS_FLUSH_INTERVAL:
+                return
+            hits, misses, load_time = self._hits, self._misses, self._load_time
+            self._hits = self._misses = self._load_time = 0
+            self._flushed_at = _time.monotonic()
+        self._flush_stats(hits, misses, load_time)
+
+    def _flush_stats(self, hits, misses, load_time):
+        # What was saved is estimated from how long the misses took to load
+        saved = hits * load_time / misses if misses > 0 else 0
+        log.info(
+            f"Local cache {self.name}: {hits} hits, {misses} misses, "
+            f"~{saved * 1000:.0f}ms saved in the last {STATS_FLUSH_INTERVAL}s"
+        )
+        try:
+            incr(_stats_key(self.name, "hits"), hits)
+            incr(_stats_key(self.name, "misses"), misses)
+            incr(_stats_key(self.name, "saved_us"), int(saved * 1_000_000))
+        except Exception as e:
+            log.exception(e)
+
+
+def _found(key, value):
+    return {} if value is None else {key: value}
+
+
+def local_cache_stats(local_caches):
+    # Totals reported by every process since the shared cache was last cleared
+    stats = {}
+    for local_cache in local_caches:
+        name = local_cache.name
+        keys = [_stats_key(name, stat) for stat in ("hits", "misses", "saved_us")]
+        values = cache.get_many(keys)
+        hits, misses, saved_us = (values.get(key, 0) for key in keys)
+        stats[name] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses > 0 else 0,
+            "saved_seconds": saved_us / 1_000_000,
+        }
+    return stats
@@ -0,0 +1,224 @@
+import ipaddress
+import random
+import timeit
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from unittest import mock
+
+import redis
+
+from django.core.cache import cache, caches
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from redis_cache import RedisCache
+
+from analytics.devices import classify_user_agent, parse_user_agent
+from analytics.views.ingress import _add_cors_headers, _allowed_origin
+from core.cache import get_and_touch_many
+from core.networks import NetworkSet
+from core.origins import OriginSet
+
+
+class Command(BaseCommand):
+    help = "Runs micro-benchmarks of Shynet's performance-sensitive code"
+
+    benchmarks = ["ip_ranges", "user_agents", "cache_round_trips", "origins"]
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "benchmarks",
+            nargs="*",
+            help=f"Which benchmarks to run: {', '.join(self.benchmarks)} (default: all)",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        names = options.get("benchmarks") or self.benchmarks
+        for name in names:
+            if name not in self.benchmarks:
+                raise CommandError(f"Unknown benchmark '{name}'")
+
+        self.random = random.Random(options.get("seed"))
+        for name in names:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{name}:"))
+            getattr(self, f"benchmark_{name}")()
+
+    def report(self, label, seconds, count):
+        self.stdout.write(f"  {label}: {seconds / count * 1e6:.2f} µs per operation")
+
+    def time(self, label, function, count):
+        self.report(label, timeit.timeit(function, number=count), count)
+
+    def benchmark_ip_ranges(self):
+        networks = [
+            ipaddress.ip_network(
+                f"{ipaddress.IPv4Address(self.random.getrandbits(32))}/"
+                f"{self.random.randint(16, 32)}",
+                strict=False,
+            )
+            for _ in range(9000)
+        ] + [
+            ipaddress.ip_network(
+                f"{ipaddress.IPv6Address(self.random.getrandbits(128))}/"
+                f"{self.random.randint(32, 128)}",
+                strict=False,
+            )
+            for _ in range(1000)
+        ]
+        ips = [
+            str(ipaddress.IPv4Address(self.random.getrandbits(32))) for _ in range(1000)
+        ]
+        self.stdout.write(f"  {len(networks)} ignored networks")
+
+        self.time("compile", lambda: NetworkSet(networks), 10)
+
+        network_set = NetworkSet(networks)
+        lookups = iter(ips * 100)
+        self.time("compiled lookup", lambda: next(lookups) in network_set, 100000)
+
+        def linear_lookup(ip):
+            remote_ip = ipaddress.ip_network(ip)
+            return any(
+                network.version == remote_ip.version and network.supernet_of(remote_ip)
+                for network in networks
+            )
+
+        # Checks every network in turn, as ingestion used to
+        lookups = iter(ips)
+        self.time("linear lookup", lambda: linear_lookup(next(lookups)), 100)
+
+    def benchmark_user_agents(self):
+        user_agents = [
+            f"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+            f"(KHTML, like Gecko) Chrome/{major}.0.{self.random.randint(0, 5000)}.90 "
+            f"Safari/537.36"
+            for major in range(60, 120)
+        ]
+        lookups = iter(user_agents * 100)
+        self.time("parse", lambda: parse_user_agent(next(lookups)), 1000)
+
+        classify_user_agent.cache_clear()
+        lookups = iter(user_agents * 1000)
+        self.time("cached", lambda: classify_user_agent(next(lookups)), 10000)
+        self.stdout.write(f"  {classify_user_agent.cache_info()}")
+
+    @contextmanager
+    def count_round_trips(self):
+        # Counts the commands sent to Redis (a pipeline counts once) or, for other
+        # backends, the calls made to the cache
+        backend = caches["default"]
+        calls = []
+        depth = [0]
+
+        def counted(function):
+            def wrapper(*args, **kwargs):
+                # Only count the outermost call; some backends implement one
+                # operation in terms of another
+                if depth[0] == 0:
+                    calls.append(function.__name__)
+                depth[0] += 1
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    depth[0] -= 1
+
+            return wrapper
+
+        if isinstance(backend, RedisCache):
+            targets = [
+                (redis.Redis, "execute_command"),
+                (redis.client.Pipeline, "execute"),
+            ]
+        else:
+            targets = [
+                (backend, name) for name in ["get", "get_many", "touch", "set", "add"]
+            ]
+        patches = [
+            mock.patch.object(target, name, counted(getattr(target, name)))
+            for target, name in targets
+        ]
+        for patch in patches:
+            patch.start()
+        try:
+            yield calls
+        finally:
+            for patch in patches:
+                patch.stop()
+
+    def benchmark_cache_round_trips(self):
+        self.stdout.write(f"  backend: {caches['default'].__class__.__name__}")
+        events = 100
+        session_keys = [f"benchmark_session_association_{i}" for i in range(events)]
+        hit_keys = [f"benchmark_hit_idempotency_{i}" for i in range(events)]
+
+        def legacy(session_key, hit_key):
+            # The lookups a heartbeat used to make
+            if cache.get(session_key) is not None:
+                cache.touch(session_key, 60)
+                cache.get(session_key)
+            if cache.get(hit_key) is not None:
+                cache.touch(hit_key, 60)
+                cache.get(hit_key)
+
+        try:
+            for label, resolve in [
+                ("separate lookups", legacy),
+                ("combined lookup", lambda *keys: get_and_touch_many(keys, 60)),
+            ]:
+                cache.set_many({key: 1 for key in session_keys + hit_keys}, timeout=60)
+                pairs = iter(zip(session_keys, hit_keys))
+                with self.count_round_trips() as calls:
+                    seconds = timeit.timeit(
+                        lambda: resolve(*next(pairs)), number=events
+                    )
+                self.report(label, seconds, events)
+                self.stdout.write(
+                    f"  {label}: {len(calls) / events:.1f} round trips per event"
+                )
+        finally:
+            cache.delete_many(session_keys + hit_keys)
+
+    def benchmark_origins(self):
+        origins = [f"https://site-{i}.example.com" for i in range(150)] + [
+            f"https://*.customer-{i}.example.org" for i in range(10)
+        ]
+        raw_origins = ", ".join(self.random.sample(origins, len(origins)))
+        self.stdout.write(f"  {len(origins)} allowed origins")
+        self.time("compile", lambda: OriginSet(raw_origins), 100)
+
+        class Service:
+            # The parts of a service configuration that origin checks use
+            allowed_origins = OriginSet(raw_origins)
+
+        factory = RequestFactory()
+        requests = [
+            factory.get("/", HTTP_ORIGIN="https://site-140.example.com"),
+            factory.get("/", HTTP_ORIGIN="https://www.customer-7.example.org"),
+            factory.get("/", HTTP_REFERER="https://site-3.example.com/a/b?c=d#e"),
+            factory.get("/", HTTP_ORIGIN="https://elsewhere.example.net"),
+        ]
+        lookups = iter(requests * 25000)
+        self.time(
+            "compiled dispatch", lambda: _allowed_origin(next(lookups), Service), 100000
+        )
+
+        def legacy_allowed_origin(request):
+            # Parses the origins on every request, as dispatch used to
+            remote_origin = request.META.get("HTTP_ORIGIN")
+            if remote_origin is None and request.META.get("HTTP_REFERER") is not None:
+                parsed = urlparse(request.META.get("HTTP_REFERER"))
+                remote_origin = f"{parsed.scheme}://{parsed.netloc}".lower()
+            allowed = [origin.strip().lower() for origin in raw_origins.split(",")]
+            return remote_origin if remote_origin in allowed else None
+
+        lookups = iter(requests * 2500)
+        self.time(
+            "legacy dispatch", lambda: legacy_allowed_origin(next(lookups)), 10000
+        )
+
+        response = {}
+        self.time(
+            "CORS headers",
+            lambda: _add_cors_headers(requests[0], response, "https://a.example.com"),
+            100000,
+        )
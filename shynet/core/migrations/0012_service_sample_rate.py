@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:45
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0011_merge_20220919_0615"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="service",
+            name="sample_rate",
+            field=models.FloatField(
+                default=1.0,
+                validators=[
+                    django.core.validators.MinValueValidator(0.0001),
+                    django.core.validators.MaxValueValidator(1.0),
+                ],
+                verbose_name="Sample rate",
+            ),
+        ),
+    ]
@@ -8,20 +8,40 @@ from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models.functions import TruncDate, TruncHour
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import models, transaction
+from django.db.models.functions import Cast, Round, TruncDate, TruncHour
+from django.db.models.signals import post_delete, post_save
 from django.db.utils import NotSupportedError
+from django.dispatch import receiver
 from django.shortcuts import reverse
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .service_config import invalidate_service_config
+
 # How long a session a needs to go without an update to no longer be considered 'active' (i.e., currently online)
-ACTIVE_USER_TIMEDELTA = timezone.timedelta(
-    milliseconds=settings.SCRIPT_HEARTBEAT_FREQUENCY * 2
-)
+if settings.SCRIPT_TRACKING_MODE == "visibility":
+    ACTIVE_USER_TIMEDELTA = timezone.timedelta(
+        milliseconds=settings.SCRIPT_KEEPALIVE_FREQUENCY * 2
+    )
+else:
+    ACTIVE_USER_TIMEDELTA = timezone.timedelta(
+        milliseconds=settings.SCRIPT_HEARTBEAT_FREQUENCY
+        * (settings.SCRIPT_HEARTBEAT_BATCH_SIZE + 1)
+    )
 RESULTS_LIMIT = 300
 
 
+def weighted_count():
+    # Counts sessions or hits, each standing for as many as its sample weight
+    return Cast(Round(models.Sum("sample_weight")), models.IntegerField())
+
+
+def _weighted_total(queryset):
+    return queryset.aggregate(count=weighted_count())["count"] or 0
+
+
 def _default_uuid():
     return str(uuid.uuid4())
 
@@ -107,6 +127,11 @@ class Service(models.Model):
     script_inject = models.TextField(
         default="", blank=True, verbose_name=_("Script inject")
     )
+    sample_rate = models.FloatField(
+        default=1.0,
+        validators=[MinValueValidator(0.0001), MaxValueValidator(1.0)],
+        verbose_name=_("Sample rate"),
+    )
 
     class Meta:
         verbose_name = _("Service")
@@ -156,28 +181,30 @@ class Service(models.Model):
 
         tz_now = timezone.now()
 
-        currently_online = Session.objects.filter(
-            service=self, last_seen__gt=tz_now - ACTIVE_USER_TIMEDELTA
-        ).count()
+        currently_online = _weighted_total(
+            Session.objects.filter(
+                service=self, last_seen__gt=tz_now - ACTIVE_USER_TIMEDELTA
+            )
+        )
 
         sessions = Session.objects.filter(
             service=self, start_time__gt=start_time, start_time__lt=end_time
         ).order_by("-start_time")
-        session_count = sessions.count()
+        session_count = _weighted_total(sessions)
 
         hits = Hit.objects.filter(
             service=self, start_time__lt=end_time, start_time__gt=start_time
         )
-        hit_count = hits.count()
+        hit_count = _weighted_total(hits)
 
         has_hits = Hit.objects.filter(service=self).exists()
 
         bounces = sessions.filter(is_bounce=True)
-        bounce_count = bounces.count()
+        bounce_count = _weighted_total(bounces)
 
         locations = (
             hits.values("location")
-            .annotate(count=models.Count("location"))
+            .annotate(count=weighted_count())
             .order_by("-count")[:RESULTS_LIMIT]
         )
 
@@ -187,7 +214,7 @@ class Service(models.Model):
             for referrer in (
                 hits.filter(initial=True)
                 .values("referrer")
-                .annotate(count=models.Count("referrer"))
+                .annotate(count=weighted_count())
                 .order_by("-count")[:RESULTS_LIMIT]
             )
             if not referrer_ignore.match(referrer["referrer"])
@@ -195,37 +222,41 @@ class Service(models.Model):
 
         countries = (
             sessions.values("country")
-            .annotate(count=models.Count("country"))
+            .annotate(count=weighted_count())
             .order_by("-count")[:RESULTS_LIMIT]
         )
 
         operating_systems = (
             sessions.values("os")
-            .annotate(count=models.Count("os"))
+            .annotate(count=weighted_count())
             .order_by("-count")[:RESULTS_LIMIT]
         )
 
         browsers = (
             sessions.values("browser")
-            .annotate(count=models.Count("browser"))
+            .annotate(count=weighted_count())
             .order_by("-count")[:RESULTS_LIMIT]
         )
 
         device_types = (
             sessions.values("device_type")
-            .annotate(count=models.Count("device_type"))
+            .annotate(count=weighted_count())
             .order_by("-count")[:RESULTS_LIMIT]
         )
 
         devices = (
             sessions.values("device")
-            .annotate(count=models.Count("device"))
+            .annotate(count=weighted_count())
             .order_by("-count")[:RESULTS_LIMIT]
         )
 
-        avg_load_time = hits.aggregate(load_time__avg=models.Avg("load_time"))[
-            "load_time__avg"
-        ]
+        load_times = hits.filter(load_time__isnull=False).aggregate(
+            total=models.Sum(models.F("load_time") * models.F("sample_weight")),
+            weight=models.Sum("sample_weight"),
+        )
+        avg_load_time = (
+            load_times["total"] / load_times["weight"] if load_times["weight"] else None
+        )
 
         avg_hits_per_session = hit_count / session_count if session_count > 0 else None
 
@@ -260,19 +291,31 @@ class Service(models.Model):
         }
 
     def _get_avg_session_duration(self, sessions, session_count):
+        # Weighted, as each session stands for as many as its sample weight
+        if session_count == 0:
+            return None
         try:
-            avg_session_duration = sessions.annotate(
+            totals = sessions.annotate(
                 duration=models.F("last_seen") - models.F("start_time")
-            ).aggregate(time_delta=models.Avg("duration"))["time_delta"]
+            ).aggregate(
+                time_delta=models.Sum(
+                    models.ExpressionWrapper(
+                        models.F("duration") * models.F("sample_weight"),
+                        output_field=models.DurationField(),
+                    )
+                ),
+                weight=models.Sum("sample_weight"),
+            )
+            avg_session_duration = totals["time_delta"] / totals["weight"]
         except NotSupportedError:
+            sessions = list(sessions)
             avg_session_duration = sum(
                 [
                     (session.last_seen - session.start_time).total_seconds()
+                    * session.sample_weight
                     for session in sessions
                 ]
-            ) / max(session_count, 1)
-        if session_count == 0:
-            avg_session_duration = None
+            ) / max(sum([session.sample_weight for session in sessions]), 1)
 
         return avg_session_duration
 
@@ -284,7 +327,7 @@ class Service(models.Model):
             sessions_per_hour = (
                 sessions.annotate(hour=TruncHour("start_time"))
                 .values("hour")
-                .annotate(count=models.Count("uuid"))
+                .annotate(count=weighted_count())
                 .order_by("hour")
             )
             chart_data = {
@@ -294,7 +337,7 @@ class Service(models.Model):
             hits_per_hour = (
                 hits.annotate(hour=TruncHour("start_time"))
                 .values("hour")
-                .annotate(count=models.Count("id"))
+                .annotate(count=weighted_count())
                 .order_by("hour")
             )
             for k in hits_per_hour:
@@ -314,7 +357,7 @@ class Service(models.Model):
             sessions_per_day = (
                 sessions.annotate(date=TruncDate("start_time"))
                 .values("date")
-                .annotate(count=models.Count("uuid"))
+                .annotate(count=weighted_count())
                 .order_by("date")
             )
             chart_data = {
@@ -323,7 +366,7 @@ class Service(models.Model):
             hits_per_day = (
                 hits.annotate(date=TruncDate("start_time"))
                 .values("date")
-                .annotate(count=models.Count("id"))
+                .annotate(count=weighted_count())
                 .order_by("date")
             )
             for k in hits_per_day:
@@ -351,3 +394,12 @@ class Service(models.Model):
             "dashboard:service",
             kwargs={"pk": self.pk},
         )
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def _invalidate_service_config(sender, instance, **kwargs):
+    # Signals also fire for services deleted in bulk (as by the admin) or along with
+    # their owner. Wait for the commit so that no process reloads the old configuration.
+    pk = instance.pk
+    transaction.on_commit(lambda: invalidate_service_config(pk))
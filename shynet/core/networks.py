@@ -0,0 +1,37 @@
+import ipaddress
+from bisect import bisect_right
+
+
+class NetworkSet:
+    # A set of IP networks compiled into sorted, non-overlapping integer intervals
+    # (one list per IP version), so that membership takes a binary search instead of
+    # a comparison against every network.
+
+    def __init__(self, networks=()):
+        ranges = {4: [], 6: []}
+        for network in networks:
+            ranges[network.version].append(
+                (int(network.network_address), int(network.broadcast_address))
+            )
+
+        self._starts = {}
+        self._ends = {}
+        for version, intervals in ranges.items():
+            merged = []
+            for start, end in sorted(intervals):
+                if len(merged) > 0 and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self._starts[version] = [start for start, end in merged]
+            self._ends[version] = [end for start, end in merged]
+
+    def __contains__(self, ip):
+        # Raises ValueError if `ip` is not a valid IP address
+        address = ipaddress.ip_address(ip)
+        value = int(address)
+        index = bisect_right(self._starts[address.version], value) - 1
+        return index >= 0 and value <= self._ends[address.version][index]
+
+    def __len__(self):
+        return len(self._starts[4]) + len(self._starts[6])
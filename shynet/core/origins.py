@@ -0,0 +1,51 @@
+import re
+
+# The origin of a URL: its scheme and authority, without a path, query or fragment
+_URL_ORIGIN = re.compile(r"[^:/?#]+://[^/?#]*")
+
+
+def url_origin(url):
+    # Returns the lowercased origin of a URL (such as a Referer), or None if it has
+    # none. Equivalent to joining urlparse's scheme and netloc, without the rest of
+    # the parsing.
+    match = _URL_ORIGIN.match(url)
+    return match.group(0).lower() if match is not None else None
+
+
+class OriginSet:
+    # The origins a service accepts, parsed once: exact origins in a frozenset, and
+    # wildcard subdomain patterns (like "https://*.example.com") compiled into a
+    # single regular expression. Only a value of exactly "*" accepts every origin; a
+    # bare "*" within a list of origins is ignored.
+
+    def __init__(self, origins):
+        exact = set()
+        patterns = []
+        self.allows_any = origins.strip() == "*"
+        for origin in origins.split(","):
+            origin = origin.strip().lower()
+            if origin == "*":
+                continue
+            elif "*" in origin:
+                # Each wildcard stands for one or more labels of a host name
+                patterns.append(
+                    re.escape(origin).replace(r"\*", r"[a-z0-9-]+(?:\.[a-z0-9-]+)*")
+                )
+            elif origin != "":
+                exact.add(origin)
+        self.exact = frozenset(exact)
+        self.wildcards = len(patterns)
+        self._pattern = (
+            re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+            if len(patterns) > 0
+            else None
+        )
+
+    def __contains__(self, origin):
+        # Expects a lowercased origin
+        if self.allows_any or origin in self.exact:
+            return True
+        return self._pattern is not None and self._pattern.fullmatch(origin) is not None
+
+    def __len__(self):
+        return len(self.exact) + self.wildcards
@@ -0,0 +1,92 @@
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.core.cache import cache
+
+from .local_cache import LocalCache
+from .networks import NetworkSet
+from .origins import OriginSet
+
+# Snapshots of service configuration, kept for the lifetime of the process. Each
+# snapshot is tagged with the version that was current in the cache when it was
+# loaded; saving or deleting a service bumps that version, which makes every process
+# reload its snapshot on next use.
+_configs = {}
+
+# The versions themselves are checked in the shared cache at most once per
+# LOCAL_CACHE_TTL seconds, so changes reach other processes after at most that long
+config_versions = LocalCache("service_config_versions")
+
+
+class ServiceConfig:
+    # The parts of a service that ingestion needs, already parsed. Attribute names
+    # mirror those of Service.
+
+    def __init__(self, service, version):
+        self.version = version
+        self.uuid = str(service.uuid)
+        self.name = service.name
+        self.status = service.status
+        self.is_active = service.status == service.ACTIVE
+        self.respect_dnt = service.respect_dnt
+        self.ignore_robots = service.ignore_robots
+        self.collect_ips = service.collect_ips
+        self.origins = service.origins
+        self.allowed_origins = OriginSet(service.origins)
+        self.script_inject = service.script_inject
+        self.sample_rate = service.sample_rate
+        self.ignored_networks = NetworkSet(service.get_ignored_networks())
+        self.ignored_referrer_regex = service.get_ignored_referrer_regex()
+
+    @property
+    def pk(self):
+        return self.uuid
+
+    def __str__(self):
+        return self.name
+
+
+def _version_key(service_uuid):
+    return f"service_config_version_{service_uuid}"
+
+
+def get_service_config(service_uuid):
+    # Returns the current configuration of a service, or None if it does not exist.
+    # Only touches the database when the service changed since it was last loaded.
+    service_uuid = str(service_uuid)
+    version = config_versions.get(_version_key(service_uuid), cache.get)
+    config = _configs.get(service_uuid)
+    if config is not None and version is not None and config.version == version:
+        return config
+
+    Service = apps.get_model("core", "Service")
+    service = Service.objects.filter(pk=service_uuid).first()
+    if service is None:
+        return None
+    if version is None:
+        version = uuid4().hex
+        if not cache.add(_version_key(service_uuid), version, timeout=None):
+            # Another process got there first
+            version = cache.get(_version_key(service_uuid), version)
+        config_versions.set(_version_key(service_uuid), version)
+    config = ServiceConfig(service, version)
+    _configs[service_uuid] = config
+    return config
+
+
+async def aget_service_config(service_uuid):
+    # Async version of get_service_config. Only the version check is done on the event
+    # loop; reloading a changed service happens in a worker thread.
+    service_uuid = str(service_uuid)
+    version = await config_versions.aget(_version_key(service_uuid), cache.aget)
+    config = _configs.get(service_uuid)
+    if config is not None and version is not None and config.version == version:
+        return config
+    return await sync_to_async(get_service_config)(service_uuid)
+
+
+def invalidate_service_config(service_uuid):
+    cache.set(_version_key(service_uuid), uuid4().hex, timeout=None)
+    config_versions.delete(_version_key(service_uuid))
+    _configs.pop(str(service_uuid), None)
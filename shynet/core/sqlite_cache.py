@@ -0,0 +1,303 @@
+import os
+import pickle
+import sqlite3
+import stat
+import threading
+import time as _time
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.exceptions import ImproperlyConfigured
+
+# How many writes a process makes between removing expired entries
+CULL_INTERVAL = 1000
+# How long to wait for another process holding the write lock, in seconds
+BUSY_TIMEOUT = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+"""
+
+# Updates that return what they changed, and upserts, need SQLite 3.35. Older versions
+# (such as those of Debian 11 or Ubuntu 20.04) read and write in a transaction instead.
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35)
+
+# Entries that are still valid at a point in time (the only parameter)
+_ALIVE = "(expires IS NULL OR expires > ?)"
+
+
+def _check_private(location):
+    # Values are pickled, and loading a pickle can run any code. So only use a database
+    # that nobody but this user can write to, or replace: created with private
+    # permissions, and in a directory that others can't swap files in.
+    directory = os.path.dirname(os.path.abspath(location))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    directory_stat = os.stat(directory)
+    if directory_stat.st_uid not in (0, os.geteuid()) or (
+        directory_stat.st_mode & 0o022 and not directory_stat.st_mode & stat.S_ISVTX
+    ):
+        raise ImproperlyConfigured(
+            f"Others can replace files in {directory}; choose another location for "
+            "the cache"
+        )
+    fd = os.open(location, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    os.close(fd)
+    for path in (location, f"{location}-wal", f"{location}-shm"):
+        try:
+            file_stat = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if file_stat.st_uid != os.geteuid() or file_stat.st_mode & 0o022:
+            raise ImproperlyConfigured(
+                f"{path} must be owned by this user and writable by nobody else"
+            )
+
+
+def _dumps(value):
+    # Integers are stored as they are, so that they can be incremented in place
+    if type(value) is int:
+        return value
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(value):
+    if isinstance(value, int):
+        return value
+    return pickle.loads(value)
+
+
+class SQLiteCache(BaseCache):
+    # A cache shared by every process on a host, kept in a SQLite database in WAL mode
+    # (so that readers never wait for writers). Lets gunicorn and Celery workers share
+    # sessions, idempotency keys and the like without running Redis. LOCATION is the
+    # path of the database file, which is created (readable by this user only) if it
+    # does not exist.
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.location = location
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        _check_private(self.location)
+        connection = sqlite3.connect(
+            self.location,
+            timeout=BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Commits survive crashes of the process; only losing power can lose the
+        # latest ones, which is fine for a cache
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(_SCHEMA)
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def _expires(self, timeout):
+        # None never expires; entries set with a timeout of 0 or less are expired
+        return self.get_backend_timeout(timeout)
+
+    @contextmanager
+    def _transaction(self, connection):
+        # Takes the write lock right away, so that what is read stays valid
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _after_write(self, connection):
+        self._writes += 1
+        if self._writes % CULL_INTERVAL == 0:
+            self._cull(connection)
+
+    def _cull(self, connection):
+        connection.execute(
+            "DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?",
+            (_time.time(),),
+        )
+        count = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self._max_entries:
+            # Like the other backends, drop a share of the entries: those expiring first
+            connection.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY expires IS NULL, expires LIMIT ?)",
+                (count // self._cull_frequency,),
+            )
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = (
+            self._connection()
+            .execute(
+                f"SELECT value FROM cache WHERE key = ? AND {_ALIVE}",
+                (key, _time.time()),
+            )
+            .fetchone()
+        )
+        return default if row is None else _loads(row[0])
+
+    def get_many(self, keys, version=None):
+        keys = {self.make_and_validate_key(key, version=version): key for key in keys}
+        if len(keys) == 0:
+            return {}
+        placeholders = ", ".join("?" * len(keys))
+        rows = self._connection().execute(
+            f"SELECT key, value FROM cache WHERE key IN ({placeholders}) AND {_ALIVE}",
+            (*keys, _time.time()),
+        )
+        return {keys[key]: _loads(value) for key, value in rows}
+
+    def get_and_touch_many(self, keys, timeout=DEFAULT_TIMEOUT, version=None):
+        # Like get_many, also resetting the timeout of the keys found, in a single
+        # statement
+        keys = {self.make_and_validate_key(key, version=version): key for key in keys}
+        if len(keys) == 0:
+            return {}
+        placeholders = ", ".join("?" * len(keys))
+        connection = self._connection()
+        if _HAS_RETURNING:
+            rows = connection.execute(
+                f"UPDATE cache SET expires = ? "
+                f"WHERE key IN ({placeholders}) AND {_ALIVE} RETURNING key, value",
+                (self._expires(timeout), *keys, _time.time()),
+            ).fetchall()
+        else:
+            with self._transaction(connection):
+                rows = connection.execute(
+                    f"SELECT key, value FROM cache "
+                    f"WHERE key IN ({placeholders}) AND {_ALIVE}",
+                    (*keys, _time.time()),
+                ).fetchall()
+                connection.executemany(
+                    "UPDATE cache SET expires = ? WHERE key = ?",
+                    [(self._expires(timeout), key) for key, _ in rows],
+                )
+        return {keys[key]: _loads(value) for key, value in rows}
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = (
+            self._connection()
+            .execute(
+                f"SELECT 1 FROM cache WHERE key = ? AND {_ALIVE}", (key, _time.time())
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, _dumps(value), self._expires(timeout)),
+        )
+        self._after_write(connection)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self._expires(timeout)
+        rows = [
+            (self.make_and_validate_key(key, version=version), _dumps(value), expires)
+            for key, value in data.items()
+        ]
+        connection = self._connection()
+        with self._transaction(connection):
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                rows,
+            )
+        self._after_write(connection)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # Only replaces an entry that expired; atomic, as it is a single statement (or
+        # a transaction)
+        key = self.make_and_validate_key(key, version=version)
+        connection = self._connection()
+        row = (key, _dumps(value), self._expires(timeout))
+        if _HAS_RETURNING:
+            cursor = connection.execute(
+                "INSERT INTO cache (key, value, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, "
+                "expires = excluded.expires "
+                "WHERE cache.expires IS NOT NULL AND cache.expires <= ?",
+                (*row, _time.time()),
+            )
+        else:
+            with self._transaction(connection):
+                connection.execute(
+                    "DELETE FROM cache "
+                    "WHERE key = ? AND expires IS NOT NULL AND expires <= ?",
+                    (key, _time.time()),
+                )
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO cache (key, value, expires) "
+                    "VALUES (?, ?, ?)",
+                    row,
+                )
+        self._after_write(connection)
+        return cursor.rowcount > 0
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection().execute(
+            f"UPDATE cache SET expires = ? WHERE key = ? AND {_ALIVE}",
+            (self._expires(timeout), key, _time.time()),
+        )
+        return cursor.rowcount > 0
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = self._connection()
+        if _HAS_RETURNING:
+            row = connection.execute(
+                f"UPDATE cache SET value = value + ? WHERE key = ? AND {_ALIVE} "
+                "AND typeof(value) = 'integer' RETURNING value",
+                (delta, key, _time.time()),
+            ).fetchone()
+        else:
+            with self._transaction(connection):
+                row = connection.execute(
+                    f"SELECT value + ? FROM cache WHERE key = ? AND {_ALIVE} "
+                    "AND typeof(value) = 'integer'",
+                    (delta, key, _time.time()),
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE cache SET value = ? WHERE key = ?", (row[0], key)
+                    )
+        if row is None:
+            raise ValueError(f"Key '{key}' not found")
+        return row[0]
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+        return cursor.rowcount > 0
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        if len(keys) == 0:
+            return
+        placeholders = ", ".join("?" * len(keys))
+        self._connection().execute(
+            f"DELETE FROM cache WHERE key IN ({placeholders})", keys
+        )
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
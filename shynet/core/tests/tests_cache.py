@@ -0,0 +1,64 @@
+import time
+from unittest import mock
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+from redis_cache import RedisCache
+
+from core.cache import get_and_touch_many
+
+
+class GetAndTouchManyTests(SimpleTestCase):
+    def use_cache(self, backend):
+        patcher = mock.patch("core.cache.caches", {"default": backend})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tests_fallback(self):
+        """
+        GIVEN: A cache backend without a single round trip for this, with two keys
+        WHEN: They and a missing key are read and touched before they expire
+        THEN: Only the keys found are returned, and they live on past their timeout
+        """
+        backend = LocMemCache("get-and-touch", {})
+        self.use_cache(backend)
+        backend.set("session", "abc", timeout=10)
+        backend.set("hit", ("abc", 1), timeout=10)
+        now = time.time()
+
+        with mock.patch("time.time", return_value=now + 5):
+            found = get_and_touch_many(["session", "hit", "missing"], 60)
+        self.assertEqual(found, {"session": "abc", "hit": ("abc", 1)})
+        with mock.patch("time.time", return_value=now + 30):
+            self.assertEqual(backend.get_many(["session", "hit"]), found)
+        self.assertEqual(get_and_touch_many([], 60), {})
+
+    def tests_redis(self):
+        """
+        GIVEN: A Redis cache with two of three keys
+        WHEN: They are read and touched
+        THEN: Every key is read and touched in one transaction, and only the keys found
+              are returned
+        """
+        backend = mock.create_autospec(RedisCache, instance=True)
+        backend.make_keys.side_effect = lambda keys: [f"v1_{key}" for key in keys]
+        backend.get_timeout.return_value = 60
+        backend.get_value.side_effect = lambda value: value.decode()
+        client = backend.get_client.return_value
+        pipeline = client.pipeline.return_value
+        pipeline.execute.return_value = [b"abc", True, None, False, b"1", True]
+        self.use_cache(backend)
+
+        found = get_and_touch_many(["session", "missing", "hit"], 60)
+
+        self.assertEqual(found, {"session": "abc", "hit": "1"})
+        client.pipeline.assert_called_once_with(transaction=True)
+        pipeline.execute.assert_called_once_with()
+        self.assertEqual(
+            pipeline.mock_calls[:-1],
+            [
+                call
+                for key in ["v1_session", "v1_missing", "v1_hit"]
+                for call in [mock.call.get(key), mock.call.expire(key, 60)]
+            ],
+        )
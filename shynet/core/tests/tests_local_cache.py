@@ -0,0 +1,70 @@
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from core.local_cache import STATS_FLUSH_INTERVAL, LocalCache, local_cache_stats
+
+
+class LocalCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.local = LocalCache("test", max_size=2, ttl=10)
+        self.loads = []
+
+    def load_many(self, keys):
+        self.loads.append(list(keys))
+        return {key: key.upper() for key in keys if key != "missing"}
+
+    def tests_values_are_kept_until_they_expire(self):
+        """
+        GIVEN: Values loaded through a local cache
+        WHEN: They are read again before and after the TTL passed
+        THEN: They are only loaded again after it passed, and misses are never kept
+        """
+        now = time.monotonic()
+        with mock.patch("time.monotonic", return_value=now):
+            self.assertEqual(
+                self.local.get_many(["a", "missing"], self.load_many), {"a": "A"}
+            )
+            self.assertEqual(
+                self.local.get_many(["a", "missing"], self.load_many), {"a": "A"}
+            )
+        with mock.patch("time.monotonic", return_value=now + 11):
+            self.assertEqual(self.local.get("a", lambda key: "new"), "new")
+
+        self.assertEqual(self.loads, [["a", "missing"], ["missing"]])
+
+    def tests_least_recently_used_are_evicted(self):
+        """
+        GIVEN: A full local cache
+        WHEN: Another value is added
+        THEN: The value that was used least recently is dropped
+        """
+        self.local.get_many(["a", "b"], self.load_many)
+        self.local.get_many(["a"], self.load_many)
+        self.local.set("c", "C")
+        self.loads.clear()
+
+        self.local.get_many(["a", "b", "c"], self.load_many)
+
+        self.assertEqual(self.loads, [["b"]])
+
+    def tests_stats_are_shared(self):
+        """
+        GIVEN: A local cache with hits and misses
+        WHEN: Its stats are flushed
+        THEN: The totals can be read back from the shared cache
+        """
+        self.local.get_many(["a", "b"], self.load_many)
+        self.local.get_many(["a", "b"], self.load_many)
+        with mock.patch(
+            "time.monotonic", return_value=time.monotonic() + STATS_FLUSH_INTERVAL
+        ):
+            self.local.get_many(["a"], self.load_many)
+
+        stats = local_cache_stats([self.local])["test"]
+        # The last lookup came after the TTL, so it was a miss too
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 3))
+        self.assertEqual(stats["hit_ratio"], 0.4)
@@ -0,0 +1,52 @@
+import ipaddress
+import random
+
+from django.test import SimpleTestCase
+
+from core.models import _parse_network_list
+from core.networks import NetworkSet
+
+
+class NetworkSetTests(SimpleTestCase):
+    def tests_membership(self):
+        """
+        GIVEN: A set of overlapping IPv4 and IPv6 networks
+        WHEN: Addresses inside, outside and on the edges are checked
+        THEN: Only addresses inside a network are members
+        """
+        networks = NetworkSet(
+            _parse_network_list("10.0.0.0/8, 10.1.0.0/16, 192.168.1.1, 2001:db8::/32")
+        )
+
+        self.assertIn("10.0.0.0", networks)
+        self.assertIn("10.255.255.255", networks)
+        self.assertIn("192.168.1.1", networks)
+        self.assertIn("2001:db8::1", networks)
+        self.assertNotIn("11.0.0.0", networks)
+        self.assertNotIn("192.168.1.2", networks)
+        self.assertNotIn("2001:db9::", networks)
+        self.assertEqual(len(networks), 3)
+        with self.assertRaises(ValueError):
+            "not an ip" in networks
+
+    def tests_matches_linear_search(self):
+        """
+        GIVEN: Many random networks
+        WHEN: Random addresses are checked
+        THEN: The result matches checking every network in turn
+        """
+        rng = random.Random(0)
+        networks = [
+            ipaddress.ip_network(
+                f"{ipaddress.IPv4Address(rng.getrandbits(32))}/{rng.randint(8, 32)}",
+                strict=False,
+            )
+            for _ in range(200)
+        ]
+        network_set = NetworkSet(networks)
+
+        for _ in range(2000):
+            ip = ipaddress.IPv4Address(rng.getrandbits(32))
+            self.assertEqual(
+                ip in network_set, any(ip in network for network in networks)
+            )
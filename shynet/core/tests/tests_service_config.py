@@ -0,0 +1,75 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from core.factories import ServiceFactory, UserFactory
+from core.models import Service
+from core.service_config import get_service_config
+
+
+class ServiceConfigTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service = ServiceFactory(
+                owner=UserFactory(), ignored_ips="10.0.0.0/8", origins="*"
+            )
+
+    def tests_config_is_loaded_once(self):
+        """
+        GIVEN: A service whose configuration was already loaded
+        WHEN: Its configuration is requested again
+        THEN: The database is not queried
+        """
+        config = get_service_config(self.service.uuid)
+        self.assertEqual(len(config.ignored_networks), 1)
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_service_config(self.service.uuid), config)
+
+    def tests_config_is_reloaded_after_save(self):
+        """
+        GIVEN: A service whose configuration was already loaded
+        WHEN: The service is changed and saved
+        THEN: The new configuration is returned
+        """
+        get_service_config(self.service.uuid)
+
+        self.service.origins = "https://example.com"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.save()
+
+        self.assertEqual(
+            get_service_config(self.service.uuid).origins, "https://example.com"
+        )
+
+    def tests_deleted_service_has_no_config(self):
+        """
+        GIVEN: A service whose configuration was already loaded
+        WHEN: The service is deleted
+        THEN: No configuration is returned
+        """
+        service_uuid = self.service.uuid
+        get_service_config(service_uuid)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.delete()
+
+        self.assertIsNone(get_service_config(service_uuid))
+
+    def tests_services_deleted_in_bulk_have_no_config(self):
+        """
+        GIVEN: Services whose configurations were already loaded
+        WHEN: One is deleted through a queryset (as by the admin), and the other's
+              owner is deleted
+        THEN: No configuration is returned for either
+        """
+        other = ServiceFactory(owner=UserFactory())
+        for service in (self.service, other):
+            get_service_config(service.uuid)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Service.objects.filter(pk=self.service.pk).delete()
+            other.owner.delete()
+
+        self.assertIsNone(get_service_config(self.service.uuid))
+        self.assertIsNone(get_service_config(other.uuid))
@@ -0,0 +1,126 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase
+
+from core.sqlite_cache import SQLiteCache
+
+
+class SQLiteCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.location = os.path.join(directory.name, "cache.sqlite3")
+        self.cache = self.new_cache()
+
+    def new_cache(self):
+        # A separate instance has its own connections, like another process would
+        return SQLiteCache(self.location, {"KEY_PREFIX": "test"})
+
+    def tests_shared_between_instances(self):
+        """
+        GIVEN: Two caches on the same database
+        WHEN: Values are set, incremented and deleted through one of them
+        THEN: The other sees every change
+        """
+        other = self.new_cache()
+        self.cache.set("session", ("abc", 1), timeout=60)
+        self.cache.set("count", 1, timeout=60)
+        self.assertEqual(other.get("session"), ("abc", 1))
+        self.assertEqual(other.incr("count", 2), 3)
+        self.assertEqual(self.cache.get("count"), 3)
+        other.delete("session")
+        self.assertIsNone(self.cache.get("session"))
+        with self.assertRaises(ValueError):
+            self.cache.incr("missing")
+
+    def tests_timeouts(self):
+        """
+        GIVEN: Entries with and without a timeout
+        WHEN: The timeout passes, with one of them touched before it does
+        THEN: Only the untouched entry with a timeout expires, and can be added again
+        """
+        self.cache.set("expiring", 1, timeout=10)
+        self.cache.set("touched", 2, timeout=10)
+        self.cache.set("forever", 3, timeout=None)
+        later = time.time() + 5
+        with mock.patch("time.time", return_value=later):
+            self.assertEqual(
+                self.cache.get_and_touch_many(["touched", "missing"], 60),
+                {"touched": 2},
+            )
+        with mock.patch("time.time", return_value=later + 10):
+            self.assertEqual(
+                self.cache.get_many(["expiring", "touched", "forever"]),
+                {"touched": 2, "forever": 3},
+            )
+            self.assertFalse(self.cache.has_key("expiring"))
+            self.assertTrue(self.cache.add("expiring", 4, timeout=10))
+            self.assertEqual(self.cache.get("expiring"), 4)
+
+    def tests_add_is_atomic(self):
+        """
+        GIVEN: Several threads, each with its own cache on the same database
+        WHEN: They all add the same key at once
+        THEN: Exactly one of them succeeds
+        """
+        caches = [self.new_cache() for _ in range(8)]
+        barrier = threading.Barrier(len(caches))
+        results = []
+
+        def add(cache):
+            barrier.wait()
+            results.append(cache.add("claim", 1, timeout=60))
+
+        threads = [threading.Thread(target=add, args=(c,)) for c in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), [False] * 7 + [True])
+
+    def tests_database_is_private(self):
+        """
+        GIVEN: A location for a new database
+        WHEN: The cache is first used
+        THEN: Only this user can read or write the database and its directory
+        """
+        location = os.path.join(self.location + ".d", "cache.sqlite3")
+        cache = SQLiteCache(location, {})
+        cache.set("key", "value")
+
+        self.assertEqual(os.stat(location).st_mode & 0o777, 0o600)
+        self.assertEqual(os.stat(os.path.dirname(location)).st_mode & 0o777, 0o700)
+
+    def tests_shared_database_is_refused(self):
+        """
+        GIVEN: A database that others can write to, or a directory in which they can
+               replace it
+        WHEN: The cache is used
+        THEN: It refuses to load anything from it
+        """
+        with open(self.location, "w"):
+            pass
+        os.chmod(self.location, 0o666)
+        with self.assertRaises(ImproperlyConfigured):
+            self.cache.get("key")
+
+        directory = os.path.join(os.path.dirname(self.location), "shared")
+        os.mkdir(directory)
+        os.chmod(directory, 0o777)
+        with self.assertRaises(ImproperlyConfigured):
+            SQLiteCache(os.path.join(directory, "cache.sqlite3"), {}).get("key")
+
+
+class LegacySQLiteCacheTests(SQLiteCacheTests):
+    # The same, on versions of SQLite without UPDATE ... RETURNING
+    def setUp(self):
+        patcher = mock.patch("core.sqlite_cache._HAS_RETURNING", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
@@ -21,6 +21,7 @@ class ServiceForm(forms.ModelForm):
             "origins",
             "collaborators",
             "script_inject",
+            "sample_rate",
         ]
         widgets = {
             "name": forms.TextInput(),
@@ -45,13 +46,14 @@ class ServiceForm(forms.ModelForm):
             "ignore_robots": _("Ignore robots"),
             "hide_referrer_regex": _("Hide specific referrers"),
             "script_inject": _("Additional injected JS"),
+            "sample_rate": _("Sample rate"),
         }
         help_texts = {
             "name": _("What should the service be called?"),
             "link": _("What's the service's primary URL?"),
             "favicon": _("What's the service's favicon URL?"),
             "origins": _(
-                "At what origins does the service operate? Use commas to separate multiple values. This sets CORS headers, so use '*' if you're not sure (or don't care)."
+                "At what origins does the service operate? Use commas to separate multiple values, and '*' for any subdomain (e.g., 'https://*.example.com'). This sets CORS headers, so use '*' if you're not sure (or don't care)."
             ),
             "respect_dnt": _(
                 "Should visitors who have enabled <a href='https://en.wikipedia.org/wiki/Do_Not_Track'>Do Not Track</a> be excluded from all data?"
@@ -68,6 +70,9 @@ class ServiceForm(forms.ModelForm):
             "script_inject": _(
                 "Optional additional JavaScript to inject at the end of the Shynet script. This code will be injected on every page where this service is installed."
             ),
+            "sample_rate": _(
+                "What share of sessions should be recorded, from 0 to 1? For example, 0.1 records one in ten sessions; statistics are scaled up to make up for the rest. Use 1 to record every session."
+            ),
         }
 
     collect_ips = forms.BooleanField(
@@ -1,8 +1,7 @@
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.messages.views import SuccessMessageMixin
-from django.core.cache import cache
-from django.db.models import Q, Count
+from django.db.models import Q
 from django.shortcuts import get_object_or_404, reverse, redirect
 from django.views.generic import (
     CreateView,
@@ -15,7 +14,7 @@ from django.views.generic import (
 from rules.contrib.views import PermissionRequiredMixin
 
 from analytics.models import Session, Hit
-from core.models import Service, _default_api_token, RESULTS_LIMIT
+from core.models import Service, _default_api_token, weighted_count, RESULTS_LIMIT
 
 from .forms import ServiceForm
 from .mixins import DateRangeMixin
@@ -88,16 +87,6 @@ class ServiceUpdateView(
     def get_success_url(self):
         return reverse("dashboard:service", kwargs={"pk": self.object.uuid})
 
-    def form_valid(self, *args, **kwargs):
-        resp = super().form_valid(*args, **kwargs)
-        cache.set(
-            f"service_origins_{self.object.uuid}", self.object.origins, timeout=3600
-        )
-        cache.set(
-            f"script_inject_{self.object.uuid}", self.object.script_inject, timeout=3600
-        )
-        return resp
-
     def get_context_data(self, *args, **kwargs):
         data = super().get_context_data(*args, **kwargs)
         data["script_protocol"] = "https://" if settings.SCRIPT_USE_HTTPS else "http://"
@@ -158,10 +147,10 @@ class ServiceLocationsListView(
             start_time__lt=self.get_end_date(),
             start_time__gt=self.get_start_date(),
         )
-        self.hit_count = hits.count()
+        self.hit_count = hits.aggregate(count=weighted_count())["count"] or 0
 
         return (
-            hits.values("location").annotate(count=Count("location")).order_by("-count")
+            hits.values("location").annotate(count=weighted_count()).order_by("-count")
         )
 
     def get_context_data(self, **kwargs):
@@ -0,0 +1,7 @@
+#!/bin/bash
+# Start Gunicorn processes for the tracking endpoints only
+echo Launching Shynet ingress server...
+exec gunicorn shynet.ingress:application \
+    --bind 0.0.0.0:${INGRESS_PORT:-8081} \
+    --workers ${NUM_INGRESS_WORKERS:-${NUM_WORKERS:-1}} \
+    --timeout 100
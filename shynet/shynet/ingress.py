@@ -0,0 +1,72 @@
+"""
+Standalone WSGI and ASGI applications for the tracking endpoints.
+
+It serves only the routes in shynet/ingress_urls.py and runs them through
+INGRESS_MIDDLEWARE instead of the full middleware stack, so tracking requests skip
+sessions, CSRF, authentication and the like. Run it in its own process with
+`ingress.webserver.sh` (or serve `asgi_application` with an ASGI server) and route
+`/ingress/` to it from the reverse proxy.
+"""
+
+import os
+
+import django
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.exception import convert_exception_to_response
+from django.core.handlers.wsgi import WSGIHandler
+from django.utils.module_loading import import_string
+
+# The tracking endpoints handle CORS and origin validation themselves
+INGRESS_MIDDLEWARE = [
+    "django.middleware.security.SecurityMiddleware",
+    "django.contrib.sites.middleware.CurrentSiteMiddleware",
+]
+
+INGRESS_URLCONF = "shynet.ingress_urls"
+
+
+class IngressHandlerMixin:
+    def load_middleware(self, is_async=False):
+        # None of INGRESS_MIDDLEWARE hooks into views, templates or exceptions
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._exception_middleware = []
+
+        get_response = self._get_response_async if is_async else self._get_response
+        handler = convert_exception_to_response(get_response)
+        for middleware_path in reversed(INGRESS_MIDDLEWARE):
+            middleware = import_string(middleware_path)
+            handler = convert_exception_to_response(middleware(handler))
+        self._middleware_chain = handler
+
+    def get_response(self, request):
+        request.urlconf = INGRESS_URLCONF
+        return super().get_response(request)
+
+    async def get_response_async(self, request):
+        request.urlconf = INGRESS_URLCONF
+        return await super().get_response_async(request)
+
+
+class IngressHandler(IngressHandlerMixin, WSGIHandler):
+    pass
+
+
+class IngressASGIHandler(IngressHandlerMixin, ASGIHandler):
+    pass
+
+
+def get_ingress_application():
+    django.setup(set_prefix=False)
+    return IngressHandler()
+
+
+def get_ingress_asgi_application():
+    django.setup(set_prefix=False)
+    return IngressASGIHandler()
+
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "shynet.settings")
+
+application = get_ingress_application()
+asgi_application = get_ingress_asgi_application()
@@ -0,0 +1,10 @@
+"""URL configuration of the standalone ingress application (see shynet/ingress.py).
+
+Only the tracking endpoints are routed, under the same paths and namespace as in the
+main URL configuration, so reverse() gives the same results in both applications.
+"""
+from django.urls import include, path
+
+urlpatterns = [
+    path("ingress/", include(("analytics.ingress_urls", "ingress")), name="ingress"),
+]
@@ -230,6 +230,16 @@ STATICFILES_FINDERS = [
     "django.contrib.staticfiles.finders.AppDirectoriesFinder",
 ]
 
+# Without Redis, the cache is shared through a SQLite database that only Shynet's user
+# may access. By default it is kept with Shynet's other data, if there is a place for
+# that; otherwise each process keeps a cache of its own.
+SHARED_CACHE_LOCATION = os.getenv(
+    "SHARED_CACHE_LOCATION",
+    "/var/local/shynet/cache/cache.sqlite3"
+    if os.access("/var/local/shynet", os.W_OK)
+    else "",
+)
+
 # Redis
 if not DEBUG and os.getenv("REDIS_CACHE_LOCATION") is not None:
     CACHES = {
@@ -239,6 +249,20 @@ if not DEBUG and os.getenv("REDIS_CACHE_LOCATION") is not None:
             "KEY_PREFIX": "v1_",  # Increment when migrations occur
         }
     }
+elif SHARED_CACHE_LOCATION != "":
+    # Without Redis, share the cache between the processes of this host through a
+    # SQLite database (set SHARED_CACHE_LOCATION to "" to keep it in each process)
+    CACHES = {
+        "default": {
+            "BACKEND": "core.sqlite_cache.SQLiteCache",
+            "LOCATION": SHARED_CACHE_LOCATION,
+            "KEY_PREFIX": "v1_",  # Increment when migrations occur
+            "OPTIONS": {"MAX_ENTRIES": 100000},
+        }
+    }
+
+# Tests clear the cache, so they run against one of their own (see conftest.py for pytest)
+TEST_RUNNER = "shynet.test_runner.TestRunner"
 
 
 # Auth
@@ -281,6 +305,18 @@ CELERY_REDIS_SOCKET_TIMEOUT = 15
 
 MAXMIND_CITY_DB = os.getenv("MAXMIND_CITY_DB", "/etc/GeoLite2-City.mmdb")
 MAXMIND_ASN_DB = os.getenv("MAXMIND_ASN_DB", "/etc/GeoLite2-ASN.mmdb")
+# Which GeoIP data to collect: any of "country", "city" (country, coordinates and time
+# zone) and "asn". Databases that aren't needed are never opened.
+MAXMIND_ENRICHMENT = [
+    level.strip()
+    for level in os.getenv("MAXMIND_ENRICHMENT", "city,asn").split(",")
+    if len(level.strip()) > 0
+]
+# How many IP addresses should each process remember the GeoIP data of?
+MAXMIND_CACHE_SIZE = int(os.getenv("MAXMIND_CACHE_SIZE", "10000"))
+# How often should workers check the GeoIP databases for updates, in seconds? Set to 0
+# to only load them once.
+MAXMIND_RELOAD_INTERVAL = int(os.getenv("MAXMIND_RELOAD_INTERVAL", "60"))
 
 
 MESSAGE_TAGS = {
@@ -349,6 +385,21 @@ SCRIPT_USE_HTTPS = os.getenv("SCRIPT_USE_HTTPS", "True") == "True"
 # milliseconds?
 SCRIPT_HEARTBEAT_FREQUENCY = int(os.getenv("SCRIPT_HEARTBEAT_FREQUENCY", "5000"))
 
+# How many heartbeats should the tracking script collect before sending them at once?
+# Whatever was collected is also sent when the visitor leaves or hides the page.
+SCRIPT_HEARTBEAT_BATCH_SIZE = int(os.getenv("SCRIPT_HEARTBEAT_BATCH_SIZE", "1"))
+
+# How should the tracking script measure how long pages are viewed? "heartbeat" sends
+# a heartbeat every SCRIPT_HEARTBEAT_FREQUENCY ms while the page is visible;
+# "visibility" adds up how long the page was visible and reports it when the page is
+# hidden or left, plus a keepalive every SCRIPT_KEEPALIVE_FREQUENCY ms while visible.
+SCRIPT_TRACKING_MODE = os.getenv("SCRIPT_TRACKING_MODE", "heartbeat").lower()
+SCRIPT_KEEPALIVE_FREQUENCY = int(os.getenv("SCRIPT_KEEPALIVE_FREQUENCY", "60000"))
+
+# How long may browsers reuse the tracking script before checking for changes, in
+# seconds? Changes to a service's settings reach visitors after at most this long.
+SCRIPT_CACHE_MAX_AGE = int(os.getenv("SCRIPT_CACHE_MAX_AGE", "300"))
+
 # How much time can elapse between requests from the same user before a new
 # session is created, in seconds?
 SESSION_MEMORY_TIMEOUT = int(os.getenv("SESSION_MEMORY_TIMEOUT", "1800"))
@@ -356,6 +407,76 @@ SESSION_MEMORY_TIMEOUT = int(os.getenv("SESSION_MEMORY_TIMEOUT", "1800"))
 # Should the Shynet version information be displayed?
 SHOW_SHYNET_VERSION = os.getenv("SHOW_SHYNET_VERSION", "True") == "True"
 
+# How many ingress events should be written to the database at once? Set to 0 to
+# process every event in its own task. Batching requires a Celery broker and a cache
+# shared by all workers (such as Redis).
+INGRESS_BATCH_SIZE = int(os.getenv("INGRESS_BATCH_SIZE", "0"))
+
+# How long can a partially filled batch wait before it is written, in seconds?
+INGRESS_BATCH_TIMEOUT = int(os.getenv("INGRESS_BATCH_TIMEOUT", "5"))
+
+# How many threads per process should look up the devices and locations of new
+# visitors in a batch of events? Set to 0 to look them up one after the other.
+INGRESS_ENRICH_THREADS = int(os.getenv("INGRESS_ENRICH_THREADS", "0"))
+
+# Without a Celery broker, how many events can wait in each process' memory to be
+# written by a background thread? Set to 0 to write events before responding.
+BACKGROUND_WRITER_QUEUE_SIZE = int(os.getenv("BACKGROUND_WRITER_QUEUE_SIZE", "0"))
+
+# How many queued events can the background writer write at once?
+BACKGROUND_WRITER_BATCH_SIZE = int(os.getenv("BACKGROUND_WRITER_BATCH_SIZE", "100"))
+
+# Where should tracking events be kept when the broker, cache or database is down?
+# They are written to the database once it is back. Leave empty to drop them.
+INGRESS_SPOOL_DIRECTORY = os.getenv("INGRESS_SPOOL_DIRECTORY", "")
+
+# How large can each file in INGRESS_SPOOL_DIRECTORY grow, in bytes?
+INGRESS_SPOOL_SEGMENT_SIZE = int(os.getenv("INGRESS_SPOOL_SEGMENT_SIZE", "16777216"))
+
+# How often should accumulated heartbeats be written to the database, in seconds? Set
+# to 0 to write every heartbeat immediately. Sessions may appear offline for up to
+# this long, so keep it close to SCRIPT_HEARTBEAT_FREQUENCY.
+HEARTBEAT_FLUSH_INTERVAL = int(os.getenv("HEARTBEAT_FLUSH_INTERVAL", "0"))
+
+# How long may each process keep what it read from the cache for itself, in seconds?
+# Saves a round trip to the cache for service settings, tracking scripts and the
+# sessions of recent events; changes to a service reach every process after at most
+# this long. Set to 0 to always read from the cache.
+LOCAL_CACHE_TTL = int(os.getenv("LOCAL_CACHE_TTL", "0"))
+
+# How many entries may each process keep per local cache?
+LOCAL_CACHE_SIZE = int(os.getenv("LOCAL_CACHE_SIZE", "10000"))
+
+# How far behind can ingestion fall before heartbeats are dropped, in seconds? Set to 0
+# to never drop them.
+INGRESS_SHED_HEARTBEATS_LAG = int(os.getenv("INGRESS_SHED_HEARTBEATS_LAG", "0"))
+
+# How far behind can ingestion fall before only a sample of visitors is recorded, in
+# seconds? The further behind, the smaller the sample; counts shown in the dashboard
+# are scaled up to make up for it. Set to 0 to always record every visitor.
+INGRESS_SAMPLE_LAG = int(os.getenv("INGRESS_SAMPLE_LAG", "0"))
+
+# What share of visitors should be recorded at least while sampling (from 0 to 1)?
+INGRESS_MIN_SAMPLE_RATE = float(os.getenv("INGRESS_MIN_SAMPLE_RATE", "0.01"))
+
+# How many distinct user agents should each process remember the parsed form of?
+USER_AGENT_CACHE_SIZE = int(os.getenv("USER_AGENT_CACHE_SIZE", "4096"))
+
+# Should parsed user agents also be shared between processes through the cache?
+USER_AGENT_SHARED_CACHE = os.getenv("USER_AGENT_SHARED_CACHE", "False") == "True"
+
+# Should the tracking endpoints be served by async views? Only worthwhile when Shynet
+# runs under an ASGI server (shynet.asgi or shynet.ingress:asgi_application).
+ASYNC_INGRESS = os.getenv("ASYNC_INGRESS", "False") == "True"
+
+# How many threads per process hand events from the async views to the queue (or,
+# without a Celery broker, ingest them)?
+ASYNC_INGRESS_THREADS = int(os.getenv("ASYNC_INGRESS_THREADS", "4"))
+
+# How many requests per process may wait for those threads? Beyond that, their events
+# are spooled to disk if INGRESS_SPOOL_DIRECTORY is set, and dropped otherwise.
+ASYNC_INGRESS_BACKLOG = int(os.getenv("ASYNC_INGRESS_BACKLOG", "1000"))
+
 # Should Shynet show third-party icons in the dashboard?
 SHOW_THIRD_PARTY_ICONS = os.getenv("SHOW_THIRD_PARTY_ICONS", "True") == "True"
 
@@ -0,0 +1,36 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+def isolated_cache():
+    # Tests clear the cache, so they get a cache of their own rather than that of an
+    # instance running on the same host
+    directory = tempfile.mkdtemp(prefix="shynet-test-cache-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    return override_settings(
+        CACHES={
+            "default": {
+                "BACKEND": "core.sqlite_cache.SQLiteCache",
+                "LOCATION": os.path.join(directory, "cache.sqlite3"),
+            }
+        }
+    )
+
+
+class TestRunner(DiscoverRunner):
+    # Runs `manage.py test` with an isolated cache. The same is done for pytest in
+    # conftest.py.
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._isolated_cache = isolated_cache()
+        self._isolated_cache.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._isolated_cache.disable()
+        super().teardown_test_environment(**kwargs)